@@ -0,0 +1,96 @@
+"""
+Benchmark: serialization cost of one page of envíos (100 rows by default).
+
+Compares the default response path (build EnvioResponse per row, FastAPI re-validates
+against response_model and encodes with the stdlib json module) with the fast path
+enabled by FAST_JSON_RESPONSES (trusted documents serialized directly by orjson).
+
+Usage: python bench_serialization.py [rows] [iterations]
+"""
+import json
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import List
+
+# server.py reads these at import time; no connection is opened by the benchmark
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'bench')
+os.environ.setdefault('JWT_SECRET', 'bench')
+
+import orjson
+from pydantic import TypeAdapter
+
+from server import EnvioResponse
+
+
+def make_envio(i: int) -> dict:
+    fecha = datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i)
+    historial = [
+        {
+            "estado": estado,
+            "fecha": fecha + timedelta(hours=n),
+            "usuario_id": str(uuid.uuid4()),
+            "usuario_nombre": "Repartidor Test",
+            "receptor_nombre": None,
+            "receptor_cedula": None,
+            "imagen_url": None,
+            "comentario": None,
+        }
+        for n, estado in enumerate(["Ingresada", "Asignado a courier", "Entregado"])
+    ]
+    return {
+        "id": str(uuid.uuid4()),
+        "ticket": f"BENCH-{i:06d}",
+        "calle": "Av. 18 de Julio",
+        "numero": str(1000 + i),
+        "apto": "101",
+        "esquina": "Ejido",
+        "motivo": "Entrega",
+        "departamento": "Montevideo",
+        "comentarios": "Dejar en portería",
+        "telefono": "099123456",
+        "contacto": "Juan Pérez",
+        "fecha_carga": fecha,
+        "estado": "Entregado",
+        "historial_estados": historial,
+        "creado_por": str(uuid.uuid4()),
+        "creado_por_nombre": "Administrador",
+    }
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    docs = [make_envio(i) for i in range(rows)]
+    adapter = TypeAdapter(List[EnvioResponse])
+
+    def default_path():
+        # Handler builds the models, FastAPI validates them again and renders JSONResponse
+        models = [EnvioResponse(**e) for e in docs]
+        content = adapter.dump_python(adapter.validate_python(models), mode="json")
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+    def single_validation_path():
+        # Plain documents returned to FastAPI (FAST_JSON_RESPONSES disabled)
+        content = adapter.dump_python(adapter.validate_python(docs), mode="json")
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+    def fast_path():
+        # ORJSONResponse over trusted documents (FAST_JSON_RESPONSES enabled)
+        return orjson.dumps(docs)
+
+    print(f"Serialization cost per {rows}-row page ({iterations} iterations)")
+    for name, fn in [
+        ("models + re-validation + json", default_path),
+        ("single validation + json", single_validation_path),
+        ("orjson fast path", fast_path),
+    ]:
+        elapsed = min(timeit.repeat(fn, number=iterations, repeat=3)) / iterations
+        print(f"  {name:<32} {elapsed * 1000:8.3f} ms/page  ({len(fn())} bytes)")
+
+
+if __name__ == "__main__":
+    main()
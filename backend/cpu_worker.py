@@ -0,0 +1,15 @@
+"""
+Entry point of the CPU pool workers.
+
+CpuBoundPool submits timed_call, so spawned worker processes unpickle it from this module. It and
+the functions submitted with it must not import server.py, or every cold worker pays for the whole
+server import and its side effects.
+"""
+import time
+
+
+def timed_call(fn, args):
+    """Runs in the pool worker: the result and the seconds the call took there"""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
@@ -0,0 +1,86 @@
+"""
+Envío export formats shared by the CSV and Excel endpoints.
+
+Kept free of server imports and import-time side effects: Excel workbooks are built in spawned
+worker processes, which import this module and cpu_worker.py, not server.py, to unpickle the task.
+"""
+from datetime import datetime
+from io import BytesIO
+from typing import List
+
+from openpyxl import Workbook
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+
+
+def format_fecha(value) -> str:
+    """ISO 8601 string for datetimes read from Mongo; legacy string values are returned as is"""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+EXPORT_HEADERS = [
+    "Ticket", "Estado", "Fecha/Hora", "Contacto", "Teléfono", "Calle", 
+    "Número", "Apto", "Esquina", "Departamento", "Motivo", "Comentarios"
+]
+# Only the exported fields are read, so photos and history are never loaded or sent to the workers
+EXPORT_PROJECTION = {
+    "_id": 0, "ticket": 1, "estado": 1, "fecha_carga": 1, "contacto": 1, "telefono": 1, "calle": 1,
+    "numero": 1, "apto": 1, "esquina": 1, "departamento": 1, "motivo": 1, "comentarios": 1
+}
+
+
+def export_row(envio: dict) -> list:
+    """Values of an envío in EXPORT_HEADERS order"""
+    return [
+        envio.get('ticket', ''),
+        envio.get('estado', 'Ingresada'),
+        format_fecha(envio.get('fecha_carga', '')),
+        envio.get('contacto', ''),
+        envio.get('telefono', ''),
+        envio.get('calle', ''),
+        envio.get('numero', ''),
+        envio.get('apto', ''),
+        envio.get('esquina', ''),
+        envio.get('departamento', ''),
+        envio.get('motivo', ''),
+        envio.get('comentarios', '')
+    ]
+
+
+def create_excel_workbook(envios: List[dict]) -> BytesIO:
+    """Create an Excel workbook with envio data"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Envíos"
+    
+    header_font = Font(bold=True, color="FFFFFF", size=11)
+    header_fill = PatternFill(start_color="C91A25", end_color="C91A25", fill_type="solid")
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    
+    thin_border = Border(
+        left=Side(style='thin', color='E2E8F0'),
+        right=Side(style='thin', color='E2E8F0'),
+        top=Side(style='thin', color='E2E8F0'),
+        bottom=Side(style='thin', color='E2E8F0')
+    )
+    
+    for col, header in enumerate(EXPORT_HEADERS, 1):
+        cell = ws.cell(row=1, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = header_alignment
+        cell.border = thin_border
+    
+    for row, envio in enumerate(envios, 2):
+        for col, value in enumerate(export_row(envio), 1):
+            cell = ws.cell(row=row, column=col, value=value)
+            cell.border = thin_border
+            cell.alignment = Alignment(vertical="center")
+    
+    column_widths = [15, 18, 22, 20, 15, 25, 10, 10, 20, 15, 18, 30]
+    for i, width in enumerate(column_widths, 1):
+        ws.column_dimensions[chr(64 + i)].width = width
+    
+    output = BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
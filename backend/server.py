@@ -1,40 +1,423 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Request, Response, Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse, ORJSONResponse, JSONResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, ReadPreference, UpdateOne, ReplaceOne, DeleteOne, monitoring
+from pymongo.read_preferences import PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.errors import PyMongoError, ExecutionTimeout, OperationFailure, DuplicateKeyError, CollectionInvalid, BulkWriteError
 import os
+import csv
+import asyncio
+import re
+import math
+import secrets
+import random
+import time
+import hashlib
+import unicodedata
+import zlib
 import logging
+import sys
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, PlainSerializer, AfterValidator
+from typing import List, Optional, Annotated, Literal, Tuple, Union
 import uuid
-from datetime import datetime, timezone, timedelta
-from io import BytesIO
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from datetime import datetime, timezone, timedelta, date
+from zoneinfo import ZoneInfo
+from io import StringIO
 import jwt
 import bcrypt
 import base64
+import orjson
+import requests
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+from cpu_worker import timed_call
+from exports import EXPORT_HEADERS, EXPORT_PROJECTION, create_excel_workbook, export_row, format_fecha
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection. Pool options are only passed when set, so driver/URI defaults apply otherwise
+MONGO_CLIENT_OPTIONS = {
+    option: int(os.environ[env])
+    for option, env in [
+        ("maxPoolSize", "MONGO_MAX_POOL_SIZE"),
+        ("minPoolSize", "MONGO_MIN_POOL_SIZE"),
+        ("maxIdleTimeMS", "MONGO_MAX_IDLE_TIME_MS"),
+        ("waitQueueTimeoutMS", "MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+        ("serverSelectionTimeoutMS", "MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+        ("connectTimeoutMS", "MONGO_CONNECT_TIMEOUT_MS"),
+        ("socketTimeoutMS", "MONGO_SOCKET_TIMEOUT_MS"),
+    ]
+    if os.environ.get(env)
+}
+
+# Request tracing: a span per request and per Mongo command, exported as JSON lines to TRACE_FILE
+# or to an OTLP/HTTP collector at TRACE_OTLP_ENDPOINT. Nothing is installed unless TRACING_ENABLED
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'false').lower() == 'true'
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'file')  # file | otlp
+TRACE_FILE = os.environ.get('TRACE_FILE', str(ROOT_DIR / 'traces.jsonl'))
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'logistica-backend')
+# Share of requests traced when the caller did not decide it in a traceparent header
+TRACE_SAMPLE_RATIO = float(os.environ.get('TRACE_SAMPLE_RATIO', 1.0))
+TRACE_FLUSH_MS = int(os.environ.get('TRACE_FLUSH_MS', 2000))
+TRACE_BUFFER_MAX = int(os.environ.get('TRACE_BUFFER_MAX', 50000))
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, kind: str, trace_id: str, parent_id: Optional[str], attributes: dict):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+# Span of the request (or block) being run; copied into Motor's executor threads with the context
+CURRENT_SPAN: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Creates spans and keeps finished ones until the exporter ships them"""
+
+    def __init__(self, buffer_max: int):
+        self.buffer_max = buffer_max
+        self.finished = []
+        # Mongo command spans end on Motor's executor threads, concurrently with the exporter
+        self.lock = threading.Lock()
+
+    def start(self, name: str, kind: str = "internal", attributes: Optional[dict] = None,
+              parent: Optional[Span] = None, trace_id: Optional[str] = None, parent_id: Optional[str] = None) -> Span:
+        if parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        return Span(name, kind, trace_id or secrets.token_hex(16), parent_id, attributes or {})
+
+    def end(self, span: Span, error: Optional[str] = None):
+        span.end_ns = time.time_ns()
+        span.error = error
+        with self.lock:
+            if len(self.finished) < self.buffer_max:
+                self.finished.append(span)
+                return
+        incr_metric("tracing.dropped")
+
+    def take_finished(self) -> List[Span]:
+        """Finished spans so far, leaving an empty buffer"""
+        with self.lock:
+            spans, self.finished = self.finished, []
+        return spans
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Child span of the current one around a block; does nothing outside a traced request"""
+        parent = CURRENT_SPAN.get()
+        if parent is None:
+            yield None
+            return
+        span = self.start(name, "internal", attributes, parent)
+        token = CURRENT_SPAN.set(span)
+        error = None
+        try:
+            yield span
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+            self.end(span, error)
+
+
+tracer = Tracer(TRACE_BUFFER_MAX)
+
+
+class MongoSpanListener(monitoring.CommandListener):
+    """A client span per Mongo command run inside a traced request. Command contents are not recorded"""
+
+    def __init__(self):
+        self.spans = {}  # (connection, request id) -> open span
+
+    def started(self, event):
+        parent = CURRENT_SPAN.get()
+        if parent is None:
+            return
+        coleccion = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        attributes = {"db.system": "mongodb", "db.name": event.database_name, "db.operation": event.command_name}
+        name = f"mongo.{event.command_name}"
+        if isinstance(coleccion, str):
+            attributes["db.mongodb.collection"] = coleccion
+            name += f" {coleccion}"
+        self.spans[(event.connection_id, event.request_id)] = tracer.start(name, "client", attributes, parent)
+
+    def succeeded(self, event):
+        span = self.spans.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            tracer.end(span)
+
+    def failed(self, event):
+        span = self.spans.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            tracer.end(span, str(event.failure.get("errmsg", event.failure)))
+
+
+if TRACING_ENABLED:
+    MONGO_CLIENT_OPTIONS["event_listeners"] = [MongoSpanListener()]
+
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# Dates are stored as native BSON datetimes and read back as aware UTC datetimes
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, tzinfo=timezone.utc, **MONGO_CLIENT_OPTIONS)
 db = client[os.environ['DB_NAME']]
 
+# Endpoint classes: default read preference and maxTimeMS for their queries.
+# Writes always go through `db` (primary); read-heavy classes can be routed to secondaries
+# with MONGO_READ_PREFERENCE or MONGO_READ_PREFERENCE_<CLASS>, and maxTimeMS overridden with
+# MONGO_MAX_TIME_MS_<CLASS>. Interactive reads stay on the primary to see their own writes, and
+# delta sync too: on a lagging secondary the sync token would move past writes not replicated yet.
+ENDPOINT_CLASSES = {
+    "interactive": ("primary", 2000),    # get_envio, envío messages
+    "list": (None, 5000),                # get_envios, message logs
+    "sync": ("primary", 5000),           # delta sync
+    "stats": (None, 10000),              # counts and reports
+    "export": (None, 60000),             # Excel/CSV exports
+    "tracking": (None, 2000),            # public tracking
+}
+
+
+def _read_preference(name: str):
+    if name == "primary":
+        return ReadPreference.PRIMARY
+    modes = {
+        "primaryPreferred": PrimaryPreferred,
+        "secondary": Secondary,
+        "secondaryPreferred": SecondaryPreferred,
+        "nearest": Nearest,
+    }
+    max_staleness = int(os.environ.get('MONGO_READ_MAX_STALENESS_SECONDS', -1))
+    return modes[name](max_staleness=max_staleness)
+
+
+READ_DBS = {}
+QUERY_MAX_TIME_MS = {}
+for endpoint_class, (default_preference, default_max_time) in ENDPOINT_CLASSES.items():
+    preference = default_preference or os.environ.get(
+        f'MONGO_READ_PREFERENCE_{endpoint_class.upper()}',
+        os.environ.get('MONGO_READ_PREFERENCE', 'primary')
+    )
+    READ_DBS[endpoint_class] = client.get_database(
+        os.environ['DB_NAME'], read_preference=_read_preference(preference)
+    )
+    QUERY_MAX_TIME_MS[endpoint_class] = int(
+        os.environ.get(f'MONGO_MAX_TIME_MS_{endpoint_class.upper()}', default_max_time)
+    )
+
+
+def read_db(endpoint_class: str):
+    """Database handle with the read preference configured for an endpoint class"""
+    return READ_DBS[endpoint_class]
+
+
+# Per-endpoint query budgets: (endpoint class, status when the budget is exceeded, cursor batch size).
+# The budget defaults to the class maxTimeMS and can be set with QUERY_BUDGET_MS_<ENDPOINT>, the
+# batch size with QUERY_BATCH_SIZE_<ENDPOINT>. Exports answer 413 (result too large to produce),
+# interactive endpoints 503.
+QUERY_BUDGETS = {
+    "get_envios": ("list", 503, 100),
+    "get_envios_count": ("stats", 503, None),
+    "export_excel": ("export", 413, 1000),
+    "export_csv": ("export", 413, 500),
+    "get_message_logs": ("list", 503, 100),
+    "sync_envios": ("sync", 503, None),
+    "envios_cercanos": ("list", 503, None),
+    "reporte_sla": ("stats", 503, None),
+    "reporte_diario": ("stats", 503, None),
+    "autocompletar_direcciones": ("list", 503, None),
+    "envios_cliente": ("list", 503, 100),
+}
+QUERY_BUDGET_MS = {
+    endpoint: int(os.environ.get(f'QUERY_BUDGET_MS_{endpoint.upper()}', QUERY_MAX_TIME_MS[endpoint_class]))
+    for endpoint, (endpoint_class, _, _) in QUERY_BUDGETS.items()
+}
+QUERY_BATCH_SIZE = {
+    endpoint: int(os.environ.get(f'QUERY_BATCH_SIZE_{endpoint.upper()}', batch_size or 0)) or None
+    for endpoint, (_, _, batch_size) in QUERY_BUDGETS.items()
+}
+
+
+def budgeted_find(collection, endpoint: str, *args, **kwargs):
+    """find() with the endpoint's maxTimeMS and batch size applied"""
+    cursor = collection.find(*args, **kwargs).max_time_ms(QUERY_BUDGET_MS[endpoint])
+    if QUERY_BATCH_SIZE[endpoint]:
+        cursor = cursor.batch_size(QUERY_BATCH_SIZE[endpoint])
+    return cursor
+
+
+def budgeted_aggregate(collection, endpoint: str, pipeline: list):
+    """aggregate() with the endpoint's maxTimeMS and batch size applied"""
+    options = {"maxTimeMS": QUERY_BUDGET_MS[endpoint], "allowDiskUse": True}
+    if QUERY_BATCH_SIZE[endpoint]:
+        options["batchSize"] = QUERY_BATCH_SIZE[endpoint]
+    return collection.aggregate(pipeline, **options)
+
 # JWT Config
 JWT_SECRET = os.environ['JWT_SECRET']
 JWT_ALGORITHM = "HS256"
-JWT_EXPIRATION_HOURS = 24
+# Short-lived access tokens, renewed with rotating refresh tokens stored in the sessions collection
+ACCESS_TOKEN_MINUTES = int(os.environ.get('ACCESS_TOKEN_MINUTES', 15))
+REFRESH_TOKEN_DAYS = int(os.environ.get('REFRESH_TOKEN_DAYS', 7))
+
+# Stateless auth: trust the token claims instead of loading the user on every request.
+# Deleted users are rejected through an in-memory revocation set refreshed from Mongo.
+AUTH_STATELESS = os.environ.get('AUTH_STATELESS', 'false').lower() == 'true'
+REVOCATION_REFRESH_SECONDS = int(os.environ.get('REVOCATION_REFRESH_SECONDS', 30))
+
+# Archival of delivered envíos into envios_archive
+ARCHIVE_ENABLED = os.environ.get('ARCHIVE_ENABLED', 'false').lower() == 'true'
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get('ARCHIVE_INTERVAL_HOURS', 6))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 500))
+# POST /admin/archivar stops after this long; the rest is left for another call or the periodic run
+ARCHIVE_REQUEST_SECONDS = float(os.environ.get('ARCHIVE_REQUEST_SECONDS', 20))
+
+# Identifies this worker as the holder of leases on periodic jobs (see acquire_lease)
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Message logs older than this are removed by a TTL index. Opt-in: 0 (default) keeps them forever
+MESSAGE_LOG_RETENTION_DAYS = int(os.environ.get('MESSAGE_LOG_RETENTION_DAYS', 0))
+MESSAGES_PAGE_MAX = 200
+
+# Delta sync for courier devices. Tombstones of deleted envíos are kept SYNC_TOMBSTONE_DAYS;
+# older sync tokens get a full resync. The lag covers writes that commit after a later read.
+SYNC_PAGE_MAX = int(os.environ.get('SYNC_PAGE_MAX', 500))
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', 30))
+SYNC_SAFETY_LAG_SECONDS = float(os.environ.get('SYNC_SAFETY_LAG_SECONDS', 5))
+# Offline street gazetteer used to geocode envíos (CSV of numbered street segments)
+GAZETTEER_PATH = os.environ.get('GAZETTEER_PATH', str(ROOT_DIR / 'data' / 'calles_uruguay.csv'))
+CERCANOS_MAX_KM = float(os.environ.get('CERCANOS_MAX_KM', 20))
+
+# Courier location pings: buffered per worker and written to the courier_locations time-series
+# collection every LOCATION_FLUSH_MS (or as soon as LOCATION_FLUSH_SIZE pings are waiting)
+LOCATION_FLUSH_MS = int(os.environ.get('LOCATION_FLUSH_MS', 1000))
+LOCATION_FLUSH_SIZE = int(os.environ.get('LOCATION_FLUSH_SIZE', 1000))
+LOCATION_BUFFER_MAX = int(os.environ.get('LOCATION_BUFFER_MAX', 50000))
+LOCATION_BATCH_MAX = int(os.environ.get('LOCATION_BATCH_MAX', 500))
+LOCATION_RETENTION_DAYS = int(os.environ.get('LOCATION_RETENTION_DAYS', 30))
+# Last known positions are re-read from Mongo after this long, so every worker sees other workers' pings
+LOCATION_CACHE_SECONDS = float(os.environ.get('LOCATION_CACHE_SECONDS', 5))
+# Older positions are not shown on the tracking page
+LOCATION_STALE_MINUTES = int(os.environ.get('LOCATION_STALE_MINUTES', 10))
+
+# Daily KPI rollups (kpi_daily), bucketed by calendar day in REPORTS_TZ. Deleted envíos are subtracted
+# when deleted; every night at KPI_RECOMPUTE_HOUR one worker recomputes the last KPI_RECOMPUTE_DAYS days
+# from the envíos to absorb lost increments.
+REPORTS_TZ = ZoneInfo(os.environ.get('REPORTS_TZ', 'America/Montevideo'))
+KPI_NIGHTLY_ENABLED = os.environ.get('KPI_NIGHTLY_ENABLED', 'true').lower() == 'true'
+KPI_RECOMPUTE_HOUR = int(os.environ.get('KPI_RECOMPUTE_HOUR', 3))
+KPI_RECOMPUTE_DAYS = int(os.environ.get('KPI_RECOMPUTE_DAYS', 2))
+
+# Largest batch of queued offline state changes accepted in one request
+OFFLINE_BATCH_MAX = int(os.environ.get('OFFLINE_BATCH_MAX', 500))
+
+# Stored responses for Idempotency-Key retries
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+# A request still "in progress" after this long is assumed dead and can be retried
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 60))
+
+# Server-side ticket generation: <PREFIX>-<number>, numbers reserved in blocks per worker
+TICKET_PREFIX = os.environ.get('TICKET_PREFIX', 'ENV')
+TICKET_DIGITS = int(os.environ.get('TICKET_DIGITS', 6))
+TICKET_BLOCK_SIZE = int(os.environ.get('TICKET_BLOCK_SIZE', 50))
+TICKET_PREFIX_PATTERN = re.compile(r"^[A-Z0-9]{1,10}$")
 
 # Frontend URL for tracking links
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'https://shiptracker-44.preview.emergentagent.com')
 
+# Serialize read endpoints with orjson and skip response_model re-validation
+FAST_JSON_RESPONSES = os.environ.get('FAST_JSON_RESPONSES', 'false').lower() == 'true'
+
+
+def _rate_rule(name: str, burst: int, per_minute: int) -> tuple:
+    """Token bucket (capacity, refill per second), overridable with RATE_LIMIT_<NAME>_BURST / _PER_MINUTE"""
+    prefix = f"RATE_LIMIT_{name.upper()}"
+    capacity = float(os.environ.get(f"{prefix}_BURST", burst))
+    refill = float(os.environ.get(f"{prefix}_PER_MINUTE", per_minute)) / 60
+    return capacity, refill
+
+
+# Rate limiting for login and public tracking
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # memory | mongo (shared between workers)
+# Only behind a reverse proxy: the client IP is then the X-Forwarded-For entry added by the
+# outermost of RATE_LIMIT_PROXY_HOPS trusted proxies. Entries to its left are client-controlled
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get('RATE_LIMIT_TRUST_FORWARDED', 'false').lower() == 'true'
+RATE_LIMIT_PROXY_HOPS = max(1, int(os.environ.get('RATE_LIMIT_PROXY_HOPS', 1)))
+RATE_LIMITS = {
+    "login_ip": _rate_rule("login_ip", 30, 10),
+    "login_user": _rate_rule("login_user", 5, 5),
+    "tracking_ip": _rate_rule("tracking_ip", 60, 60),
+    "tracking_ticket": _rate_rule("tracking_ticket", 30, 30),
+}
+
+# Response compression (gzip, and brotli when installed)
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# Content that is already compressed (xlsx is a zip archive) is sent as is
+COMPRESSION_SKIP_TYPES = (
+    "image/", "video/", "audio/", "application/zip", "application/gzip", "application/pdf",
+    "application/vnd.openxmlformats-officedocument",
+)
+
+# In-process counters exposed on /api/metrics
+METRICS = Counter()
+
+# Event-loop lag monitor: scheduling delay sampled every LOOP_MONITOR_INTERVAL_MS, and the loop
+# thread's stack logged when it stays blocked longer than LOOP_BLOCK_THRESHOLD_MS
+LOOP_MONITOR_ENABLED = os.environ.get('LOOP_MONITOR_ENABLED', 'false').lower() == 'true'
+LOOP_MONITOR_INTERVAL_MS = int(os.environ.get('LOOP_MONITOR_INTERVAL_MS', 100))
+LOOP_BLOCK_THRESHOLD_MS = int(os.environ.get('LOOP_BLOCK_THRESHOLD_MS', 200))
+
+# Sampling profiler: admins send PROFILE_HEADER on any request to get its profile stored, and with
+# PROFILE_SAMPLE_EVERY=N one request in N of each route is profiled into per-route flame data.
+# The middleware is only installed when PROFILING_ENABLED
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILE_HEADER = os.environ.get('PROFILE_HEADER', 'X-Profile')
+PROFILE_SAMPLE_EVERY = int(os.environ.get('PROFILE_SAMPLE_EVERY', 0))
+PROFILE_INTERVAL_MS = int(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_RETENTION_HOURS = int(os.environ.get('PROFILE_RETENTION_HOURS', 24))
+
+# CPU-bound work kept off the event loop: processes for pure-Python work (Excel),
+# threads for C calls that release the GIL (bcrypt) or are short (base64)
+CPU_POOL_PROCESSES = int(os.environ.get('CPU_POOL_PROCESSES', 2))
+CPU_POOL_THREADS = int(os.environ.get('CPU_POOL_THREADS', 4))
+# Calls allowed to wait for a free worker before new ones are rejected with 503
+CPU_POOL_QUEUE_MAX = int(os.environ.get('CPU_POOL_QUEUE_MAX', 16))
+
 # Create the main app
 app = FastAPI()
 
@@ -45,6 +428,11 @@ users_router = APIRouter(prefix="/api/users", tags=["users"])
 envios_router = APIRouter(prefix="/api/envios", tags=["envios"])
 messages_router = APIRouter(prefix="/api/messages", tags=["messages"])
 tracking_router = APIRouter(prefix="/api/tracking", tags=["tracking"])
+couriers_router = APIRouter(prefix="/api/couriers", tags=["couriers"])
+reports_router = APIRouter(prefix="/api/reports", tags=["reports"])
+direcciones_router = APIRouter(prefix="/api/direcciones", tags=["direcciones"])
+clientes_router = APIRouter(prefix="/api/clientes", tags=["clientes"])
+profiles_router = APIRouter(prefix="/api/profiles", tags=["profiles"])
 
 security = HTTPBearer()
 
@@ -61,6 +449,8 @@ MOTIVOS_ENVIO = ["Entrega", "Retiro y Entrega", "Retiro"]
 
 # Estados de envío
 ESTADOS_ENVIO = ["Ingresada", "Asignado a courier", "Entregado", "No entregado"]
+# Envíos still waiting for a delivery
+ESTADOS_ABIERTOS = ["Ingresada", "Asignado a courier", "No entregado"]
 
 # Roles
 ROLES = ["admin", "agente", "repartidor"]
@@ -68,6 +458,12 @@ ROLES = ["admin", "agente", "repartidor"]
 
 # ============== MODELS ==============
 
+# Stored as BSON datetime, emitted as the ISO 8601 string the frontend expects
+IsoDatetime = Annotated[datetime, PlainSerializer(lambda v: v.isoformat(), return_type=str, when_used="json")]
+# Timestamps sent by devices; one without an offset is taken as UTC so it compares with server times
+UtcDatetime = Annotated[datetime, AfterValidator(lambda v: v if v.tzinfo else v.replace(tzinfo=timezone.utc))]
+
+
 class UserBase(BaseModel):
     username: str = Field(..., min_length=3)
     nombre: str = Field(..., min_length=2)
@@ -93,9 +489,21 @@ class UserLogin(BaseModel):
 class TokenResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
+    expires_in: int = ACCESS_TOKEN_MINUTES * 60
+    refresh_token: Optional[str] = None
     user: UserResponse
 
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+class Ubicacion(BaseModel):
+    """GeoJSON point; coordinates are [longitud, latitud]"""
+    type: Literal["Point"] = "Point"
+    coordinates: Tuple[Annotated[float, Field(ge=-180, le=180)], Annotated[float, Field(ge=-90, le=90)]]
+
+
 class EnvioBase(BaseModel):
     ticket: str = Field(..., min_length=1, description="Número de ticket para rastreo")
     calle: str = Field(..., min_length=1, description="Nombre de la calle")
@@ -107,10 +515,12 @@ class EnvioBase(BaseModel):
     comentarios: Optional[str] = Field(default="", description="Comentarios adicionales")
     telefono: str = Field(..., min_length=1, description="Número de teléfono")
     contacto: str = Field(..., min_length=1, description="Nombre de contacto")
+    ubicacion: Optional[Ubicacion] = Field(default=None, description="Coordenadas; si se omiten se buscan en el nomenclátor")
 
 
 class EnvioCreate(EnvioBase):
-    pass
+    ticket: Optional[str] = Field(default=None, min_length=1, description="Número de ticket; si se omite se genera en el servidor")
+    prefijo_ticket: Optional[str] = Field(default=None, exclude=True, description="Prefijo del ticket generado")
 
 
 class EnvioUpdate(BaseModel):
@@ -124,17 +534,20 @@ class EnvioUpdate(BaseModel):
     comentarios: Optional[str] = None
     telefono: Optional[str] = None
     contacto: Optional[str] = None
+    ubicacion: Optional[Ubicacion] = None
 
 
 class EstadoHistorial(BaseModel):
     estado: str
-    fecha: str
+    fecha: IsoDatetime
     usuario_id: str
     usuario_nombre: str
     receptor_nombre: Optional[str] = None
     receptor_cedula: Optional[str] = None
     imagen_url: Optional[str] = None
     comentario: Optional[str] = None
+    cambio_id: Optional[str] = None
+    fecha_cliente: Optional[IsoDatetime] = None
 
 
 class EnvioResponse(BaseModel):
@@ -148,12 +561,31 @@ class EnvioResponse(BaseModel):
     departamento: str
     comentarios: str
     telefono: str
+    telefono_e164: Optional[str] = None
     contacto: str
-    fecha_carga: str
+    fecha_carga: IsoDatetime
     estado: str
     historial_estados: List[EstadoHistorial]
     creado_por: str
     creado_por_nombre: str
+    ubicacion: Optional[Ubicacion] = None
+    courier_id: Optional[str] = None
+    courier_nombre: Optional[str] = None
+    updated_at: Optional[IsoDatetime] = None
+    # Missing on envíos not written since versioning: their first touch_envio $inc makes it 1
+    version: int = 0
+
+
+class EnvioCercano(EnvioResponse):
+    distancia_m: float
+
+
+class SyncResponse(BaseModel):
+    envios: List[EnvioResponse]
+    eliminados: List[str]
+    token: str
+    has_more: bool
+    reset: bool
 
 
 class CambioEstadoRequest(BaseModel):
@@ -164,17 +596,71 @@ class CambioEstadoRequest(BaseModel):
     comentario: Optional[str] = None
 
 
+class CambioEstadoOffline(CambioEstadoRequest):
+    cambio_id: str = Field(min_length=1, description="Generated on the device; makes retried batches safe")
+    envio_id: str
+    fecha_cliente: UtcDatetime = Field(description="When the change was made on the device")
+    estado_base: Optional[str] = Field(default=None, description="Envío state the device saw when making the change")
+
+
+class LoteCambiosRequest(BaseModel):
+    cambios: List[CambioEstadoOffline] = Field(min_length=1, max_length=OFFLINE_BATCH_MAX)
+
+
+class ResultadoCambio(BaseModel):
+    cambio_id: str
+    envio_id: str
+    resultado: str
+    estado_actual: Optional[str] = None
+    detalle: Optional[str] = None
+
+
+class LoteCambiosResponse(BaseModel):
+    resultados: List[ResultadoCambio]
+
+
 class MessageLog(BaseModel):
     id: str
     envio_id: str
     ticket: str
     telefono: str
+    telefono_e164: Optional[str] = None
     mensaje: str
     estado: str
-    fecha: str
+    fecha: IsoDatetime
     enviado: bool = False  # False = simulado, True = enviado real
 
 
+class PuntoUbicacion(BaseModel):
+    lat: float = Field(ge=-90, le=90)
+    lng: float = Field(ge=-180, le=180)
+    fecha: datetime = Field(description="Momento de la lectura en el dispositivo")
+    precision_m: Optional[float] = Field(default=None, ge=0)
+
+
+class LoteUbicaciones(BaseModel):
+    puntos: List[PuntoUbicacion] = Field(min_length=1, max_length=LOCATION_BATCH_MAX)
+
+
+class UbicacionCourier(BaseModel):
+    lat: float
+    lng: float
+    fecha: IsoDatetime
+
+
+class TrackingResponse(BaseModel):
+    ticket: str
+    estado: str
+    calle: str
+    numero: str
+    apto: str
+    departamento: str
+    contacto: str
+    fecha_carga: IsoDatetime
+    historial_estados: List[EstadoHistorial]
+    ubicacion_courier: Optional[UbicacionCourier] = None
+
+
 class EnvioFilters(BaseModel):
     departamento: Optional[str] = None
     motivo: Optional[str] = None
@@ -185,6 +671,220 @@ class EnvioFilters(BaseModel):
 
 # ============== HELPERS ==============
 
+def model_projection(model) -> dict:
+    """Mongo projection that returns exactly the fields of a response model"""
+    projection = {"_id": 0}
+    projection.update({field: 1 for field in model.model_fields})
+    return projection
+
+
+ENVIO_PROJECTION = model_projection(EnvioResponse)
+# Synced copies leave out delivery photos (base64 data URLs); devices fetch the envío when they need one
+SYNC_PROJECTION = {
+    **{campo: 1 for campo in ENVIO_PROJECTION if campo != "historial_estados"},
+    **{f"historial_estados.{campo}": 1 for campo in EstadoHistorial.model_fields if campo != "imagen_url"}
+}
+MESSAGE_PROJECTION = model_projection(MessageLog)
+TRACKING_PROJECTION = model_projection(TrackingResponse)
+
+
+def trusted_response(content, response: Optional[Response] = None):
+    """Return documents read from our own collections without building models twice.
+
+    Documents are validated when they are written, so with FAST_JSON_RESPONSES enabled they
+    are serialized directly by orjson and the response_model validation is skipped. Otherwise
+    the plain documents are handed to FastAPI, which validates them once. Headers set on the
+    injected `response` are kept in both cases.
+    """
+    if FAST_JSON_RESPONSES:
+        return ORJSONResponse(content, headers=dict(response.headers) if response else None)
+    return content
+
+
+def encode_cursor(*values) -> str:
+    """Opaque pagination cursor from the sort key of the last returned document"""
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode()
+
+
+def touch_envio(update: dict) -> dict:
+    """Stamp updated_at and bump version on an envío update document; every write must go through it for delta sync and ETags"""
+    update.setdefault("$set", {})["updated_at"] = datetime.now(timezone.utc)
+    update.setdefault("$inc", {})["version"] = 1
+    return update
+
+
+def etag_de(*partes) -> str:
+    """Weak ETag over the values that identify a representation"""
+    return f'W/"{hashlib.sha1(orjson.dumps(partes)).hexdigest()}"'
+
+
+def conditional_response(content, etag: str, if_none_match: Optional[str], response: Response):
+    """304 without serializing `content` when If-None-Match already holds `etag`, otherwise the content tagged with it"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match:
+        etags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in etags or etag.removeprefix("W/") in etags:
+            incr_metric("etag.not_modified")
+            return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return trusted_response(content, response)
+
+
+async def acquire_lease(name: str, seconds: float) -> bool:
+    """Take or renew the `name` lease for `seconds`, so a periodic job runs in one worker at a time.
+
+    False while another worker holds an unexpired lease: the upsert then collides with its document.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        await db.leases.update_one(
+            {"_id": name, "$or": [{"expires_at": {"$lte": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def add_tombstones(envio_ids: List[str]):
+    """Record removed envíos so synced devices drop them"""
+    if envio_ids:
+        now = datetime.now(timezone.utc)
+        await db.envio_tombstones.insert_many([{"id": envio_id, "eliminado_at": now} for envio_id in envio_ids])
+
+
+# Rollup counter incremented by each transition
+KPI_CONTADORES = {"Entregado": "entregados", "No entregado": "fallidos"}
+
+
+def fecha_kpi(value) -> Optional[datetime]:
+    """Stored date as a datetime; legacy ISO strings not yet converted by fechas_envios_bson are parsed"""
+    return value if isinstance(value, datetime) else _to_datetime(value)
+
+
+async def registrar_kpi(envio: dict, contador: str, momento: Union[datetime, str], cantidad: int = 1):
+    """Increment a daily rollup counter for the envío's departamento, motivo and creator"""
+    momento = fecha_kpi(momento)
+    if momento is None:
+        return
+    dia = momento.astimezone(REPORTS_TZ).date().isoformat()
+    clave = {"fecha": dia, "departamento": envio["departamento"], "motivo": envio["motivo"], "creado_por": envio["creado_por"]}
+    await db.kpi_daily.update_one(
+        {"_id": "|".join(clave.values())},
+        {"$inc": {contador: cantidad}, "$setOnInsert": clave},
+        upsert=cantidad > 0
+    )
+
+
+# Fields contar_kpis needs from a deleted or moved envío
+KPI_PROJECTION = {
+    "_id": 0, "departamento": 1, "motivo": 1, "creado_por": 1, "fecha_carga": 1,
+    "historial_estados.estado": 1, "historial_estados.fecha": 1, "historial_estados.fecha_cliente": 1
+}
+
+
+async def contar_kpis(envio: dict, cantidad: int):
+    """Add (1) or take out (-1) all of an envío's counts in the rollups.
+
+    Done right away when an envío is deleted or moves to another departamento or motivo, so days
+    outside the nightly recompute stay right.
+    """
+    await registrar_kpi(envio, "creados", envio["fecha_carga"], cantidad)
+    for historial in envio.get("historial_estados", []):
+        fecha = fecha_kpi(historial.get("fecha"))
+        if historial["estado"] in KPI_CONTADORES and fecha:
+            # Same moment aplicar_cambio_estado counted: device time, never later than the server time
+            momento = min(fecha_kpi(historial.get("fecha_cliente")) or fecha, fecha)
+            await registrar_kpi(envio, KPI_CONTADORES[historial["estado"]], momento, cantidad)
+
+
+def decode_cursor(cursor: str, *types) -> list:
+    """Values of a cursor from encode_cursor, checked against the expected type of each one"""
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if (
+        not isinstance(values, list) or len(values) != len(types)
+        or not all(isinstance(value, tipo) for value, tipo in zip(values, types))
+    ):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return values
+
+
+class CpuBoundPool:
+    """Bounded executor for CPU-heavy calls so they never run on the event loop.
+
+    At most `workers` calls run at once and `queue_max` more wait for a worker; beyond that
+    run() fails fast with 503 rather than queueing work the client would time out on. Call
+    counts, queue wait and run time per task are kept in METRICS.
+    """
+
+    def __init__(self, name: str, make_executor, workers: int, queue_max: int):
+        self.name = name
+        self.make_executor = make_executor
+        self.workers = workers
+        self.queue_max = queue_max
+        self.executor = None
+        self.in_flight = 0
+
+    def _release(self):
+        self.in_flight -= 1
+
+    async def run(self, task: str, fn, *args):
+        if self.in_flight >= self.workers + self.queue_max:
+            incr_metric(f"cpu_pool.{self.name}.rejected")
+            raise HTTPException(
+                status_code=503,
+                detail="Servidor ocupado, reintente en unos segundos",
+                headers={"Retry-After": "5"}
+            )
+        if self.executor is None:
+            # Created on first use, inside the serving worker process
+            self.executor = self.make_executor(self.workers)
+        
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        executor = self.executor
+        try:
+            future = executor.submit(timed_call, fn, args)
+            # Released when the work ends, not when the caller stops waiting (client gone)
+            self.in_flight += 1
+            future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+            result, run_seconds = await asyncio.wrap_future(future)
+        except BrokenExecutor:
+            # A worker process died: release the broken pool's resources, the next call starts a fresh one
+            if self.executor is executor:
+                self.executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            incr_metric(f"cpu_pool.{self.name}.broken")
+            raise HTTPException(status_code=503, detail="Servidor ocupado, reintente en unos segundos")
+        
+        prefix = f"cpu_pool.{self.name}.{task}"
+        incr_metric(f"{prefix}.count")
+        incr_metric(f"{prefix}.run_ms", run_seconds * 1000)
+        incr_metric(f"{prefix}.wait_ms", (time.perf_counter() - start - run_seconds) * 1000)
+        return result
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Spawned rather than forked: the serving process has Mongo client threads that must not be copied
+process_pool = CpuBoundPool(
+    "process",
+    lambda workers: ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")),
+    CPU_POOL_PROCESSES, CPU_POOL_QUEUE_MAX
+)
+thread_pool = CpuBoundPool(
+    "thread",
+    lambda workers: ThreadPoolExecutor(workers, thread_name_prefix="cpu"),
+    CPU_POOL_THREADS, CPU_POOL_QUEUE_MAX
+)
+
+
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
 
@@ -193,22 +893,100 @@ def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode(), hashed.encode())
 
 
-def create_token(user_id: str, username: str, rol: str) -> str:
+def create_token(user: dict, session_id: Optional[str] = None) -> str:
+    # nombre and created_at let the stateless mode answer handlers and /auth/me without a lookup
     payload = {
-        "sub": user_id,
-        "username": username,
-        "rol": rol,
-        "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
+        "sub": user["id"],
+        "username": user["username"],
+        "rol": user["rol"],
+        "nombre": user["nombre"],
+        "created_at": user["created_at"],
+        "sid": session_id,
+        "exp": datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_MINUTES)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 
+def _hash_refresh_secret(secret: str) -> str:
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+async def create_session(user: dict) -> tuple:
+    """Open a refresh session; returns (session_id, refresh_token). Only a hash of the secret is stored"""
+    session_id = str(uuid.uuid4())
+    secret = secrets.token_urlsafe(32)
+    now = datetime.now(timezone.utc)
+    await db.sessions.insert_one({
+        "id": session_id,
+        "user_id": user["id"],
+        "token_hash": _hash_refresh_secret(secret),
+        "created_at": now,
+        "expires_at": now + timedelta(days=REFRESH_TOKEN_DAYS)
+    })
+    return session_id, f"{session_id}.{secret}"
+
+
+async def rotate_session(refresh_token: str) -> Optional[tuple]:
+    """Swap a refresh token for a new one. Returns (session, new refresh_token), None if invalid.
+
+    The swap is a single conditional update, so a refresh token can only be used once.
+    """
+    session_id, _, secret = refresh_token.partition(".")
+    new_secret = secrets.token_urlsafe(32)
+    now = datetime.now(timezone.utc)
+    session = await db.sessions.find_one_and_update(
+        {"id": session_id, "token_hash": _hash_refresh_secret(secret), "expires_at": {"$gt": now}},
+        {"$set": {
+            "token_hash": _hash_refresh_secret(new_secret),
+            "refreshed_at": now,
+            "expires_at": now + timedelta(days=REFRESH_TOKEN_DAYS)
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+    if session is None:
+        return None
+    return session, f"{session_id}.{new_secret}"
+
+
+# Ids of deactivated users, checked by the stateless auth mode
+REVOKED_USER_IDS = set()
+
+
+async def refresh_revoked_users():
+    revoked = await db.users.distinct("id", {"activo": False})
+    REVOKED_USER_IDS.clear()
+    REVOKED_USER_IDS.update(revoked)
+
+
+async def revocation_refresh_loop():
+    """Pick up users deleted through other workers"""
+    while True:
+        await asyncio.sleep(REVOCATION_REFRESH_SECONDS)
+        try:
+            await refresh_revoked_users()
+        except PyMongoError as e:
+            logger.warning(f"Could not refresh revoked users: {e}")
+
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id = payload.get("sub")
         
+        # Tokens issued before the stateless mode lack the claims and still go to Mongo
+        if AUTH_STATELESS and "nombre" in payload:
+            if user_id in REVOKED_USER_IDS:
+                raise HTTPException(status_code=401, detail="Usuario no encontrado")
+            return {
+                "id": user_id,
+                "username": payload["username"],
+                "nombre": payload["nombre"],
+                "rol": payload["rol"],
+                "activo": True,
+                "created_at": payload["created_at"]
+            }
+        
         user = await db.users.find_one({"id": user_id, "activo": True}, {"_id": 0})
         if not user:
             raise HTTPException(status_code=401, detail="Usuario no encontrado")
@@ -231,91 +1009,1062 @@ def require_role(*roles):
     return role_checker
 
 
+def incr_metric(name: str, value: float = 1):
+    METRICS[name] += value
+
+
+class MemoryRateLimitBackend:
+    """Token buckets kept in process memory, one set per worker"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, updated_at), least recently used first
+
+    async def take(self, key: str, capacity: float, refill: float) -> float:
+        """Consume one token. Returns 0 when allowed, otherwise seconds until a token is available"""
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * refill)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        
+        # Keys are client-controlled: evict the least recently used one at a time, never rescan
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        
+        return 0.0 if allowed else (1 - tokens) / refill
+
+
+class MongoRateLimitBackend:
+    """Token buckets stored in Mongo so every worker shares the same limits"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def take(self, key: str, capacity: float, refill: float) -> float:
+        now = time.time()
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$ts", now]}]}]}
+        refilled = {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, refill]}]}
+        bucket = await self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, refilled]},
+                    "ts": now,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=capacity / refill)
+                }},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return 0.0 if bucket["allowed"] else (1 - bucket["tokens"]) / refill
+
+
+rate_limiter = MongoRateLimitBackend(db.rate_limits) if RATE_LIMIT_BACKEND == "mongo" else MemoryRateLimitBackend()
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+        if forwarded:
+            # Each trusted proxy appends the address it received the request from
+            return forwarded[max(len(forwarded) - RATE_LIMIT_PROXY_HOPS, 0)]
+    return request.client.host if request.client else "unknown"
+
+
+async def enforce_rate_limit(rule: str, key: str):
+    """Take a token from the bucket of (rule, key), raising 429 with Retry-After when empty"""
+    if not RATE_LIMIT_ENABLED:
+        return
+    
+    capacity, refill = RATE_LIMITS[rule]
+    try:
+        retry_after = await rate_limiter.take(f"{rule}:{key}", capacity, refill)
+    except PyMongoError as e:
+        # Fail open: a limiter outage must not take login and tracking down with it
+        incr_metric("rate_limit.backend_errors")
+        logger.warning(f"Rate limiter unavailable: {e}")
+        return
+    
+    if retry_after:
+        incr_metric(f"rate_limit.{rule}.limited")
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas solicitudes. Intente nuevamente más tarde.",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    incr_metric(f"rate_limit.{rule}.allowed")
+
+
+def rate_limit_by_ip(rule: str):
+    async def limiter(request: Request):
+        await enforce_rate_limit(rule, client_ip(request))
+    return limiter
+
+
+async def run_idempotent(idempotency_key: Optional[str], user: dict, scope: str, payload, operation):
+    """Run `operation` once per Idempotency-Key; retries with the same key get the stored response.
+
+    The key is scoped to the user and the endpoint. Reusing it with a different payload is a 422,
+    and retrying while the original request is still running is a 409. `operation(committed)` calls
+    committed() as soon as its write is in, with the response when it is already known: from then on
+    a failure keeps the key, storing that response or a failed state, so a retry never writes twice.
+    """
+    escrito = {}
+    
+    def committed(response=None):
+        escrito["response"] = response
+    
+    if not idempotency_key:
+        return await operation(committed)
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key demasiado larga")
+    
+    record_id = f"{user['id']}:{scope}:{idempotency_key}"
+    fingerprint = hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    now = datetime.now(timezone.utc)
+    
+    try:
+        await db.idempotency_keys.insert_one(
+            {"_id": record_id, "fingerprint": fingerprint, "estado": "en_proceso", "created_at": now}
+        )
+    except DuplicateKeyError:
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if record is None or record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="La Idempotency-Key ya fue usada con otra solicitud")
+        
+        if record["estado"] in ("completado", "fallido"):
+            incr_metric("idempotency.replayed")
+            return JSONResponse(
+                record["body"],
+                status_code=record["status_code"],
+                headers={"Idempotent-Replayed": "true"}
+            )
+        
+        # Take over a request whose worker died mid-way, otherwise ask the client to wait
+        stale = now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        taken = await db.idempotency_keys.update_one(
+            {"_id": record_id, "estado": "en_proceso", "created_at": {"$lt": stale}},
+            {"$set": {"created_at": now}}
+        )
+        if taken.modified_count == 0:
+            raise HTTPException(status_code=409, detail="La solicitud original todavía se está procesando")
+    
+    try:
+        result = await operation(committed)
+    except BaseException:
+        if "response" not in escrito:
+            # Nothing was committed for this key: let the client retry
+            await db.idempotency_keys.delete_one({"_id": record_id})
+        elif escrito["response"] is not None:
+            await guardar_respuesta_idempotente(record_id, "completado", 200, escrito["response"])
+        else:
+            incr_metric("idempotency.failed_after_commit")
+            await guardar_respuesta_idempotente(record_id, "fallido", 500, {
+                "detail": "La solicitud se aplicó pero no terminó de procesarse. Consulte el envío antes de reintentar"
+            })
+        raise
+    
+    await guardar_respuesta_idempotente(record_id, "completado", 200, result)
+    return result
+
+
+async def guardar_respuesta_idempotente(record_id: str, estado: str, status_code: int, body):
+    await db.idempotency_keys.update_one(
+        {"_id": record_id},
+        {"$set": {"estado": estado, "status_code": status_code, "body": jsonable_encoder(body)}}
+    )
+
+
+class TicketAllocator:
+    """Per-prefix ticket sequences served from blocks reserved in the counters collection.
+
+    A worker reserves a block of numbers with a single $inc and hands them out from memory, so
+    concurrent creations and bulk imports only touch the counter once per block. Tickets are
+    unique across workers but not gapless: unused numbers of a block are lost on restart.
+    """
+
+    def __init__(self, collection, block_size: int):
+        self.collection = collection
+        self.block_size = block_size
+        self.blocks = {}  # prefix -> (next number, end of block)
+        self.locks = {}
+
+    async def _reserve(self, prefix: str, size: int) -> tuple:
+        counter = await self.collection.find_one_and_update(
+            {"_id": f"ticket:{prefix}"},
+            {"$inc": {"seq": size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        end = counter["seq"] + 1
+        return end - size, end
+
+    async def next_numbers(self, prefix: str, count: int = 1) -> List[int]:
+        async with self.locks.setdefault(prefix, asyncio.Lock()):
+            numbers = []
+            while len(numbers) < count:
+                start, end = self.blocks.get(prefix, (0, 0))
+                if start >= end:
+                    start, end = await self._reserve(prefix, max(self.block_size, count - len(numbers)))
+                taken = min(end - start, count - len(numbers))
+                numbers.extend(range(start, start + taken))
+                self.blocks[prefix] = (start + taken, end)
+            return numbers
+
+    async def allocate(self, prefix: str, count: int = 1) -> List[str]:
+        prefix = prefix.upper()
+        if not TICKET_PREFIX_PATTERN.match(prefix):
+            raise HTTPException(status_code=400, detail="Prefijo de ticket inválido (hasta 10 letras o números)")
+        return [f"{prefix}-{n:0{TICKET_DIGITS}d}" for n in await self.next_numbers(prefix, count)]
+
+
+ticket_allocator = TicketAllocator(db.counters, TICKET_BLOCK_SIZE)
+
+
+# ---- Address normalization ----
+
+# Abbreviations expanded in both the display form and the lookup key (keys are accent-free)
+ABREVIATURAS = {
+    "av": "avenida", "avda": "avenida", "bv": "bulevar", "bvar": "bulevar", "boulevard": "bulevar",
+    "gral": "general", "dr": "doctor", "pte": "presidente", "ing": "ingeniero", "cnel": "coronel",
+    "tte": "teniente", "sta": "santa", "sto": "santo", "cno": "camino"
+}
+# Street type words left out of lookup keys, so "Av. Rivera" and "Rivera" are the same street
+CALLE_TIPOS = {"avenida", "bulevar", "calle"}
+# Kept in lowercase inside names ("18 de Julio", "Treinta y Tres")
+CONECTORES = {"de", "del", "la", "las", "los", "y", "e"}
+ROMANO = re.compile(r"m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})")
+
+
+def sin_acentos(texto: str) -> str:
+    return unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+
+
+def clave_calle(texto: str) -> str:
+    """Lookup key for a street or departamento name: lowercase, no accents, punctuation or type words"""
+    palabras = [ABREVIATURAS.get(p, p) for p in re.findall(r"[a-z0-9]+", sin_acentos(texto).lower())]
+    while len(palabras) > 1 and palabras[0] in CALLE_TIPOS:
+        palabras.pop(0)
+    return " ".join(palabras)
+
+
+def es_romano(palabra: str, mayuscula: bool, primera: bool) -> bool:
+    """Roman numeral ("Felipe II", "Pío IX"): typed in uppercase, or made of I, V and X after the first word"""
+    if not palabra or not ROMANO.fullmatch(palabra):
+        return False
+    return mayuscula or (not primera and set(palabra) <= set("ivx"))
+
+
+def normalizar_calle(texto: str) -> str:
+    """Display form of a street name: abbreviations expanded, words capitalized, Roman numerals in uppercase, single spaces"""
+    # Uppercase only marks a numeral when the rest of the name is not typed in uppercase too
+    todo_mayusculas = texto.isupper()
+    palabras = []
+    for escrita in texto.replace(".", ". ").split():
+        escrita = escrita.strip(".,")
+        palabra = escrita.lower()
+        if not palabra:
+            continue
+        if es_romano(palabra, escrita.isupper() and not todo_mayusculas, not palabras):
+            palabras.append(palabra.upper())
+            continue
+        palabra = ABREVIATURAS.get(sin_acentos(palabra), palabra)
+        palabras.append(palabra if palabras and palabra in CONECTORES else palabra[:1].upper() + palabra[1:])
+    return " ".join(palabras)
+
+
+DEPARTAMENTOS_POR_CLAVE = {clave_calle(d): d for d in DEPARTAMENTOS_URUGUAY}
+
+
+def normalizar_direccion(datos: dict) -> dict:
+    """Normalize the address fields present in an envío create/update payload"""
+    datos = dict(datos)
+    if datos.get("departamento"):
+        datos["departamento"] = DEPARTAMENTOS_POR_CLAVE.get(clave_calle(datos["departamento"]), datos["departamento"].strip())
+    for campo in ("calle", "esquina"):
+        if datos.get(campo):
+            datos[campo] = normalizar_calle(datos[campo])
+    for campo in ("numero", "apto"):
+        if datos.get(campo):
+            datos[campo] = " ".join(datos[campo].split()).upper()
+    return datos
+
+
+# ---- Phone numbers ----
+
+CODIGO_PAIS = "598"
+
+
+def normalizar_telefono(telefono: str) -> Optional[str]:
+    """E.164 form of a phone number as typed ("099 123 456" -> "+59899123456"), None when it is not recognizable.
+
+    Numbers without a country code follow the Uruguayan plan: 09X mobiles (the trunk 0 is dropped)
+    and 8-digit numbers starting with 2 or 4 for landlines.
+    """
+    if not telefono:
+        return None
+    digitos = re.sub(r"\D", "", telefono)
+    internacional = telefono.strip().startswith("+") or digitos.startswith("00")
+    digitos = digitos[2:] if digitos.startswith("00") else digitos
+    if internacional:
+        return f"+{digitos}" if 8 <= len(digitos) <= 15 else None
+    if len(digitos) == 11 and digitos.startswith(CODIGO_PAIS):
+        return f"+{digitos}"
+    if len(digitos) == 9 and digitos.startswith("09"):
+        return f"+{CODIGO_PAIS}{digitos[1:]}"
+    if len(digitos) == 8 and digitos[0] in "249":
+        return f"+{CODIGO_PAIS}{digitos}"
+    return None
+
+
+async def canonizar_calle(departamento: str, calle: str) -> str:
+    """Spelling already used for this street in the departamento (address book, then gazetteer)"""
+    if not calle:
+        return calle
+    conocida = await db.calles.find_one({"_id": f"{departamento}|{clave_calle(calle)}"}, {"calle": 1})
+    if conocida:
+        return conocida["calle"]
+    return gazetteer.nombre_calle(departamento, calle) or calle
+
+
+async def registrar_direccion(envio: dict):
+    """Count a use of the envío's street and address in the calles / direcciones address book"""
+    now = datetime.now(timezone.utc)
+    departamento, clave = envio["departamento"], clave_calle(envio["calle"])
+    await db.calles.update_one(
+        {"_id": f"{departamento}|{clave}"},
+        {
+            "$inc": {"usos": 1},
+            "$set": {"ultimo_uso": now},
+            "$setOnInsert": {"departamento": departamento, "clave": clave, "calle": envio["calle"]}
+        },
+        upsert=True
+    )
+    await db.direcciones.update_one(
+        {"_id": f"{departamento}|{clave}|{envio['numero']}|{envio.get('apto') or ''}"},
+        {
+            "$inc": {"usos": 1},
+            "$set": {"esquina": envio.get("esquina") or "", "ultimo_uso": now},
+            "$setOnInsert": {
+                "departamento": departamento, "clave_calle": clave, "calle": envio["calle"],
+                "numero": envio["numero"], "apto": envio.get("apto") or ""
+            }
+        },
+        upsert=True
+    )
+
+
+class Gazetteer:
+    """Offline geocoder over numbered street segments (desde/hasta door numbers with the coordinates of both ends).
+
+    The position of a door number is interpolated along its segment. Loaded on first use.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tramos = None  # (departamento, calle) keys -> [(desde, hasta, lat_desde, lng_desde, lat_hasta, lng_hasta)]
+        self.nombres = {}  # (departamento, calle) keys -> street name as written in the gazetteer
+
+    def _load(self):
+        tramos = {}
+        try:
+            with open(self.path, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    key = (clave_calle(row["departamento"]), clave_calle(row["calle"]))
+                    self.nombres[key] = row["calle"]
+                    tramos.setdefault(key, []).append((
+                        int(row["desde"]), int(row["hasta"]),
+                        float(row["lat_desde"]), float(row["lng_desde"]),
+                        float(row["lat_hasta"]), float(row["lng_hasta"])
+                    ))
+        except FileNotFoundError:
+            logger.warning(f"Gazetteer not found at {self.path}; envíos will not be geocoded")
+        self.tramos = tramos
+
+    def nombre_calle(self, departamento: str, calle: str) -> Optional[str]:
+        if self.tramos is None:
+            self._load()
+        return self.nombres.get((clave_calle(departamento), clave_calle(calle)))
+
+    def geocode(self, departamento: str, calle: str, numero: str) -> Optional[dict]:
+        """GeoJSON point for an address, None when the street or door number is not covered"""
+        if self.tramos is None:
+            self._load()
+        match = re.match(r"\s*(\d+)", numero or "")
+        if not match:
+            return None
+        numero = int(match.group(1))
+        for desde, hasta, lat_desde, lng_desde, lat_hasta, lng_hasta in self.tramos.get(
+            (clave_calle(departamento), clave_calle(calle)), []
+        ):
+            if desde <= numero <= hasta:
+                f = (numero - desde) / (hasta - desde) if hasta > desde else 0
+                return {
+                    "type": "Point",
+                    "coordinates": [
+                        round(lng_desde + f * (lng_hasta - lng_desde), 6),
+                        round(lat_desde + f * (lat_hasta - lat_desde), 6)
+                    ]
+                }
+        return None
+
+
+gazetteer = Gazetteer(GAZETTEER_PATH)
+
+
 async def log_whatsapp_message(envio_id: str, ticket: str, telefono: str, mensaje: str, estado: str):
     """Log WhatsApp message (simulated for now, ready for WhatsApp Business API)"""
+    with tracer.span("log_whatsapp_message", estado=estado):
+        return await _log_whatsapp_message(envio_id, ticket, telefono, mensaje, estado)
+
+
+async def _log_whatsapp_message(envio_id: str, ticket: str, telefono: str, mensaje: str, estado: str):
     message_log = {
         "id": str(uuid.uuid4()),
         "envio_id": envio_id,
         "ticket": ticket,
         "telefono": telefono,
+        "telefono_e164": normalizar_telefono(telefono),
         "mensaje": mensaje,
         "estado": estado,
-        "fecha": datetime.now(timezone.utc).isoformat(),
+        "fecha": datetime.now(timezone.utc),
         "enviado": False  # Simulated
     }
     await db.message_logs.insert_one(message_log)
     return message_log
 
 
-def create_excel_workbook(envios: List[dict]) -> BytesIO:
-    """Create an Excel workbook with envio data"""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Envíos"
+def parse_fecha(value: str) -> datetime:
+    """Parse a date filter (YYYY-MM-DD or full ISO 8601) as an aware UTC datetime"""
+    try:
+        fecha = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Fecha inválida: {value}")
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return fecha
+
+
+def fecha_range(fecha_desde: Optional[str], fecha_hasta: Optional[str]) -> dict:
+    """Mongo range condition for a date filter; a bare date in fecha_hasta includes the whole day"""
+    rango = {}
+    if fecha_desde:
+        rango["$gte"] = parse_fecha(fecha_desde)
+    if fecha_hasta:
+        hasta = parse_fecha(fecha_hasta)
+        if len(fecha_hasta) == 10:
+            rango["$lt"] = hasta + timedelta(days=1)
+        else:
+            rango["$lte"] = hasta
+    return rango
+
+
+async def stream_csv(first_batch: List[dict], cursor):
+    """Stream envíos as CSV: the already fetched first batch, then the rest of the cursor"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")  # BOM so Excel detects UTF-8
+    writer.writerow(EXPORT_HEADERS)
     
-    header_font = Font(bold=True, color="FFFFFF", size=11)
-    header_fill = PatternFill(start_color="C91A25", end_color="C91A25", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
+    for envio in first_batch:
+        writer.writerow(export_row(envio))
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
     
-    thin_border = Border(
-        left=Side(style='thin', color='E2E8F0'),
-        right=Side(style='thin', color='E2E8F0'),
-        top=Side(style='thin', color='E2E8F0'),
-        bottom=Side(style='thin', color='E2E8F0')
-    )
+    rows = 0
+    try:
+        async for envio in cursor:
+            writer.writerow(export_row(envio))
+            rows += 1
+            if rows % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    except ExecutionTimeout:
+        # Headers are already sent; abort the transfer so the client sees an incomplete download
+        incr_metric("query_budget.export_csv.exceeded")
+        logger.warning("CSV export aborted: query budget exceeded mid-stream")
+        raise
+    yield buffer.getvalue()
+
+
+def build_envios_query(
+    departamento: Optional[str] = None,
+    motivo: Optional[str] = None,
+    estado: Optional[str] = None,
+    fecha_desde: Optional[str] = None,
+    fecha_hasta: Optional[str] = None
+) -> dict:
+    query = {}
+    if departamento:
+        query["departamento"] = departamento
+    if motivo:
+        query["motivo"] = motivo
+    if estado:
+        query["estado"] = estado
+    if fecha_desde or fecha_hasta:
+        query["fecha_carga"] = fecha_range(fecha_desde, fecha_hasta)
+    return query
+
+
+async def find_envio(database, query: dict, projection: dict, **kwargs) -> Optional[dict]:
+    """find_one on envios, falling back to envios_archive for archived deliveries"""
+    envio = await database.envios.find_one(query, projection, **kwargs)
+    if envio is None:
+        envio = await database.envios_archive.find_one(query, projection, **kwargs)
+    return envio
+
+
+def export_cursor(endpoint: str, query: dict, include_archived: bool, limit: Optional[int] = None):
+    """Cursor over envíos to export, newest first, optionally including the archive"""
+    collection = read_db("export").envios
+    if not include_archived:
+        cursor = budgeted_find(collection, endpoint, query, EXPORT_PROJECTION).sort("fecha_carga", -1)
+        return cursor.limit(limit) if limit else cursor
     
-    headers = [
-        "Ticket", "Estado", "Fecha/Hora", "Contacto", "Teléfono", "Calle", 
-        "Número", "Apto", "Esquina", "Departamento", "Motivo", "Comentarios"
+    pipeline = [
+        {"$match": query},
+        {"$unionWith": {"coll": "envios_archive", "pipeline": [{"$match": query}]}},
+        {"$sort": {"fecha_carga": -1}},
     ]
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": EXPORT_PROJECTION})
+    return budgeted_aggregate(collection, endpoint, pipeline)
+
+
+@contextmanager
+def query_budget(endpoint: str):
+    """Turn a maxTimeMS overrun into a clear error asking the user to narrow the filters"""
+    try:
+        yield
+    except ExecutionTimeout:
+        incr_metric(f"query_budget.{endpoint}.exceeded")
+        raise HTTPException(
+            status_code=QUERY_BUDGETS[endpoint][1],
+            detail="La consulta excede el tiempo permitido. Acote los filtros (por ejemplo el rango de fechas) e intente nuevamente."
+        )
+
+
+# ============== MIDDLEWARE ==============
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick br or gzip from an Accept-Encoding header, honouring q=0"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
     
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-        cell.border = thin_border
-    
-    for row, envio in enumerate(envios, 2):
-        data = [
-            envio.get('ticket', ''),
-            envio.get('estado', 'Ingresada'),
-            envio.get('fecha_carga', ''),
-            envio.get('contacto', ''),
-            envio.get('telefono', ''),
-            envio.get('calle', ''),
-            envio.get('numero', ''),
-            envio.get('apto', ''),
-            envio.get('esquina', ''),
-            envio.get('departamento', ''),
-            envio.get('motivo', ''),
-            envio.get('comentarios', '')
-        ]
-        for col, value in enumerate(data, 1):
-            cell = ws.cell(row=row, column=col, value=value)
-            cell.border = thin_border
-            cell.alignment = Alignment(vertical="center")
-    
-    column_widths = [15, 18, 22, 20, 15, 25, 10, 10, 20, 15, 18, 30]
-    for i, width in enumerate(column_widths, 1):
-        ws.column_dimensions[chr(64 + i)].width = width
-    
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    return output
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+class CompressionMiddleware:
+    """Negotiated gzip/brotli compression for buffered and streaming responses"""
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        responder = _CompressionResponder(send, encoding, self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressionResponder:
+    def __init__(self, send, encoding: str, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.passthrough = False
+        self.compressor = None
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.compressor is None:
+            if self.encoding == "br":
+                self.compressor = brotli.Compressor(quality=4)
+            else:
+                self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        
+        if self.encoding == "br":
+            out = self.compressor.process(data)
+            return out + (self.compressor.finish() if final else self.compressor.flush())
+        out = self.compressor.compress(data)
+        return out + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            self.passthrough = (
+                "content-encoding" in headers
+                or content_type.startswith(COMPRESSION_SKIP_TYPES)
+            )
+            if self.passthrough:
+                await self._send(message)
+            else:
+                self.start_message = message
+            return
+        
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+        
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            
+            if not more_body and len(body) < self.minimum_size:
+                # Small single-chunk response, not worth compressing
+                self.passthrough = True
+                await self._send(start)
+                await self._send(message)
+                return
+            
+            headers["Content-Encoding"] = self.encoding
+            if more_body:
+                # Streaming response: length is unknown, compress chunk by chunk
+                del headers["Content-Length"]
+            else:
+                body = self.compress(body, final=True)
+                headers["Content-Length"] = str(len(body))
+                incr_metric(f"compression.{self.encoding}")
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": body, "more_body": False})
+                return
+            incr_metric(f"compression.{self.encoding}")
+            await self._send(start)
+        
+        await self._send({
+            "type": "http.response.body",
+            "body": self.compress(body, final=not more_body),
+            "more_body": more_body
+        })
+
+
+class LoopMonitor:
+    """Measures how late the event loop runs a periodic sleep and catches callbacks that block it.
+
+    The sampling task records the lag in METRICS and beats a heartbeat. A watchdog thread checks
+    the heartbeat; when it is older than the threshold the loop is stuck in synchronous code, so
+    the watchdog logs the loop thread's current stack (the blocking call and the coroutine that
+    made it) with the request that task is serving.
+    """
+
+    def __init__(self, interval_ms: int, threshold_ms: int):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = 0.0
+        self.requests = {}  # asyncio task -> ASGI scope of the request it serves
+        self.stopped = threading.Event()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.last_beat = time.monotonic()
+                lag_ms = max(0.0, (self.last_beat - start - self.interval) * 1000)
+                incr_metric("event_loop.samples")
+                incr_metric("event_loop.lag_ms_total", lag_ms)
+                METRICS["event_loop.lag_ms_max"] = max(METRICS["event_loop.lag_ms_max"], lag_ms)
+                if lag_ms >= self.threshold * 1000:
+                    incr_metric("event_loop.blocked")
+        finally:
+            self.stopped.set()
+
+    def _watchdog(self):
+        reported = None
+        while not self.stopped.wait(self.threshold / 4):
+            beat = self.last_beat
+            blocked = time.monotonic() - beat - self.interval
+            # One report per blocking episode
+            if blocked >= self.threshold and beat != reported:
+                reported = beat
+                self._report(blocked)
+
+    def _report(self, blocked: float):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else "  (stack unavailable)\n"
+        scope = self.requests.get(asyncio.current_task(self.loop))
+        if scope:
+            endpoint = scope.get("endpoint")
+            serving = f"{scope['method']} {scope['path']}" + (f" ({endpoint.__name__})" if endpoint else "")
+        else:
+            serving = "no request (background task or callback)"
+        logger.warning(f"Event loop blocked for more than {blocked * 1000:.0f} ms serving {serving}:\n{stack}")
+
+
+class LoopMonitorMiddleware:
+    """Records which request each task serves, so blocking reports can name the route"""
+
+    def __init__(self, app, monitor: LoopMonitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        task = asyncio.current_task()
+        self.monitor.requests[task] = scope
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.monitor.requests.pop(task, None)
+
+
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL_MS, LOOP_BLOCK_THRESHOLD_MS)
+
+
+def colapsar_stack(frame) -> str:
+    """Stack in collapsed (flame graph) format, root first: file:function;file:function;..."""
+    partes = []
+    while frame is not None and len(partes) < 128:
+        partes.append(f"{Path(frame.f_code.co_filename).name}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(partes))
+
+
+class RequestProfiler:
+    """Sampling profiler for requests served on the event loop.
+
+    A sampler thread reads the loop thread's stack every PROFILE_INTERVAL_MS while any request
+    is being profiled. A sample is credited to a request only when its task is the one running;
+    otherwise the request is waiting (I/O or other tasks) and gets a [waiting] sample.
+    """
+
+    def __init__(self, interval_ms: int, sample_every: int):
+        self.interval = interval_ms / 1000
+        self.sample_every = sample_every
+        self.loop = None
+        self.loop_thread_id = None
+        self.activos = {}  # asyncio task -> Counter of collapsed stacks
+        self.lock = threading.Lock()
+        self.hay_activos = threading.Event()
+        self.vistos = Counter()  # route -> requests seen, for the 1-in-N mode
+        self.rutas = {}  # route -> {"perfilados": n, "stacks": Counter}
+
+    def start(self, task) -> Counter:
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.loop_thread_id = threading.get_ident()
+            threading.Thread(target=self._sampler, name="request-profiler", daemon=True).start()
+        muestras = Counter()
+        with self.lock:
+            self.activos[task] = muestras
+            self.hay_activos.set()
+        return muestras
+
+    def stop(self, task):
+        with self.lock:
+            self.activos.pop(task, None)
+
+    def _sampler(self):
+        while True:
+            self.hay_activos.wait()
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.activos:
+                    self.hay_activos.clear()
+                    continue
+                activos = list(self.activos.items())
+            frame = sys._current_frames().get(self.loop_thread_id)
+            corriendo = asyncio.current_task(self.loop)
+            for task, muestras in activos:
+                muestras[colapsar_stack(frame) if task is corriendo and frame else "[waiting]"] += 1
+
+    def sampled(self, ruta: str) -> bool:
+        """Whether this request is the 1-in-N of its route"""
+        if self.sample_every <= 0:
+            return False
+        self.vistos[ruta] += 1
+        return self.vistos[ruta] % self.sample_every == 0
+
+    def aggregate(self, ruta: str, muestras: Counter):
+        agregado = self.rutas.setdefault(ruta, {"perfilados": 0, "stacks": Counter()})
+        agregado["perfilados"] += 1
+        agregado["stacks"].update(muestras)
+
+
+def ruta_de(scope) -> str:
+    """Route template of a request ("GET /api/envios/{envio_id}"), so 1-in-N counts per endpoint"""
+    for route in app.router.routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return f"{scope['method']} {route.path}"
+    return f"{scope['method']} (sin ruta)"
+
+
+class ProfilingMiddleware:
+    """Profiles requests that carry PROFILE_HEADER from an admin, and the 1-in-N sampled ones.
+
+    Requested profiles are stored in the profiles collection and their id returned in X-Profile-Id.
+    """
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def _es_admin(self, scope) -> bool:
+        try:
+            credentials = await security(Request(scope))
+            await require_role("admin")(await get_current_user(credentials))
+        except HTTPException:
+            incr_metric("profiling.denied")
+            return False
+        return True
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        pedido = PROFILE_HEADER.lower().encode() in dict(scope["headers"]) and await self._es_admin(scope)
+        ruta = ruta_de(scope) if pedido or self.profiler.sample_every > 0 else None
+        muestreado = ruta is not None and self.profiler.sampled(ruta)
+        if not pedido and not muestreado:
+            await self.app(scope, receive, send)
+            return
+        
+        profile_id = str(uuid.uuid4())
+        
+        async def send_with_id(message):
+            if pedido and message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["X-Profile-Id"] = profile_id
+            await send(message)
+        
+        task = asyncio.current_task()
+        muestras = self.profiler.start(task)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            self.profiler.stop(task)
+            duracion_ms = round((time.perf_counter() - start) * 1000, 1)
+            if muestreado:
+                self.profiler.aggregate(ruta, muestras)
+            if pedido:
+                await self._store(profile_id, scope, ruta, duracion_ms, muestras)
+
+    async def _store(self, profile_id: str, scope, ruta: str, duracion_ms: float, muestras: Counter):
+        try:
+            await db.profiles.insert_one({
+                "id": profile_id,
+                "ruta": ruta,
+                "path": scope["path"],
+                "duracion_ms": duracion_ms,
+                "muestras": sum(muestras.values()),
+                # Pairs, since stacks contain dots and cannot be document keys
+                "stacks": [[stack, n] for stack, n in muestras.most_common()],
+                "created_at": datetime.now(timezone.utc)
+            })
+        except PyMongoError as e:
+            logger.error(f"Could not store profile {profile_id}: {e}")
+
+
+request_profiler = RequestProfiler(PROFILE_INTERVAL_MS, PROFILE_SAMPLE_EVERY)
+
+
+def parse_traceparent(value: Optional[str]) -> Tuple[Optional[str], Optional[str], Optional[bool]]:
+    """Trace id, parent span id and sampled flag of a W3C traceparent header; Nones when absent or malformed"""
+    match = re.fullmatch(r"[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})", (value or "").strip())
+    if not match or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None, None, None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+class TracingMiddleware:
+    """Server span per request, continuing the caller's trace from traceparent and returning ours in the response"""
+
+    def __init__(self, app, tracer: Tracer, sample_ratio: float):
+        self.app = app
+        self.tracer = tracer
+        self.sample_ratio = sample_ratio
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        trace_id, parent_id, sampled = parse_traceparent(Headers(scope=scope).get("traceparent"))
+        if sampled is None:
+            sampled = random.random() < self.sample_ratio
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+        
+        span = self.tracer.start(
+            f"{scope['method']} {scope['path']}", "server",
+            {"http.method": scope["method"], "http.target": scope["path"]},
+            trace_id=trace_id, parent_id=parent_id
+        )
+        
+        async def send_traced(message):
+            if message["type"] == "http.response.start":
+                span.attributes["http.status_code"] = message["status"]
+                MutableHeaders(scope=message)["traceparent"] = span.traceparent()
+            await send(message)
+        
+        token = CURRENT_SPAN.set(span)
+        error = None
+        try:
+            await self.app(scope, receive, send_traced)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+            # Named after the route template once routing has set it, so spans group per endpoint
+            route = scope.get("route")
+            if route is not None:
+                span.name = f"{scope['method']} {route.path}"
+                span.attributes["http.route"] = route.path
+            if error is None and span.attributes.get("http.status_code", 500) >= 500:
+                error = f"HTTP {span.attributes.get('http.status_code', 500)}"
+            self.tracer.end(span, error)
+
+
+OTLP_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class SpanExporter:
+    """Ships finished spans in batches from a background task; the file or network I/O runs in a thread"""
+
+    def __init__(self, tracer: Tracer, kind: str):
+        self.tracer = tracer
+        self.kind = kind
+
+    def _write_file(self, spans: List[Span]):
+        with open(TRACE_FILE, "ab") as f:
+            for span in spans:
+                f.write(orjson.dumps({
+                    "trace_id": span.trace_id,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "name": span.name,
+                    "kind": span.kind,
+                    "start": datetime.fromtimestamp(span.start_ns / 1e9, timezone.utc),
+                    "duration_ms": round((span.end_ns - span.start_ns) / 1e6, 3),
+                    "attributes": span.attributes,
+                    "error": span.error
+                }) + b"\n")
+
+    def _post_otlp(self, spans: List[Span]):
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": "logistica"},
+                "spans": [
+                    {
+                        "traceId": span.trace_id,
+                        "spanId": span.span_id,
+                        **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                        "name": span.name,
+                        "kind": OTLP_KINDS[span.kind],
+                        "startTimeUnixNano": str(span.start_ns),
+                        "endTimeUnixNano": str(span.end_ns),
+                        "attributes": [{"key": k, "value": otlp_value(v)} for k, v in span.attributes.items()],
+                        "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+                    }
+                    for span in spans
+                ]
+            }]
+        }]}
+        response = requests.post(
+            TRACE_OTLP_ENDPOINT, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, timeout=10
+        )
+        response.raise_for_status()
+
+    async def flush(self):
+        spans = self.tracer.take_finished()
+        if not spans:
+            return
+        try:
+            await asyncio.to_thread(self._post_otlp if self.kind == "otlp" else self._write_file, spans)
+            incr_metric("tracing.exported", len(spans))
+        except (OSError, requests.RequestException) as e:
+            incr_metric("tracing.export_failed", len(spans))
+            logger.warning(f"Could not export {len(spans)} spans: {e}")
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(TRACE_FLUSH_MS / 1000)
+            await self.flush()
+
+
+span_exporter = SpanExporter(tracer, TRACE_EXPORTER)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the trace id of the current request to log records (- outside traced requests)"""
+
+    def filter(self, record):
+        span = CURRENT_SPAN.get()
+        record.trace_id = span.trace_id if span else "-"
+        return True
 
 
 # ============== AUTH ROUTES ==============
 
-@auth_router.post("/login", response_model=TokenResponse)
+@auth_router.post("/login", response_model=TokenResponse, dependencies=[Depends(rate_limit_by_ip("login_ip"))])
 async def login(credentials: UserLogin):
+    await enforce_rate_limit("login_user", credentials.username.lower())
+    
     user = await db.users.find_one({"username": credentials.username, "activo": True}, {"_id": 0})
     
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await thread_pool.run("bcrypt", verify_password, credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
-    token = create_token(user["id"], user["username"], user["rol"])
+    session_id, refresh_token = await create_session(user)
+    token = create_token(user, session_id)
     
     user_response = UserResponse(
         id=user["id"],
@@ -326,7 +2075,34 @@ async def login(credentials: UserLogin):
         created_at=user["created_at"]
     )
     
-    return TokenResponse(access_token=token, user=user_response)
+    return TokenResponse(access_token=token, refresh_token=refresh_token, user=user_response)
+
+
+@auth_router.post("/refresh", response_model=TokenResponse)
+async def refresh_access_token(request: RefreshRequest):
+    """New access token from a refresh token, without a password check. The refresh token is rotated"""
+    rotated = await rotate_session(request.refresh_token)
+    if rotated is None:
+        raise HTTPException(status_code=401, detail="Sesión inválida o expirada")
+    session, refresh_token = rotated
+    
+    user = await db.users.find_one({"id": session["user_id"], "activo": True}, {"_id": 0, "password": 0})
+    if not user:
+        await db.sessions.delete_one({"id": session["id"]})
+        raise HTTPException(status_code=401, detail="Usuario no encontrado")
+    
+    return TokenResponse(
+        access_token=create_token(user, session["id"]),
+        refresh_token=refresh_token,
+        user=UserResponse(**user)
+    )
+
+
+@auth_router.post("/logout")
+async def logout(request: RefreshRequest):
+    session_id, _, secret = request.refresh_token.partition(".")
+    await db.sessions.delete_one({"id": session_id, "token_hash": _hash_refresh_secret(secret)})
+    return {"message": "Sesión cerrada"}
 
 
 @auth_router.get("/me", response_model=UserResponse)
@@ -351,7 +2127,7 @@ async def create_user(
     user = {
         "id": str(uuid.uuid4()),
         "username": user_data.username,
-        "password": hash_password(user_data.password),
+        "password": await thread_pool.run("bcrypt", hash_password, user_data.password),
         "nombre": user_data.nombre,
         "rol": user_data.rol,
         "activo": True,
@@ -389,6 +2165,10 @@ async def delete_user(user_id: str, current_user: dict = Depends(require_role("a
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
+    # Other workers pick it up on their next revocation refresh
+    REVOKED_USER_IDS.add(user_id)
+    await db.sessions.delete_many({"user_id": user_id})
+    
     return {"message": "Usuario eliminado"}
 
 
@@ -417,15 +2197,26 @@ async def get_estados():
 @envios_router.post("", response_model=EnvioResponse)
 async def create_envio(
     envio_data: EnvioCreate,
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
     current_user: dict = Depends(require_role("admin", "agente"))
 ):
-    if envio_data.departamento not in DEPARTAMENTOS_URUGUAY:
+    # prefijo_ticket is excluded from model_dump() but changes the result, so it is part of the fingerprint
+    return await run_idempotent(
+        idempotency_key, current_user, "create_envio",
+        {**envio_data.model_dump(), "prefijo_ticket": envio_data.prefijo_ticket},
+        lambda committed: _create_envio(envio_data, current_user, committed)
+    )
+
+
+async def _create_envio(envio_data: EnvioCreate, current_user: dict, committed) -> EnvioResponse:
+    datos = normalizar_direccion(envio_data.model_dump())
+    if datos["departamento"] not in DEPARTAMENTOS_URUGUAY:
         raise HTTPException(status_code=400, detail="Departamento inválido")
     
     if envio_data.motivo not in MOTIVOS_ENVIO:
         raise HTTPException(status_code=400, detail="Motivo inválido")
     
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     historial_inicial = {
         "estado": "Ingresada",
@@ -434,54 +2225,105 @@ async def create_envio(
         "usuario_nombre": current_user["nombre"]
     }
     
+    ticket = envio_data.ticket
+    if ticket:
+        if await ticket_existe(ticket):
+            raise HTTPException(status_code=409, detail="Ya existe un envío con ese ticket")
+    else:
+        ticket = await generar_ticket(envio_data.prefijo_ticket or TICKET_PREFIX)
+    
+    datos["calle"], datos["esquina"] = await asyncio.gather(
+        canonizar_calle(datos["departamento"], datos["calle"]),
+        canonizar_calle(datos["departamento"], datos["esquina"])
+    )
+    
     envio = {
         "id": str(uuid.uuid4()),
-        **envio_data.model_dump(),
+        **datos,
+        "ticket": ticket,
+        "telefono_e164": normalizar_telefono(datos["telefono"]),
         "fecha_carga": now,
         "estado": "Ingresada",
         "historial_estados": [historial_inicial],
         "creado_por": current_user["id"],
-        "creado_por_nombre": current_user["nombre"]
+        "creado_por_nombre": current_user["nombre"],
+        "sla": {"intentos_fallidos": 0},
+        "updated_at": now,
+        "version": 1
     }
+    if envio["ubicacion"] is None:
+        envio["ubicacion"] = gazetteer.geocode(envio["departamento"], envio["calle"], envio["numero"])
+    if envio["ubicacion"] is None:
+        # Left out rather than null so the 2dsphere index skips it
+        del envio["ubicacion"]
     
-    await db.envios.insert_one(envio)
+    try:
+        await db.envios.insert_one(envio)
+    except DuplicateKeyError:
+        # Same ticket inserted concurrently (unique index on envios.ticket)
+        raise HTTPException(status_code=409, detail="Ya existe un envío con ese ticket")
+    respuesta = EnvioResponse(**envio)
+    committed(respuesta)
+    await registrar_kpi(envio, "creados", now)
+    await registrar_direccion(envio)
     
-    return EnvioResponse(**envio)
+    return respuesta
 
 
-@envios_router.get("", response_model=List[EnvioResponse])
-async def get_envios(
-    limit: int = 100,
-    skip: int = 0,
-    departamento: Optional[str] = None,
+async def ticket_existe(ticket: str) -> bool:
+    """Tickets are unique across the hot collection (unique index) and the archive (checked here)"""
+    return (
+        await db.envios.find_one({"ticket": ticket}, {"_id": 1}) is not None
+        or await db.envios_archive.find_one({"ticket": ticket}, {"_id": 1}) is not None
+    )
+
+
+async def generar_ticket(prefijo: str) -> str:
+    """Next sequence ticket, skipping numbers already taken by manually typed tickets"""
+    while True:
+        ticket = (await ticket_allocator.allocate(prefijo))[0]
+        if not await ticket_existe(ticket):
+            return ticket
+        incr_metric("tickets.skipped")
+
+
+@envios_router.post("/tickets")
+async def reservar_tickets(
+    cantidad: int = 1,
+    prefijo: str = TICKET_PREFIX,
+    current_user: dict = Depends(require_role("admin", "agente"))
+):
+    """Reserve ticket numbers up front, e.g. to label a bulk import"""
+    if not 1 <= cantidad <= 1000:
+        raise HTTPException(status_code=400, detail="La cantidad debe estar entre 1 y 1000")
+    return {"tickets": await ticket_allocator.allocate(prefijo, cantidad)}
+
+
+@envios_router.get("", response_model=List[EnvioResponse])
+async def get_envios(
+    response: Response,
+    limit: int = 100,
+    skip: int = 0,
+    departamento: Optional[str] = None,
     motivo: Optional[str] = None,
     estado: Optional[str] = None,
     fecha_desde: Optional[str] = None,
     fecha_hasta: Optional[str] = None,
+    if_none_match: Optional[str] = Header(default=None, alias="If-None-Match"),
     current_user: dict = Depends(get_current_user)
 ):
-    query = {}
+    query = build_envios_query(departamento, motivo, estado, fecha_desde, fecha_hasta)
     
-    if departamento:
-        query["departamento"] = departamento
-    if motivo:
-        query["motivo"] = motivo
-    if estado:
-        query["estado"] = estado
-    if fecha_desde:
-        query["fecha_carga"] = {"$gte": fecha_desde}
-    if fecha_hasta:
-        if "fecha_carga" in query:
-            query["fecha_carga"]["$lte"] = fecha_hasta
-        else:
-            query["fecha_carga"] = {"$lte": fecha_hasta}
+    with query_budget("get_envios"):
+        envios = await budgeted_find(
+            read_db("list").envios, "get_envios",
+            query, 
+            ENVIO_PROJECTION
+        ).sort("fecha_carga", -1).skip(skip).limit(limit).to_list(limit)
     
-    envios = await db.envios.find(
-        query, 
-        {"_id": 0}
-    ).sort("fecha_carga", -1).skip(skip).limit(limit).to_list(limit)
-    
-    return [EnvioResponse(**e) for e in envios]
+    # Versions are per envío, so the page is identified by which envíos it holds and their versions
+    etag = etag_de([(e["id"], e.get("version", 0)) for e in envios])
+    return conditional_response(envios, etag, if_none_match, response)
 
 
 @envios_router.get("/count")
@@ -491,15 +2333,12 @@ async def get_envios_count(
     estado: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    query = {}
-    if departamento:
-        query["departamento"] = departamento
-    if motivo:
-        query["motivo"] = motivo
-    if estado:
-        query["estado"] = estado
+    query = build_envios_query(departamento, motivo, estado)
     
-    count = await db.envios.count_documents(query)
+    with query_budget("get_envios_count"):
+        count = await read_db("stats").envios.count_documents(
+            query, maxTimeMS=QUERY_BUDGET_MS["get_envios_count"]
+        )
     return {"count": count}
 
 
@@ -510,29 +2349,18 @@ async def export_all_envios_excel(
     estado: Optional[str] = None,
     fecha_desde: Optional[str] = None,
     fecha_hasta: Optional[str] = None,
+    include_archived: bool = False,
     current_user: dict = Depends(require_role("admin", "agente"))
 ):
-    query = {}
-    if departamento:
-        query["departamento"] = departamento
-    if motivo:
-        query["motivo"] = motivo
-    if estado:
-        query["estado"] = estado
-    if fecha_desde:
-        query["fecha_carga"] = {"$gte": fecha_desde}
-    if fecha_hasta:
-        if "fecha_carga" in query:
-            query["fecha_carga"]["$lte"] = fecha_hasta
-        else:
-            query["fecha_carga"] = {"$lte": fecha_hasta}
+    query = build_envios_query(departamento, motivo, estado, fecha_desde, fecha_hasta)
     
-    envios = await db.envios.find(query, {"_id": 0}).sort("fecha_carga", -1).to_list(1000)
+    with query_budget("export_excel"):
+        envios = await export_cursor("export_excel", query, include_archived, limit=1000).to_list(1000)
     
     if not envios:
         raise HTTPException(status_code=404, detail="No hay envíos para exportar")
     
-    excel_file = create_excel_workbook(envios)
+    excel_file = await process_pool.run("excel", create_excel_workbook, envios)
     filename = f"envios_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
     
     return StreamingResponse(
@@ -542,12 +2370,176 @@ async def export_all_envios_excel(
     )
 
 
+@envios_router.get("/export/csv")
+async def export_all_envios_csv(
+    departamento: Optional[str] = None,
+    motivo: Optional[str] = None,
+    estado: Optional[str] = None,
+    fecha_desde: Optional[str] = None,
+    fecha_hasta: Optional[str] = None,
+    include_archived: bool = False,
+    current_user: dict = Depends(require_role("admin", "agente"))
+):
+    """Stream all matching envíos as CSV without loading them in memory"""
+    query = build_envios_query(departamento, motivo, estado, fecha_desde, fecha_hasta)
+    cursor = export_cursor("export_csv", query, include_archived)
+    
+    # Fetch the first batch before answering so an early budget overrun still gets a proper status
+    with query_budget("export_csv"):
+        first_batch = await cursor.to_list(QUERY_BATCH_SIZE["export_csv"] or 500)
+    filename = f"envios_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    
+    return StreamingResponse(
+        stream_csv(first_batch, cursor),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
+def sync_scope(user: dict) -> Optional[dict]:
+    """Envíos kept on a courier's device: open ones nobody took plus the ones assigned to them.
+
+    None for other roles, whose devices keep every envío.
+    """
+    if user["rol"] != "repartidor":
+        return None
+    return {"$or": [
+        {"estado": "Asignado a courier", "courier_id": user["id"]},
+        {"estado": {"$in": [estado for estado in ESTADOS_ABIERTOS if estado != "Asignado a courier"]}}
+    ]}
+
+
+@envios_router.get("/sync", response_model=SyncResponse)
+async def sync_envios(
+    since: Optional[str] = None,
+    limit: int = SYNC_PAGE_MAX,
+    current_user: dict = Depends(get_current_user)
+):
+    """Envíos created, changed or deleted since a sync token, oldest change first.
+
+    Without a token (or with one older than the tombstone retention) the whole working set is sent
+    with reset=true and the device must replace its copy. Keep calling with the returned token while
+    has_more is true. An envío may be sent again on the next call; devices upsert by id.
+    
+    Couriers only get their sync_scope; envíos that leave it (taken by another courier, delivered)
+    come back as tombstones, since every such change bumps updated_at.
+    """
+    limit = max(1, min(limit, SYNC_PAGE_MAX))
+    now = datetime.now(timezone.utc)
+    safe = now - timedelta(seconds=SYNC_SAFETY_LAG_SECONDS)
+    safe = (safe.replace(microsecond=safe.microsecond // 1000 * 1000), "")
+    
+    since_key = None
+    if since:
+        fecha, last_id = decode_cursor(since, str, str)
+        since_key = (parse_fecha(fecha), last_id)
+        if since_key[0] < now - timedelta(days=SYNC_TOMBSTONE_DAYS):
+            since_key = None
+    
+    def after(field):
+        if since_key is None:
+            return {field: {"$exists": True}}
+        fecha, last_id = since_key
+        return {"$or": [{field: {"$gt": fecha}}, {field: fecha, "id": {"$gt": last_id}}]}
+    
+    alcance = sync_scope(current_user)
+    with query_budget("sync_envios"):
+        envios = await budgeted_find(
+            read_db("sync").envios, "sync_envios",
+            {"$and": [after("updated_at"), alcance]} if alcance else after("updated_at"), SYNC_PROJECTION
+        ).sort([("updated_at", 1), ("id", 1)]).limit(limit + 1).to_list(limit + 1)
+        tombstones = []
+        if since_key is not None:
+            tombstones = await budgeted_find(
+                read_db("sync").envio_tombstones, "sync_envios", after("eliminado_at"), {"_id": 0, "id": 1, "eliminado_at": 1}
+            ).sort([("eliminado_at", 1), ("id", 1)]).limit(limit + 1).to_list(limit + 1)
+        if since_key is not None and alcance:
+            fuera = await budgeted_find(
+                read_db("sync").envios, "sync_envios",
+                {"$and": [after("updated_at"), {"$nor": [alcance]}]}, {"_id": 0, "id": 1, "updated_at": 1}
+            ).sort([("updated_at", 1), ("id", 1)]).limit(limit + 1).to_list(limit + 1)
+            tombstones += [{"id": envio["id"], "eliminado_at": envio["updated_at"]} for envio in fuera]
+    
+    changes = sorted(
+        [((e["updated_at"], e["id"]), e) for e in envios] + [((t["eliminado_at"], t["id"]), None) for t in tombstones],
+        key=lambda change: change[0]
+    )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    
+    # Never hand out a token past the lag window: a write stamped earlier may still be committing.
+    # A full page inside the window keeps its last key so the next call always makes progress.
+    if has_more:
+        last_key = changes[-1][0]
+        token = min(last_key, safe)
+        if since_key is not None and token <= since_key:
+            token = last_key
+    else:
+        token = max(since_key, safe) if since_key is not None else safe
+    
+    content = {
+        "envios": [envio for _, envio in changes if envio is not None],
+        "eliminados": [key[1] for key, envio in changes if envio is None],
+        "token": encode_cursor(format_fecha(token[0]), token[1]),
+        "has_more": has_more,
+        "reset": since_key is None
+    }
+    return trusted_response(content)
+
+
+@envios_router.get("/cercanos", response_model=List[EnvioCercano])
+async def get_envios_cercanos(
+    lat: float,
+    lng: float,
+    estado: Optional[str] = None,
+    courier_id: Optional[str] = None,
+    max_km: float = CERCANOS_MAX_KM,
+    limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    """Open envíos nearest to a point, closest first, with their distance in meters.
+
+    Only geocoded envíos are considered. courier_id=yo restricts to the caller's assignments.
+    """
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise HTTPException(status_code=400, detail="Coordenadas inválidas")
+    if estado and estado not in ESTADOS_ENVIO:
+        raise HTTPException(status_code=400, detail=f"Estado inválido. Opciones: {', '.join(ESTADOS_ENVIO)}")
+    limit = max(1, min(limit, 200))
+    
+    query = {"estado": estado or {"$in": ESTADOS_ABIERTOS}}
+    if courier_id:
+        query["courier_id"] = current_user["id"] if courier_id == "yo" else courier_id
+    
+    pipeline = [
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [lng, lat]},
+            "distanceField": "distancia_m",
+            "maxDistance": max_km * 1000,
+            "query": query,
+            "spherical": True
+        }},
+        {"$limit": limit},
+        {"$project": {**ENVIO_PROJECTION, "distancia_m": 1}}
+    ]
+    with query_budget("envios_cercanos"):
+        envios = await budgeted_aggregate(read_db("list").envios, "envios_cercanos", pipeline).to_list(limit)
+    return trusted_response(envios)
+
+
 @envios_router.get("/{envio_id}", response_model=EnvioResponse)
-async def get_envio(envio_id: str, current_user: dict = Depends(get_current_user)):
-    envio = await db.envios.find_one({"id": envio_id}, {"_id": 0})
+async def get_envio(
+    envio_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None, alias="If-None-Match"),
+    current_user: dict = Depends(get_current_user)
+):
+    envio = await find_envio(
+        read_db("interactive"), {"id": envio_id}, ENVIO_PROJECTION, max_time_ms=QUERY_MAX_TIME_MS["interactive"]
+    )
     if not envio:
         raise HTTPException(status_code=404, detail="Envío no encontrado")
-    return EnvioResponse(**envio)
+    return conditional_response(envio, etag_de(envio["id"], envio.get("version", 0)), if_none_match, response)
 
 
 @envios_router.put("/{envio_id}", response_model=EnvioResponse)
@@ -560,12 +2552,43 @@ async def update_envio(
     if not envio:
         raise HTTPException(status_code=404, detail="Envío no encontrado")
     
-    update_data = {k: v for k, v in envio_data.model_dump().items() if v is not None}
+    update_data = normalizar_direccion({k: v for k, v in envio_data.model_dump().items() if v is not None})
+    departamento = update_data.get("departamento", envio["departamento"])
+    for campo in ("calle", "esquina"):
+        if update_data.get(campo):
+            update_data[campo] = await canonizar_calle(departamento, update_data[campo])
+    if "telefono" in update_data:
+        update_data["telefono_e164"] = normalizar_telefono(update_data["telefono"])
+    if update_data.get("ticket", envio["ticket"]) != envio["ticket"] and await ticket_existe(update_data["ticket"]):
+        raise HTTPException(status_code=409, detail="Ya existe un envío con ese ticket")
+    update = {"$set": update_data}
     
+    # A new address without explicit coordinates is geocoded again; stale coordinates are dropped
+    if "ubicacion" not in update_data and update_data.keys() & {"calle", "numero", "departamento"}:
+        direccion = {**envio, **update_data}
+        ubicacion = gazetteer.geocode(direccion["departamento"], direccion["calle"], direccion["numero"])
+        if ubicacion:
+            update_data["ubicacion"] = ubicacion
+        else:
+            update["$unset"] = {"ubicacion": ""}
+    
+    anterior = None
     if update_data:
-        await db.envios.update_one({"id": envio_id}, {"$set": update_data})
+        try:
+            # Counts move from the rollup the envío was in when written, even under concurrent edits
+            anterior = await db.envios.find_one_and_update({"id": envio_id}, touch_envio(update), KPI_PROJECTION)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="Ya existe un envío con ese ticket")
     
     updated_envio = await db.envios.find_one({"id": envio_id}, {"_id": 0})
+    if updated_envio is None:
+        raise HTTPException(status_code=404, detail="Envío no encontrado")
+    if anterior and (anterior["departamento"], anterior["motivo"]) != (updated_envio["departamento"], updated_envio["motivo"]):
+        await contar_kpis(anterior, -1)
+        await contar_kpis(updated_envio, 1)
+    # Only a different address is a new use; resending the same one on every edit is not
+    if any(campo in update_data and update_data[campo] != envio.get(campo) for campo in ("calle", "numero", "departamento")):
+        await registrar_direccion(updated_envio)
     return EnvioResponse(**updated_envio)
 
 
@@ -573,25 +2596,66 @@ async def update_envio(
 async def cambiar_estado(
     envio_id: str,
     cambio: CambioEstadoRequest,
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
     current_user: dict = Depends(get_current_user)
 ):
-    if cambio.nuevo_estado not in ESTADOS_ENVIO:
-        raise HTTPException(status_code=400, detail=f"Estado inválido. Opciones: {', '.join(ESTADOS_ENVIO)}")
-    
+    return await run_idempotent(
+        idempotency_key, current_user, "cambiar_estado", {"envio_id": envio_id, **cambio.model_dump()},
+        lambda committed: _cambiar_estado(envio_id, cambio, current_user, committed)
+    )
+
+
+async def _cambiar_estado(envio_id: str, cambio: CambioEstadoRequest, current_user: dict, committed) -> EnvioResponse:
     envio = await db.envios.find_one({"id": envio_id}, {"_id": 0})
     if not envio:
         raise HTTPException(status_code=404, detail="Envío no encontrado")
     
-    # Validate state transition
-    current_state = envio["estado"]
-    valid_transitions = {
-        "Ingresada": ["Asignado a courier"],
-        "Asignado a courier": ["Entregado", "No entregado"],
-        "Entregado": [],
-        "No entregado": ["Asignado a courier"]
-    }
+    validar_cambio_estado(envio, cambio)
+    if not await aplicar_cambio_estado(envio, cambio, current_user, on_commit=committed):
+        raise HTTPException(status_code=409, detail="El estado del envío cambió mientras se procesaba. Intente nuevamente")
     
-    if cambio.nuevo_estado not in valid_transitions.get(current_state, []):
+    updated_envio = await db.envios.find_one({"id": envio_id}, {"_id": 0})
+    return EnvioResponse(**updated_envio)
+
+
+def calcular_sla(envio: dict, nuevo_estado: str, momento: datetime) -> dict:
+    """sla fields changed by a transition made at `momento`.
+
+    Read-modify-write is safe because the update is conditional on the state the envío was read in.
+    Durations are minutes since fecha_carga; only the first assignment counts for minutos_asignacion.
+    """
+    fecha_carga = envio["fecha_carga"] if isinstance(envio["fecha_carga"], datetime) else _to_datetime(envio["fecha_carga"])
+    if fecha_carga is None:
+        return {}
+    if momento.tzinfo is None:
+        momento = momento.replace(tzinfo=timezone.utc)
+    minutos = round(max((momento - fecha_carga).total_seconds(), 0) / 60, 1)
+    sla = envio.get("sla") or {}
+    
+    if nuevo_estado == "Asignado a courier" and sla.get("minutos_asignacion") is None:
+        return {"minutos_asignacion": minutos}
+    if nuevo_estado == "No entregado":
+        return {"intentos_fallidos": sla.get("intentos_fallidos", 0) + 1}
+    if nuevo_estado == "Entregado":
+        return {"minutos_entrega": minutos, "entregado_en": momento}
+    return {}
+
+
+VALID_TRANSITIONS = {
+    "Ingresada": ["Asignado a courier"],
+    "Asignado a courier": ["Entregado", "No entregado"],
+    "Entregado": [],
+    "No entregado": ["Asignado a courier"]
+}
+
+
+def validar_cambio_estado(envio: dict, cambio: CambioEstadoRequest):
+    """Raise 400 when the change is not allowed from the envío's current state"""
+    if cambio.nuevo_estado not in ESTADOS_ENVIO:
+        raise HTTPException(status_code=400, detail=f"Estado inválido. Opciones: {', '.join(ESTADOS_ENVIO)}")
+    
+    current_state = envio["estado"]
+    if cambio.nuevo_estado not in VALID_TRANSITIONS.get(current_state, []):
         raise HTTPException(
             status_code=400, 
             detail=f"No se puede cambiar de '{current_state}' a '{cambio.nuevo_estado}'"
@@ -604,8 +2668,18 @@ async def cambiar_estado(
                 status_code=400, 
                 detail="Se requiere nombre y cédula del receptor para marcar como entregado"
             )
-    
-    now = datetime.now(timezone.utc).isoformat()
+
+
+async def aplicar_cambio_estado(
+    envio: dict, cambio: CambioEstadoRequest, current_user: dict, on_commit=None, **historial_extra
+) -> bool:
+    """Apply a validated change and notify the customer.
+
+    The update only matches while the envío is still in the state it was validated against; returns
+    False when another change got there first. `envio` is updated in place on success, and
+    on_commit() is called as soon as the change is written.
+    """
+    now = datetime.now(timezone.utc)
     
     nuevo_historial = {
         "estado": cambio.nuevo_estado,
@@ -615,16 +2689,33 @@ async def cambiar_estado(
         "receptor_nombre": cambio.receptor_nombre,
         "receptor_cedula": cambio.receptor_cedula,
         "imagen_url": cambio.imagen_url,
-        "comentario": cambio.comentario
+        "comentario": cambio.comentario,
+        **historial_extra
     }
     
-    await db.envios.update_one(
-        {"id": envio_id},
-        {
-            "$set": {"estado": cambio.nuevo_estado},
+    cambios = {"estado": cambio.nuevo_estado}
+    if cambio.nuevo_estado == "Asignado a courier":
+        cambios.update(courier_id=current_user["id"], courier_nombre=current_user["nombre"])
+    # Offline changes count from when they happened on the device
+    momento = min(historial_extra.get("fecha_cliente") or now, now)
+    sla = calcular_sla(envio, cambio.nuevo_estado, momento)
+    
+    result = await db.envios.update_one(
+        {"id": envio["id"], "estado": envio["estado"]},
+        touch_envio({
+            "$set": {**cambios, **{f"sla.{campo}": valor for campo, valor in sla.items()}},
             "$push": {"historial_estados": nuevo_historial}
-        }
+        })
     )
+    if result.modified_count == 0:
+        return False
+    if on_commit:
+        on_commit()
+    envio.update(cambios)
+    envio.setdefault("sla", {}).update(sla)
+    if cambio.nuevo_estado in KPI_CONTADORES:
+        await registrar_kpi(envio, KPI_CONTADORES[cambio.nuevo_estado], momento)
+    envio.setdefault("historial_estados", []).append(nuevo_historial)
     
     # Generate tracking link
     tracking_link = f"{FRONTEND_URL}/rastreo/{envio['ticket']}"
@@ -640,36 +2731,108 @@ async def cambiar_estado(
     
     if mensaje:
         await log_whatsapp_message(
-            envio_id=envio_id,
+            envio_id=envio["id"],
             ticket=envio["ticket"],
             telefono=envio["telefono"],
             mensaje=mensaje,
             estado=cambio.nuevo_estado
         )
+    return True
+
+
+@envios_router.post("/estados/lote", response_model=LoteCambiosResponse)
+async def cambiar_estados_lote(
+    lote: LoteCambiosRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Apply state changes queued by a courier device while offline, in the order they were made.
+
+    Each change reports aplicado, duplicado (cambio_id already applied, e.g. a retried batch),
+    conflicto (the envío moved away from estado_base on the server, or the transition is no longer
+    valid) or error. Conflicts carry the current server state so the device can resolve them.
+    """
+    envio_ids = list({cambio.envio_id for cambio in lote.cambios})
+    envios = {
+        envio["id"]: envio
+        for envio in await db.envios.find({"id": {"$in": envio_ids}}, {"_id": 0}).to_list(len(envio_ids))
+    }
     
-    updated_envio = await db.envios.find_one({"id": envio_id}, {"_id": 0})
-    return EnvioResponse(**updated_envio)
+    resultados = []
+    for cambio in lote.cambios:
+        resultado = {"cambio_id": cambio.cambio_id, "envio_id": cambio.envio_id}
+        envio = envios.get(cambio.envio_id)
+        if envio is None:
+            resultados.append({**resultado, "resultado": "error", "detalle": "Envío no encontrado"})
+            continue
+        resultado["estado_actual"] = envio["estado"]
+        
+        if any(h.get("cambio_id") == cambio.cambio_id for h in envio.get("historial_estados", [])):
+            resultados.append({**resultado, "resultado": "duplicado"})
+            continue
+        if cambio.estado_base and cambio.estado_base != envio["estado"]:
+            resultados.append({
+                **resultado, "resultado": "conflicto",
+                "detalle": f"El envío pasó a '{envio['estado']}' en el servidor"
+            })
+            continue
+        try:
+            validar_cambio_estado(envio, cambio)
+        except HTTPException as e:
+            resultados.append({**resultado, "resultado": "conflicto", "detalle": e.detail})
+            continue
+        
+        aplicado = await aplicar_cambio_estado(
+            envio, cambio, current_user, cambio_id=cambio.cambio_id, fecha_cliente=cambio.fecha_cliente
+        )
+        if not aplicado:
+            # Changed concurrently by someone else: reload so later changes are checked against it
+            envios[envio["id"]] = envio = await db.envios.find_one({"id": envio["id"]}, {"_id": 0})
+            if envio is None:
+                # Deleted or archived in the meantime; later changes to it get the same answer
+                resultado.pop("estado_actual")
+                resultados.append({**resultado, "resultado": "error", "detalle": "Envío no encontrado"})
+                continue
+            resultados.append({
+                **resultado, "resultado": "conflicto", "estado_actual": envio["estado"],
+                "detalle": "El envío cambió mientras se procesaba el lote"
+            })
+            continue
+        resultados.append({**resultado, "resultado": "aplicado", "estado_actual": envio["estado"]})
+    
+    incr_metric("offline_batch.cambios", len(lote.cambios))
+    incr_metric("offline_batch.conflictos", sum(r["resultado"] == "conflicto" for r in resultados))
+    return {"resultados": resultados}
 
 
 @envios_router.post("/{envio_id}/upload-image")
 async def upload_delivery_image(
     envio_id: str,
     file: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
     current_user: dict = Depends(get_current_user)
 ):
     """Upload an image for delivery proof - stores as base64 in MongoDB"""
-    envio = await db.envios.find_one({"id": envio_id}, {"_id": 0})
-    if not envio:
-        raise HTTPException(status_code=404, detail="Envío no encontrado")
-    
-    # Read and encode image
     contents = await file.read()
     if len(contents) > 5 * 1024 * 1024:  # 5MB limit
         raise HTTPException(status_code=400, detail="Imagen muy grande. Máximo 5MB")
     
+    # Fingerprinted by content: two photos with the same name and size are different requests
+    digest = await thread_pool.run("sha256", lambda: hashlib.sha256(contents).hexdigest())
+    return await run_idempotent(
+        idempotency_key, current_user, "upload_delivery_image",
+        {"envio_id": envio_id, "sha256": digest, "content_type": file.content_type},
+        lambda committed: _upload_delivery_image(envio_id, contents, file.content_type)
+    )
+
+
+async def _upload_delivery_image(envio_id: str, contents: bytes, content_type: Optional[str]) -> dict:
+    envio = await db.envios.find_one({"id": envio_id}, {"_id": 0})
+    if not envio:
+        raise HTTPException(status_code=404, detail="Envío no encontrado")
+    
     # Encode to base64
-    base64_image = base64.b64encode(contents).decode('utf-8')
-    content_type = file.content_type or 'image/jpeg'
+    base64_image = await thread_pool.run("base64", lambda: base64.b64encode(contents).decode('utf-8'))
+    content_type = content_type or 'image/jpeg'
     data_url = f"data:{content_type};base64,{base64_image}"
     
     return {"imagen_url": data_url}
@@ -680,12 +2843,14 @@ async def export_single_envio_excel(
     envio_id: str,
     current_user: dict = Depends(require_role("admin", "agente"))
 ):
-    envio = await db.envios.find_one({"id": envio_id}, {"_id": 0})
+    envio = await find_envio(
+        read_db("export"), {"id": envio_id}, EXPORT_PROJECTION, max_time_ms=QUERY_MAX_TIME_MS["export"]
+    )
     
     if not envio:
         raise HTTPException(status_code=404, detail="Envío no encontrado")
     
-    excel_file = create_excel_workbook([envio])
+    excel_file = await process_pool.run("excel", create_excel_workbook, [envio])
     filename = f"envio_{envio.get('ticket', envio_id)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
     
     return StreamingResponse(
@@ -700,9 +2865,14 @@ async def delete_envio(
     envio_id: str,
     current_user: dict = Depends(require_role("admin", "agente"))
 ):
-    result = await db.envios.delete_one({"id": envio_id})
-    if result.deleted_count == 0:
+    envio = await db.envios.find_one_and_delete({"id": envio_id}, KPI_PROJECTION)
+    if envio:
+        await add_tombstones([envio_id])
+    else:
+        envio = await db.envios_archive.find_one_and_delete({"id": envio_id}, KPI_PROJECTION)
+    if envio is None:
         raise HTTPException(status_code=404, detail="Envío no encontrado")
+    await contar_kpis(envio, -1)
     return {"message": "Envío eliminado exitosamente"}
 
 
@@ -710,61 +2880,977 @@ async def delete_envio(
 
 @messages_router.get("", response_model=List[MessageLog])
 async def get_message_logs(
+    response: Response,
     limit: int = 50,
+    cursor: Optional[str] = None,
+    ticket: Optional[str] = None,
+    telefono: Optional[str] = None,
+    estado: Optional[str] = None,
+    enviado: Optional[bool] = None,
+    fecha_desde: Optional[str] = None,
+    fecha_hasta: Optional[str] = None,
     current_user: dict = Depends(require_role("admin"))
 ):
-    messages = await db.message_logs.find(
-        {}, {"_id": 0}
-    ).sort("fecha", -1).limit(limit).to_list(limit)
-    return messages
+    """Newest messages first. When more are available the X-Next-Cursor header holds the cursor for the next page"""
+    limit = max(1, min(limit, MESSAGES_PAGE_MAX))
+    
+    query = {}
+    if ticket:
+        query["ticket"] = ticket
+    if telefono:
+        e164 = normalizar_telefono(telefono)
+        # Numbers we cannot normalize were stored without telefono_e164: match them as typed
+        if e164:
+            query["telefono_e164"] = e164
+        else:
+            query["telefono"] = telefono
+    if estado:
+        query["estado"] = estado
+    if enviado is not None:
+        query["enviado"] = enviado
+    if fecha_desde or fecha_hasta:
+        query["fecha"] = fecha_range(fecha_desde, fecha_hasta)
+    if cursor:
+        fecha, last_id = decode_cursor(cursor, str, str)
+        fecha = parse_fecha(fecha)
+        query["$or"] = [{"fecha": {"$lt": fecha}}, {"fecha": fecha, "id": {"$lt": last_id}}]
+    
+    with query_budget("get_message_logs"):
+        messages = await budgeted_find(
+            read_db("list").message_logs, "get_message_logs", query, MESSAGE_PROJECTION
+        ).sort([("fecha", -1), ("id", -1)]).limit(limit).to_list(limit)
+    
+    if len(messages) == limit:
+        last = messages[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(format_fecha(last["fecha"]), last["id"])
+    return trusted_response(messages, response)
 
 
 @messages_router.get("/{envio_id}", response_model=List[MessageLog])
 async def get_envio_messages(
     envio_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None, alias="If-None-Match"),
     current_user: dict = Depends(get_current_user)
 ):
-    messages = await db.message_logs.find(
-        {"envio_id": envio_id}, {"_id": 0}
-    ).sort("fecha", -1).to_list(100)
-    return messages
+    messages = await read_db("interactive").message_logs.find(
+        {"envio_id": envio_id}, MESSAGE_PROJECTION
+    ).sort("fecha", -1).max_time_ms(QUERY_MAX_TIME_MS["interactive"]).to_list(100)
+    # Logs are only appended or flagged as sent
+    etag = etag_de([(m["id"], m.get("enviado", False)) for m in messages])
+    return conditional_response(messages, etag, if_none_match, response)
 
 
-# ============== PUBLIC TRACKING ROUTES ==============
+# ============== ADDRESS BOOK ROUTES ==============
 
-class TrackingResponse(BaseModel):
-    ticket: str
-    estado: str
-    calle: str
-    numero: str
-    apto: str
-    departamento: str
-    contacto: str
-    fecha_carga: str
-    historial_estados: List[EstadoHistorial]
+def prefijo_calle(texto: str) -> str:
+    """Key prefix for what the user typed so far; a bare street type ("Av.") matches every street"""
+    palabras = clave_calle(texto).split()
+    while palabras and palabras[0] in CALLE_TIPOS:
+        palabras.pop(0)
+    return " ".join(palabras)
+
+
+@direcciones_router.get("/calles")
+async def autocompletar_calles(
+    departamento: str,
+    q: str = "",
+    limit: int = 10,
+    current_user: dict = Depends(require_role("admin", "agente"))
+):
+    """Streets of a departamento whose name starts with q, most used first"""
+    limit = max(1, min(limit, 50))
+    query = {"departamento": departamento}
+    prefijo = prefijo_calle(q)
+    if prefijo:
+        # Anchored regex on the lookup key is an index range scan
+        query["clave"] = {"$regex": f"^{re.escape(prefijo)}"}
+    
+    with query_budget("autocompletar_direcciones"):
+        calles = await budgeted_find(
+            db.calles, "autocompletar_direcciones", query, {"_id": 0, "calle": 1, "usos": 1}
+        ).sort("usos", -1).to_list(limit)
+    return {"calles": calles}
+
+
+@direcciones_router.get("")
+async def autocompletar_direcciones(
+    departamento: str,
+    calle: str,
+    numero: str = "",
+    limit: int = 10,
+    current_user: dict = Depends(require_role("admin", "agente"))
+):
+    """Addresses already used on a street, filtered by door number prefix, most used first"""
+    limit = max(1, min(limit, 50))
+    query = {"departamento": departamento, "clave_calle": clave_calle(calle)}
+    numero = " ".join(numero.split()).upper()
+    if numero:
+        query["numero"] = {"$regex": f"^{re.escape(numero)}"}
+    
+    with query_budget("autocompletar_direcciones"):
+        direcciones = await budgeted_find(
+            db.direcciones, "autocompletar_direcciones", query,
+            {"_id": 0, "calle": 1, "numero": 1, "apto": 1, "esquina": 1, "usos": 1}
+        ).sort("usos", -1).to_list(limit)
+    return {"direcciones": direcciones}
+
+
+# ============== CUSTOMER ROUTES ==============
+
+CLIENTE_ENVIOS_MAX = int(os.environ.get('CLIENTE_ENVIOS_MAX', 500))
+
+
+@clientes_router.get("/{telefono}/envios", response_model=List[EnvioResponse])
+async def envios_cliente(
+    telefono: str,
+    current_user: dict = Depends(require_role("admin", "agente"))
+):
+    """Every envío of a customer, archived deliveries included, newest first, looked up by phone number in any format"""
+    telefono_e164 = normalizar_telefono(telefono)
+    if not telefono_e164:
+        raise HTTPException(status_code=400, detail="Teléfono inválido")
+    
+    query = {"telefono_e164": telefono_e164}
+    # Projected in both branches: trusted_response skips the model, so only its fields may be read
+    pipeline = [
+        {"$match": query},
+        {"$project": ENVIO_PROJECTION},
+        {"$unionWith": {"coll": "envios_archive", "pipeline": [{"$match": query}, {"$project": ENVIO_PROJECTION}]}},
+        {"$sort": {"fecha_carga": -1}},
+        {"$limit": CLIENTE_ENVIOS_MAX}
+    ]
+    with query_budget("envios_cliente"):
+        envios = await budgeted_aggregate(read_db("list").envios, "envios_cliente", pipeline).to_list(CLIENTE_ENVIOS_MAX)
+    return trusted_response(envios)
 
 
-@tracking_router.get("/{ticket}", response_model=TrackingResponse)
+# ============== COURIER LOCATION ROUTES ==============
+
+class CourierLocations:
+    """Courier pings buffered in memory and written to the courier_locations time-series collection in batches.
+
+    Ingestion never waits on Mongo: pings are appended to the buffer and flushed by a background
+    task with one unordered insert_many. The newest position of each courier is kept in memory for
+    the tracking page and re-read from the collection after LOCATION_CACHE_SECONDS, which picks up
+    pings received by other workers.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.pending = []
+        self.latest = {}  # courier id -> (position or None, monotonic time it was read)
+        self.wakeup = asyncio.Event()
+        self.writing = None  # task of the insert in progress
+
+    def add(self, courier_id: str, puntos: List[PuntoUbicacion]) -> int:
+        if len(self.pending) + len(puntos) > LOCATION_BUFFER_MAX:
+            incr_metric("locations.rejected", len(puntos))
+            raise HTTPException(status_code=503, detail="Servicio de ubicaciones saturado, reintente más tarde")
+        
+        now = datetime.now(timezone.utc)
+        for punto in puntos:
+            fecha = punto.fecha if punto.fecha.tzinfo else punto.fecha.replace(tzinfo=timezone.utc)
+            doc = {
+                "courier_id": courier_id,
+                # Device clocks run ahead sometimes; a ping cannot be newer than its arrival
+                "fecha": min(fecha, now),
+                "ubicacion": {"type": "Point", "coordinates": [punto.lng, punto.lat]}
+            }
+            if punto.precision_m is not None:
+                doc["precision_m"] = punto.precision_m
+            self.pending.append(doc)
+        
+        newest = max(self.pending[-len(puntos):], key=lambda doc: doc["fecha"])
+        current = self.latest.get(courier_id, (None, 0))[0]
+        if current is None or newest["fecha"] >= current["fecha"]:
+            self.latest[courier_id] = (self._position(newest), time.monotonic())
+        
+        incr_metric("locations.received", len(puntos))
+        if len(self.pending) >= LOCATION_FLUSH_SIZE:
+            self.wakeup.set()
+        return len(puntos)
+
+    @staticmethod
+    def _position(doc: dict) -> dict:
+        lng, lat = doc["ubicacion"]["coordinates"]
+        return {"lat": lat, "lng": lng, "fecha": doc["fecha"]}
+
+    async def flush(self):
+        """Write the buffered pings.
+
+        The insert runs in its own task and is shielded: cancelling a flush (e.g. the flush loop on
+        shutdown) leaves the swapped batch being written, and the next flush waits for it first.
+        """
+        while self.writing is not None and not self.writing.done():
+            await asyncio.shield(self.writing)
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        self.writing = asyncio.ensure_future(self._write(batch))
+        await asyncio.shield(self.writing)
+
+    async def _write(self, batch: list):
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+            incr_metric("locations.written", len(batch))
+        except BulkWriteError as e:
+            # Unordered insert: everything but the rejected pings was written, nothing to retry
+            failed = len(e.details.get("writeErrors", []))
+            incr_metric("locations.written", len(batch) - failed)
+            incr_metric("locations.dropped", failed)
+        except PyMongoError as e:
+            # Keep the batch for the next attempt, newest pings first, as far as the buffer allows
+            room = max(LOCATION_BUFFER_MAX - len(self.pending), 0)
+            keep = batch[max(len(batch) - room, 0):] if room else []
+            self.pending = keep + self.pending
+            incr_metric("locations.dropped", len(batch) - len(keep))
+            logger.error(f"Could not write {len(batch)} courier locations: {e}")
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=LOCATION_FLUSH_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def last_position(self, courier_id: str) -> Optional[dict]:
+        position, read_at = self.latest.get(courier_id, (None, None))
+        if read_at is not None and time.monotonic() - read_at < LOCATION_CACHE_SECONDS:
+            return position
+        
+        doc = await self.collection.find_one(
+            {"courier_id": courier_id}, {"_id": 0, "fecha": 1, "ubicacion": 1}, sort=[("fecha", -1)]
+        )
+        if doc and (position is None or doc["fecha"] > position["fecha"]):
+            position = self._position(doc)
+        self.latest[courier_id] = (position, time.monotonic())
+        return position
+
+
+courier_locations = CourierLocations(db.courier_locations)
+
+
+@couriers_router.post("/ubicaciones", status_code=202)
+async def registrar_ubicaciones(
+    lote: LoteUbicaciones,
+    current_user: dict = Depends(require_role("repartidor"))
+):
+    """Batch of GPS readings from a courier device; stored asynchronously"""
+    return {"recibidos": courier_locations.add(current_user["id"], lote.puntos)}
+
+
+# ============== PUBLIC TRACKING ROUTES ==============
+
+@tracking_router.get("/{ticket}", response_model=TrackingResponse, dependencies=[Depends(rate_limit_by_ip("tracking_ip"))])
 async def get_tracking_by_ticket(ticket: str):
     """Public endpoint for customers to track their shipment"""
-    envio = await db.envios.find_one({"ticket": ticket}, {"_id": 0})
+    await enforce_rate_limit("tracking_ticket", ticket)
+    
+    envio = await find_envio(
+        read_db("tracking"), {"ticket": ticket}, {**TRACKING_PROJECTION, "courier_id": 1},
+        max_time_ms=QUERY_MAX_TIME_MS["tracking"]
+    )
     
     if not envio:
         raise HTTPException(status_code=404, detail="Envío no encontrado")
     
-    return TrackingResponse(
-        ticket=envio["ticket"],
-        estado=envio["estado"],
-        calle=envio["calle"],
-        numero=envio["numero"],
-        apto=envio.get("apto", ""),
-        departamento=envio["departamento"],
-        contacto=envio["contacto"],
-        fecha_carga=envio["fecha_carga"],
-        historial_estados=envio.get("historial_estados", [])
+    envio.setdefault("apto", "")
+    envio.setdefault("historial_estados", [])
+    
+    # Live courier position only while the envío is on its way
+    courier_id = envio.pop("courier_id", None)
+    if envio["estado"] == "Asignado a courier" and courier_id:
+        position = await courier_locations.last_position(courier_id)
+        if position and position["fecha"] >= datetime.now(timezone.utc) - timedelta(minutes=LOCATION_STALE_MINUTES):
+            envio["ubicacion_courier"] = position
+    return trusted_response(envio)
+
+
+# ============== METRICS ROUTES ==============
+
+@api_router.get("/metrics")
+async def get_metrics(current_user: dict = Depends(require_role("admin"))):
+    return {"metrics": dict(sorted(METRICS.items()))}
+
+
+# ============== PROFILING ROUTES ==============
+
+def collapsed_text(stacks) -> PlainTextResponse:
+    """Collapsed stacks as text, one "stack count" line each, for flamegraph.pl or speedscope"""
+    return PlainTextResponse("".join(f"{stack} {n}\n" for stack, n in stacks))
+
+
+@profiles_router.get("")
+async def list_profiles(limit: int = 50, current_user: dict = Depends(require_role("admin"))):
+    """Profiles requested with the profiling header, newest first"""
+    limit = max(1, min(limit, 200))
+    return await db.profiles.find({}, {"_id": 0, "stacks": 0}).sort("created_at", -1).to_list(limit)
+
+
+@profiles_router.get("/rutas")
+async def list_route_profiles(current_user: dict = Depends(require_role("admin"))):
+    """Routes profiled by the 1-in-N mode on this worker, with the number of requests and samples"""
+    return [
+        {"ruta": ruta, "perfilados": agregado["perfilados"], "muestras": sum(agregado["stacks"].values())}
+        for ruta, agregado in sorted(request_profiler.rutas.items())
+    ]
+
+
+@profiles_router.get("/rutas/flame")
+async def route_flame(ruta: str, current_user: dict = Depends(require_role("admin"))):
+    agregado = request_profiler.rutas.get(ruta)
+    if not agregado:
+        raise HTTPException(status_code=404, detail="Ruta sin perfiles")
+    return collapsed_text(agregado["stacks"].most_common())
+
+
+@profiles_router.delete("/rutas")
+async def reset_route_profiles(current_user: dict = Depends(require_role("admin"))):
+    request_profiler.rutas.clear()
+    return {"message": "Perfiles por ruta reiniciados"}
+
+
+@profiles_router.get("/{profile_id}")
+async def get_profile(profile_id: str, formato: str = "json", current_user: dict = Depends(require_role("admin"))):
+    """A stored profile; formato=collapsed returns its stacks as collapsed text"""
+    profile = await db.profiles.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    if formato == "collapsed":
+        return collapsed_text(profile["stacks"])
+    return profile
+
+
+# ============== REPORTS ROUTES ==============
+
+SLA_AGRUPACIONES = {"departamento": "departamento", "motivo": "motivo", "courier": "courier_id"}
+
+
+# Upper bounds (minutes) of the histogram buckets the SLA report counts durations into
+SLA_BUCKETS_MIN = [5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 360, 480, 720, 1440, 2880, 4320, 7200, 10080, 20160, 43200]
+
+
+def sla_histograma(campo: str) -> list:
+    """Facet counting a duration per group and histogram bucket, with the sum and largest value of each bucket"""
+    return [
+        {"$match": {campo: {"$ne": None}}},
+        {"$group": {
+            "_id": {
+                "clave": "$clave",
+                "bucket": {"$size": {"$filter": {"input": SLA_BUCKETS_MIN, "cond": {"$lt": ["$$this", f"${campo}"]}}}}
+            },
+            "n": {"$sum": 1},
+            "total": {"$sum": f"${campo}"},
+            "max": {"$max": f"${campo}"}
+        }}
+    ]
+
+
+def resumen_minutos(buckets: list) -> Optional[dict]:
+    """Percentiles from a group's histogram: the largest value in the bucket holding the nearest rank.
+
+    Exact average; percentiles are an upper bound, never more than one bucket above the true value.
+    """
+    buckets = sorted(buckets, key=lambda b: b["_id"]["bucket"])
+    n = sum(b["n"] for b in buckets)
+    if not n:
+        return None
+    
+    def percentil(p: float):
+        rank = max(math.ceil(p / 100 * n), 1)
+        acumulado = 0
+        for b in buckets:
+            acumulado += b["n"]
+            if acumulado >= rank:
+                return b["max"]
+    
+    return {
+        "p50": percentil(50),
+        "p90": percentil(90),
+        "p95": percentil(95),
+        "promedio": round(sum(b["total"] for b in buckets) / n, 1)
+    }
+
+
+@reports_router.get("/sla")
+async def reporte_sla(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    agrupar: str = "departamento",
+    current_user: dict = Depends(require_role("admin", "agente"))
+):
+    """Time to assign, time to deliver (minutes since loaded) and failed attempts of envíos loaded in a date range.
+
+    Reads only the precomputed sla fields of the range (fecha_carga index) and returns counts per
+    histogram bucket instead of every duration. Defaults to the last 30 days.
+    """
+    if agrupar not in SLA_AGRUPACIONES:
+        raise HTTPException(status_code=400, detail=f"Agrupación inválida. Opciones: {', '.join(SLA_AGRUPACIONES)}")
+    if not desde:
+        desde = (datetime.now(timezone.utc) - timedelta(days=30)).date().isoformat()
+    
+    pipeline = [
+        {"$match": {"fecha_carga": fecha_range(desde, hasta)}},
+        {"$project": {
+            "_id": 0,
+            "clave": f"${SLA_AGRUPACIONES[agrupar]}",
+            "asignacion": "$sla.minutos_asignacion",
+            "entrega": "$sla.minutos_entrega",
+            "fallidos": "$sla.intentos_fallidos"
+        }},
+        {"$facet": {
+            "grupos": [
+                {"$group": {"_id": "$clave", "envios": {"$sum": 1}, "intentos_fallidos": {"$sum": "$fallidos"}}},
+                {"$sort": {"_id": 1}}
+            ],
+            "asignacion": sla_histograma("asignacion"),
+            "entrega": sla_histograma("entrega")
+        }}
+    ]
+    with query_budget("reporte_sla"):
+        resultado = (await budgeted_aggregate(read_db("stats").envios, "reporte_sla", pipeline).to_list(1))[0]
+    grupos = resultado["grupos"]
+    histogramas = {"asignacion": {}, "entrega": {}}
+    for campo, por_clave in histogramas.items():
+        for bucket in resultado[campo]:
+            por_clave.setdefault(bucket["_id"].get("clave"), []).append(bucket)
+    
+    nombres = {}
+    if agrupar == "courier":
+        usuarios = await db.users.find(
+            {"id": {"$in": [g["_id"] for g in grupos if g["_id"]]}}, {"_id": 0, "id": 1, "nombre": 1}
+        ).to_list(None)
+        nombres = {u["id"]: u["nombre"] for u in usuarios}
+    
+    return {
+        "desde": desde,
+        "hasta": hasta,
+        "agrupar": agrupar,
+        "grupos": [
+            {
+                "clave": g["_id"],
+                **({"nombre": nombres.get(g["_id"])} if agrupar == "courier" else {}),
+                "envios": g["envios"],
+                "entregados": sum(b["n"] for b in histogramas["entrega"].get(g["_id"], [])),
+                "intentos_fallidos": g["intentos_fallidos"],
+                "minutos_asignacion": resumen_minutos(histogramas["asignacion"].get(g["_id"], [])),
+                "minutos_entrega": resumen_minutos(histogramas["entrega"].get(g["_id"], []))
+            }
+            for g in grupos
+        ]
+    }
+
+
+KPI_AGRUPACIONES = {"departamento": "$departamento", "motivo": "$motivo", "usuario": "$creado_por", "total": None}
+
+
+def parse_dia(value: str) -> str:
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Fecha inválida: {value}")
+
+
+@reports_router.get("/daily")
+async def reporte_diario(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    agrupar: str = "total",
+    departamento: Optional[str] = None,
+    motivo: Optional[str] = None,
+    current_user: dict = Depends(require_role("admin", "agente"))
+):
+    """Envíos created, delivered and failed per day (YYYY-MM-DD in REPORTS_TZ), from the kpi_daily rollups.
+
+    Defaults to the last 90 days.
+    """
+    if agrupar not in KPI_AGRUPACIONES:
+        raise HTTPException(status_code=400, detail=f"Agrupación inválida. Opciones: {', '.join(KPI_AGRUPACIONES)}")
+    hoy = datetime.now(REPORTS_TZ).date()
+    desde = parse_dia(desde) if desde else (hoy - timedelta(days=90)).isoformat()
+    hasta = parse_dia(hasta) if hasta else hoy.isoformat()
+    
+    query = {"fecha": {"$gte": desde, "$lte": hasta}}
+    if departamento:
+        query["departamento"] = departamento
+    if motivo:
+        query["motivo"] = motivo
+    
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": {"fecha": "$fecha", "clave": KPI_AGRUPACIONES[agrupar]},
+            "creados": {"$sum": "$creados"},
+            "entregados": {"$sum": "$entregados"},
+            "fallidos": {"$sum": "$fallidos"}
+        }},
+        {"$sort": {"_id.fecha": 1, "_id.clave": 1}}
+    ]
+    with query_budget("reporte_diario"):
+        filas = await budgeted_aggregate(read_db("stats").kpi_daily, "reporte_diario", pipeline).to_list(None)
+    
+    nombres = {}
+    if agrupar == "usuario":
+        usuarios = await db.users.find(
+            {"id": {"$in": list({f["_id"]["clave"] for f in filas})}}, {"_id": 0, "id": 1, "nombre": 1}
+        ).to_list(None)
+        nombres = {u["id"]: u["nombre"] for u in usuarios}
+    
+    return {
+        "desde": desde,
+        "hasta": hasta,
+        "agrupar": agrupar,
+        "series": [
+            {
+                "fecha": f["_id"]["fecha"],
+                **({"clave": f["_id"]["clave"]} if agrupar != "total" else {}),
+                **({"nombre": nombres.get(f["_id"]["clave"])} if agrupar == "usuario" else {}),
+                "creados": f["creados"],
+                "entregados": f["entregados"],
+                "fallidos": f["fallidos"]
+            }
+            for f in filas
+        ]
+    }
+
+
+async def recompute_kpi_daily(desde: Optional[date] = None) -> int:
+    """Rebuild the rollups of every day since `desde` (all history when None) from envíos and the archive.
+
+    Rollups are replaced in one bulk write instead of being cleared first, so increments made while
+    the aggregation runs are only lost on a rollup replaced at that moment, until the next run.
+    """
+    tz = str(REPORTS_TZ)
+    dia = lambda campo: {"$dateToString": {"format": "%Y-%m-%d", "date": campo, "timezone": tz}}
+    grupo = {"departamento": "$departamento", "motivo": "$motivo", "creado_por": "$creado_por"}
+    inicio = datetime.combine(desde, datetime.min.time(), REPORTS_TZ) if desde else None
+    rango = {"fecha": {"$gte": desde.isoformat()}} if desde else {}
+    
+    # Listed before aggregating: a rollup first written meanwhile is new activity, not a stale day
+    existentes = {fila["_id"] for fila in await db.kpi_daily.find(rango, {"_id": 1}).to_list(None)}
+    
+    creados = [
+        *([{"$match": {"fecha_carga": {"$gte": inicio}}}] if inicio else []),
+        {"$group": {"_id": {"fecha": dia("$fecha_carga"), **grupo}, "creados": {"$sum": 1}}}
+    ]
+    eventos = [
+        {"$match": {"historial_estados.estado": {"$in": list(KPI_CONTADORES)}}},
+        {"$unwind": "$historial_estados"},
+        {"$match": {"historial_estados.estado": {"$in": list(KPI_CONTADORES)}}},
+        # Same moment the incremental path uses: device time for offline changes, never after the server time
+        {"$set": {"momento": {"$min": ["$historial_estados.fecha_cliente", "$historial_estados.fecha"]}}},
+        *([{"$match": {"momento": {"$gte": inicio}}}] if inicio else []),
+        {"$group": {
+            "_id": {"fecha": dia("$momento"), **grupo},
+            "entregados": {"$sum": {"$cond": [{"$eq": ["$historial_estados.estado", "Entregado"]}, 1, 0]}},
+            "fallidos": {"$sum": {"$cond": [{"$eq": ["$historial_estados.estado", "No entregado"]}, 1, 0]}}
+        }}
+    ]
+    
+    filas = {}
+    for pipeline in (creados, eventos):
+        for collection in (db.envios, db.envios_archive):
+            async for fila in collection.aggregate(pipeline, allowDiskUse=True):
+                clave = fila.pop("_id")
+                acumulado = filas.setdefault("|".join(clave.values()), {**clave, "creados": 0, "entregados": 0, "fallidos": 0})
+                for contador, valor in fila.items():
+                    acumulado[contador] += valor
+    
+    ops = kpi_recompute_ops(filas, existentes)
+    if ops:
+        await db.kpi_daily.bulk_write(ops, ordered=False)
+    return len(filas)
+
+
+def kpi_recompute_ops(filas: dict, existentes: set) -> list:
+    """Replace every recomputed rollup; drop the ones of the range left without activity (e.g. all deleted)"""
+    return [
+        *(ReplaceOne({"_id": _id}, fila, upsert=True) for _id, fila in filas.items()),
+        *(DeleteOne({"_id": _id}) for _id in sorted(existentes - filas.keys()))
+    ]
+
+
+async def run_kpi_nightly() -> Optional[int]:
+    """Nightly recompute in the worker holding the lease; None in the others"""
+    # Held past the run, so workers waking a little later do not recompute again
+    if not await acquire_lease("kpi_nightly", 12 * 3600):
+        return None
+    desde = datetime.now(REPORTS_TZ).date() - timedelta(days=KPI_RECOMPUTE_DAYS)
+    filas = await recompute_kpi_daily(desde)
+    logger.info(f"Recomputed daily KPIs since {desde}: {filas} rollups")
+    return filas
+
+
+async def kpi_nightly_loop():
+    while True:
+        ahora = datetime.now(REPORTS_TZ)
+        proxima = ahora.replace(hour=KPI_RECOMPUTE_HOUR, minute=0, second=0, microsecond=0)
+        if proxima <= ahora:
+            proxima += timedelta(days=1)
+        await asyncio.sleep((proxima - ahora).total_seconds())
+        try:
+            await run_kpi_nightly()
+        except PyMongoError as e:
+            logger.error(f"Daily KPI recompute failed: {e}")
+
+
+# ============== DATA MIGRATIONS ==============
+
+RUN_DATA_MIGRATIONS = os.environ.get('RUN_DATA_MIGRATIONS', 'true').lower() == 'true'
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 500))
+MIGRATION_PAUSE_MS = int(os.environ.get('MIGRATION_PAUSE_MS', 50))
+# Longest a single migration may run before another worker may take over the run
+MIGRATION_LEASE_SECONDS = int(os.environ.get('MIGRATION_LEASE_SECONDS', 3600))
+
+# Long-running tasks started on startup and cancelled on shutdown
+BACKGROUND_TASKS = []
+
+
+def _to_datetime(value) -> Optional[datetime]:
+    """Legacy ISO string to aware UTC datetime, None if it is not a parseable string"""
+    if not isinstance(value, str):
+        return None
+    try:
+        fecha = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return fecha if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc)
+
+
+async def migrate_in_batches(collection, query: dict, projection: dict, build_update) -> int:
+    """Online migration: apply build_update(doc) to matching documents in small _id-ordered batches"""
+    last_id = None
+    migrated = 0
+    while True:
+        batch_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+        docs = await collection.find(batch_query, projection).sort("_id", 1).to_list(MIGRATION_BATCH_SIZE)
+        if not docs:
+            return migrated
+        
+        ops = []
+        for doc in docs:
+            update = build_update(doc)
+            if update:
+                ops.append(UpdateOne({"_id": doc["_id"]}, update))
+        if ops:
+            await collection.bulk_write(ops, ordered=False)
+            migrated += len(ops)
+        
+        last_id = docs[-1]["_id"]
+        # Yield to regular traffic between batches
+        await asyncio.sleep(MIGRATION_PAUSE_MS / 1000)
+
+
+def _fechas_envio_update(envio: dict) -> Optional[dict]:
+    update = {}
+    fecha = _to_datetime(envio.get("fecha_carga"))
+    if fecha:
+        update["fecha_carga"] = fecha
+    for i, historial in enumerate(envio.get("historial_estados", [])):
+        fecha = _to_datetime(historial.get("fecha"))
+        if fecha:
+            update[f"historial_estados.{i}.fecha"] = fecha
+    return {"$set": update} if update else None
+
+
+async def migrate_fechas_envios() -> int:
+    return await migrate_in_batches(
+        db.envios,
+        {"$or": [{"fecha_carga": {"$type": "string"}}, {"historial_estados.fecha": {"$type": "string"}}]},
+        {"fecha_carga": 1, "historial_estados.fecha": 1},
+        _fechas_envio_update
+    )
+
+
+async def migrate_fechas_message_logs() -> int:
+    return await migrate_in_batches(
+        db.message_logs,
+        {"fecha": {"$type": "string"}},
+        {"fecha": 1},
+        lambda log: {"$set": {"fecha": _to_datetime(log["fecha"])}} if _to_datetime(log["fecha"]) else None
+    )
+
+
+async def migrate_updated_at_envios() -> int:
+    # Stamped with the migration time, not a past date, so devices that synced before also receive them
+    return await migrate_in_batches(
+        db.envios,
+        {"updated_at": {"$exists": False}},
+        {"_id": 1},
+        lambda envio: {"$set": {"updated_at": datetime.now(timezone.utc)}}
+    )
+
+
+def _ubicacion_envio_update(envio: dict) -> Optional[dict]:
+    ubicacion = gazetteer.geocode(envio.get("departamento", ""), envio.get("calle", ""), envio.get("numero", ""))
+    return touch_envio({"$set": {"ubicacion": ubicacion}}) if ubicacion else None
+
+
+async def migrate_ubicacion_envios() -> int:
+    return await migrate_in_batches(
+        db.envios,
+        {"ubicacion": {"$exists": False}},
+        {"departamento": 1, "calle": 1, "numero": 1},
+        _ubicacion_envio_update
+    )
+
+
+def _courier_envio_update(envio: dict) -> Optional[dict]:
+    asignaciones = [h for h in envio["historial_estados"] if h.get("estado") == "Asignado a courier"]
+    if not asignaciones:
+        return None
+    return touch_envio({"$set": {
+        "courier_id": asignaciones[-1]["usuario_id"],
+        "courier_nombre": asignaciones[-1]["usuario_nombre"]
+    }})
+
+
+async def migrate_courier_envios() -> int:
+    return await migrate_in_batches(
+        db.envios,
+        {"courier_id": {"$exists": False}, "historial_estados.estado": "Asignado a courier"},
+        {"historial_estados.estado": 1, "historial_estados.usuario_id": 1, "historial_estados.usuario_nombre": 1},
+        _courier_envio_update
     )
 
 
+def _sla_envio_update(envio: dict) -> Optional[dict]:
+    """Replay the history through calcular_sla"""
+    sla = {"intentos_fallidos": 0}
+    for historial in envio.get("historial_estados", []):
+        momento = historial.get("fecha_cliente") or historial.get("fecha")
+        momento = momento if isinstance(momento, datetime) else _to_datetime(momento)
+        if momento:
+            sla.update(calcular_sla({"fecha_carga": envio["fecha_carga"], "sla": sla}, historial["estado"], momento))
+    return {"$set": {"sla": sla}}
+
+
+async def migrate_sla_envios() -> int:
+    return await migrate_in_batches(
+        db.envios,
+        {"sla": {"$exists": False}},
+        {"fecha_carga": 1, "historial_estados.estado": 1, "historial_estados.fecha": 1, "historial_estados.fecha_cliente": 1},
+        _sla_envio_update
+    )
+
+
+async def migrate_direcciones_envios() -> int:
+    """Normalize the address of existing envíos and rebuild the calles / direcciones address book from them.
+
+    Envíos are read oldest first, so the canonical spelling of a street is the gazetteer's or the first one used.
+    """
+    calles, direcciones, ops = {}, {}, []
+    migrated = 0
+    inicio = datetime.now(timezone.utc)
+    
+    def canonica(departamento: str, calle: str) -> str:
+        if not calle:
+            return calle
+        conocida = calles.get(f"{departamento}|{clave_calle(calle)}")
+        return conocida["calle"] if conocida else gazetteer.nombre_calle(departamento, calle) or calle
+    
+    campos = {"departamento": 1, "calle": 1, "numero": 1, "apto": 1, "esquina": 1, "fecha_carga": 1}
+    async for envio in db.envios.find({}, campos).sort("fecha_carga", 1):
+        datos = normalizar_direccion({campo: envio.get(campo) for campo in campos})
+        departamento = datos["departamento"]
+        datos["calle"], datos["esquina"] = canonica(departamento, datos["calle"]), canonica(departamento, datos["esquina"])
+        cambios = {campo: valor for campo, valor in datos.items() if valor != envio.get(campo)}
+        if cambios:
+            ops.append(UpdateOne({"_id": envio["_id"]}, touch_envio({"$set": cambios})))
+        
+        clave = clave_calle(datos["calle"])
+        calle = calles.setdefault(f"{departamento}|{clave}", {
+            "departamento": departamento, "clave": clave, "calle": datos["calle"], "usos": 0
+        })
+        calle["usos"] += 1
+        calle["ultimo_uso"] = datos["fecha_carga"]
+        direccion = direcciones.setdefault(f"{departamento}|{clave}|{datos['numero']}|{datos.get('apto') or ''}", {
+            "departamento": departamento, "clave_calle": clave, "calle": datos["calle"],
+            "numero": datos["numero"], "apto": datos.get("apto") or "", "usos": 0
+        })
+        direccion["usos"] += 1
+        direccion["esquina"] = datos.get("esquina") or ""
+        direccion["ultimo_uso"] = datos["fecha_carga"]
+        
+        if len(ops) >= MIGRATION_BATCH_SIZE:
+            await db.envios.bulk_write(ops, ordered=False)
+            migrated += len(ops)
+            ops = []
+            await asyncio.sleep(MIGRATION_PAUSE_MS / 1000)
+    if ops:
+        await db.envios.bulk_write(ops, ordered=False)
+        migrated += len(ops)
+    
+    for collection, libro in ((db.calles, calles), (db.direcciones, direcciones)):
+        if libro:
+            await collection.bulk_write(
+                [ReplaceOne({"_id": _id}, doc, upsert=True) for _id, doc in libro.items()],
+                ordered=False
+            )
+        # Drop old spellings; entries used by live requests since the scan started are kept
+        viejas = [
+            doc["_id"] async for doc in collection.find({"ultimo_uso": {"$lt": inicio}}, {"_id": 1})
+            if doc["_id"] not in libro
+        ]
+        for i in range(0, len(viejas), MIGRATION_BATCH_SIZE):
+            await collection.delete_many({"_id": {"$in": viejas[i:i + MIGRATION_BATCH_SIZE]}})
+    return migrated
+
+
+def _telefono_update(doc: dict) -> dict:
+    return {"$set": {"telefono_e164": normalizar_telefono(doc.get("telefono", ""))}}
+
+
+async def migrate_telefono_envios() -> int:
+    migrated = 0
+    for collection, build_update in (
+        (db.envios, lambda envio: touch_envio(_telefono_update(envio))),
+        # Archived envíos are not synced, no updated_at bump
+        (db.envios_archive, _telefono_update),
+        (db.message_logs, _telefono_update),
+    ):
+        migrated += await migrate_in_batches(collection, {"telefono_e164": {"$exists": False}}, {"telefono": 1}, build_update)
+    return migrated
+
+
+async def migrate_version_envios() -> int:
+    # Content is unchanged, so no touch_envio: devices do not need to sync these again
+    migrated = 0
+    for collection in (db.envios, db.envios_archive):
+        migrated += await migrate_in_batches(
+            collection, {"version": {"$exists": False}}, {"_id": 1}, lambda envio: {"$set": {"version": 1}}
+        )
+    return migrated
+
+
+async def migrate_tickets_unicos() -> int:
+    """Rename duplicate tickets (all but the oldest envío keep a -D<n> suffix) and make envios.ticket unique"""
+    duplicados = await db.envios.aggregate([
+        {"$sort": {"fecha_carga": 1}},
+        {"$group": {"_id": "$ticket", "ids": {"$push": "$id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True).to_list(None)
+    
+    ops = []
+    for grupo in duplicados:
+        for n, envio_id in enumerate(grupo["ids"][1:], start=2):
+            ops.append(UpdateOne({"id": envio_id}, touch_envio({"$set": {"ticket": f"{grupo['_id']}-D{n}"}})))
+            logger.warning(f"Duplicate ticket {grupo['_id']} of envío {envio_id} renamed to {grupo['_id']}-D{n}")
+    if ops:
+        await db.envios.bulk_write(ops, ordered=False)
+    
+    indices = await db.envios.index_information()
+    if "ticket_1" in indices:
+        await db.envios.drop_index("ticket_1")
+    await db.envios.create_index("ticket", unique=True, name="ticket_unique")
+    return len(ops)
+
+
+# Applied in order, each one once per database (recorded in the migrations collection)
+DATA_MIGRATIONS = [
+    ("fechas_envios_bson", migrate_fechas_envios),
+    ("fechas_message_logs_bson", migrate_fechas_message_logs),
+    ("updated_at_envios", migrate_updated_at_envios),
+    ("ubicacion_envios", migrate_ubicacion_envios),
+    ("courier_envios", migrate_courier_envios),
+    ("sla_envios", migrate_sla_envios),
+    ("kpi_daily_backfill", recompute_kpi_daily),
+    ("direcciones_envios", migrate_direcciones_envios),
+    ("telefono_envios", migrate_telefono_envios),
+    ("version_envios", migrate_version_envios),
+    ("tickets_unicos", migrate_tickets_unicos),
+]
+
+
+async def run_data_migrations():
+    for name, migration in DATA_MIGRATIONS:
+        if await db.migrations.find_one({"_id": name}):
+            continue
+        # One worker migrates; the lease is renewed before each migration so a crashed run is resumed later
+        if not await acquire_lease("data_migrations", MIGRATION_LEASE_SECONDS):
+            logger.info("Data migrations are running in another worker")
+            return
+        try:
+            migrated = await migration()
+        except PyMongoError as e:
+            logger.error(f"Migration {name} failed, will retry on next start: {e}")
+            return
+        await db.migrations.update_one(
+            {"_id": name},
+            {"$set": {"completed_at": datetime.now(timezone.utc), "migrated": migrated}},
+            upsert=True
+        )
+        logger.info(f"Migration {name} completed: {migrated} documents updated")
+
+
+# ============== ARCHIVAL ==============
+
+async def archive_delivered_envios(older_than_days: int, max_seconds: Optional[float] = None) -> Tuple[int, bool]:
+    """Move envíos delivered more than `older_than_days` ago into envios_archive, in batches.
+
+    Returns the number archived and whether nothing is left, which is False when `max_seconds` ran out first.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    query = {
+        "estado": "Entregado",
+        "historial_estados": {"$elemMatch": {"estado": "Entregado", "fecha": {"$lt": cutoff}}}
+    }
+    
+    archived = 0
+    while True:
+        if deadline and time.monotonic() >= deadline:
+            return archived, False
+        batch = await db.envios.find(query).to_list(ARCHIVE_BATCH_SIZE)
+        if not batch:
+            return archived, True
+        
+        # Copy first, then delete: an interruption leaves the envío in both collections, never in none,
+        # and reads check the hot collection first
+        await db.envios_archive.bulk_write(
+            [ReplaceOne({"id": envio["id"]}, envio, upsert=True) for envio in batch],
+            ordered=False
+        )
+        envio_ids = [envio["id"] for envio in batch]
+        result = await db.envios.delete_many({"id": {"$in": envio_ids}, "estado": "Entregado"})
+        # Archived envíos leave the synced working set like deleted ones
+        await add_tombstones(envio_ids)
+        archived += result.deleted_count
+        incr_metric("archive.envios", result.deleted_count)
+        await asyncio.sleep(MIGRATION_PAUSE_MS / 1000)
+
+
+async def archive_loop():
+    """Periodic archival; every worker runs the loop but only the lease holder archives"""
+    while True:
+        try:
+            if await acquire_lease("archive", ARCHIVE_INTERVAL_HOURS * 3600):
+                archived, _ = await archive_delivered_envios(ARCHIVE_AFTER_DAYS)
+                if archived:
+                    logger.info(f"Archived {archived} delivered envíos")
+        except PyMongoError as e:
+            logger.error(f"Archival failed: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
+
+
+@api_router.post("/admin/archivar")
+async def archivar_envios(
+    dias: int = ARCHIVE_AFTER_DAYS,
+    current_user: dict = Depends(require_role("admin"))
+):
+    """Archive delivered envíos now instead of waiting for the periodic run.
+
+    Bounded by ARCHIVE_REQUEST_SECONDS; `completo` is False when envíos are left to archive.
+    """
+    if dias < 1:
+        raise HTTPException(status_code=400, detail="La antigüedad mínima es de 1 día")
+    archived, completo = await archive_delivered_envios(dias, max_seconds=ARCHIVE_REQUEST_SECONDS)
+    return {"archivados": archived, "completo": completo}
+
+
 # ============== INIT ADMIN ==============
 
 @app.on_event("startup")
@@ -784,6 +3870,110 @@ async def create_default_admin():
         logging.info("Admin user created: admin / admin123")
 
 
+@app.on_event("startup")
+async def create_indexes():
+    await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_HOURS * 3600)
+    await db.sessions.create_index("id", unique=True)
+    await db.sessions.create_index("user_id")
+    await db.sessions.create_index("expires_at", expireAfterSeconds=0)
+    await db.profiles.create_index("id", unique=True)
+    await db.profiles.create_index("created_at", expireAfterSeconds=PROFILE_RETENTION_HOURS * 3600)
+    await db.envios.create_index("id", unique=True)
+    await ensure_unique_tickets()
+    await db.envios.create_index([("fecha_carga", -1)])
+    await db.envios.create_index([("estado", 1), ("fecha_carga", -1)])
+    await db.envios.create_index([("departamento", 1), ("fecha_carga", -1)])
+    await db.envios.create_index([("updated_at", 1), ("id", 1)])
+    await db.envios.create_index([("ubicacion", "2dsphere"), ("estado", 1)])
+    await db.envios.create_index([("courier_id", 1), ("estado", 1)])
+    await db.envios.create_index([("telefono_e164", 1), ("fecha_carga", -1)])
+    # The SLA report only filters on a fecha_carga range, served by the index above
+    try:
+        await db.envios.drop_index("sla_report")
+    except OperationFailure:
+        pass  # Never created or already dropped
+    await db.envio_tombstones.create_index("eliminado_at", expireAfterSeconds=SYNC_TOMBSTONE_DAYS * 86400)
+    await db.envio_tombstones.create_index([("eliminado_at", 1), ("id", 1)])
+    await db.envios_archive.create_index("id", unique=True)
+    await db.envios_archive.create_index("ticket")
+    await db.envios_archive.create_index([("fecha_carga", -1)])
+    await db.envios_archive.create_index([("telefono_e164", 1), ("fecha_carga", -1)])
+    await ensure_message_log_retention()
+    await ensure_courier_locations()
+    await db.kpi_daily.create_index([("fecha", 1), ("departamento", 1), ("motivo", 1)])
+    await db.calles.create_index([("departamento", 1), ("clave", 1)])
+    await db.direcciones.create_index([("departamento", 1), ("clave_calle", 1), ("numero", 1)])
+    await db.message_logs.create_index([("fecha", -1), ("id", -1)])
+    await db.message_logs.create_index([("envio_id", 1), ("fecha", -1)])
+    for field in ("ticket", "telefono_e164", "estado", "enviado"):
+        await db.message_logs.create_index([(field, 1), ("fecha", -1), ("id", -1)])
+
+
+async def ensure_unique_tickets():
+    """Unique index on envios.ticket; databases with duplicate tickets get it from the tickets_unicos migration"""
+    try:
+        await db.envios.create_index("ticket", unique=True, name="ticket_unique")
+    except OperationFailure:
+        logger.warning("envios.ticket is not unique yet; the tickets_unicos migration renames duplicates and adds the index")
+
+
+async def ensure_message_log_retention():
+    """Single-field index on message_logs.fecha, with a TTL when MESSAGE_LOG_RETENTION_DAYS is set"""
+    if MESSAGE_LOG_RETENTION_DAYS <= 0:
+        try:
+            await db.message_logs.create_index([("fecha", -1)])
+        except OperationFailure:
+            logger.warning("message_logs.fecha still has a TTL index; drop it to disable retention")
+        return
+    
+    expire_after = MESSAGE_LOG_RETENTION_DAYS * 86400
+    try:
+        await db.message_logs.create_index([("fecha", -1)], expireAfterSeconds=expire_after)
+    except OperationFailure:
+        # Index exists with other options (no TTL or a different retention): update it in place
+        try:
+            await db.command(
+                "collMod", "message_logs",
+                index={"keyPattern": {"fecha": -1}, "expireAfterSeconds": expire_after}
+            )
+        except OperationFailure as e:
+            logger.error(f"Could not apply message log retention: {e}")
+
+
+async def ensure_courier_locations():
+    """Time-series collection for courier pings, bucketed per courier, expiring after LOCATION_RETENTION_DAYS"""
+    try:
+        await db.create_collection(
+            "courier_locations",
+            timeseries={"timeField": "fecha", "metaField": "courier_id", "granularity": "seconds"},
+            expireAfterSeconds=LOCATION_RETENTION_DAYS * 86400
+        )
+    except CollectionInvalid:
+        pass  # Already created
+    except OperationFailure as e:
+        logger.warning(f"Could not create courier_locations as a time-series collection: {e}")
+    await db.courier_locations.create_index([("courier_id", 1), ("fecha", -1)])
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if AUTH_STATELESS:
+        await refresh_revoked_users()
+        BACKGROUND_TASKS.append(asyncio.create_task(revocation_refresh_loop()))
+    if RUN_DATA_MIGRATIONS:
+        BACKGROUND_TASKS.append(asyncio.create_task(run_data_migrations()))
+    if ARCHIVE_ENABLED:
+        BACKGROUND_TASKS.append(asyncio.create_task(archive_loop()))
+    BACKGROUND_TASKS.append(asyncio.create_task(courier_locations.flush_loop()))
+    if KPI_NIGHTLY_ENABLED:
+        BACKGROUND_TASKS.append(asyncio.create_task(kpi_nightly_loop()))
+    if LOOP_MONITOR_ENABLED:
+        BACKGROUND_TASKS.append(asyncio.create_task(loop_monitor.run()))
+    if TRACING_ENABLED:
+        BACKGROUND_TASKS.append(asyncio.create_task(span_exporter.flush_loop()))
+
+
 # Include routers
 app.include_router(api_router)
 app.include_router(auth_router)
@@ -791,6 +3981,23 @@ app.include_router(users_router)
 app.include_router(envios_router)
 app.include_router(messages_router)
 app.include_router(tracking_router)
+app.include_router(couriers_router)
+app.include_router(reports_router)
+app.include_router(direcciones_router)
+app.include_router(clientes_router)
+app.include_router(profiles_router)
+
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
+if LOOP_MONITOR_ENABLED:
+    app.add_middleware(LoopMonitorMiddleware, monitor=loop_monitor)
+
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+if TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware, tracer=tracer, sample_ratio=TRACE_SAMPLE_RATIO)
 
 app.add_middleware(
     CORSMiddleware,
@@ -798,14 +4005,24 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-Next-Cursor", "Idempotent-Replayed", "ETag", "traceparent"],
 )
 
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - ' + ('[%(trace_id)s] - ' if TRACING_ENABLED else '') + '%(message)s'
 )
+if TRACING_ENABLED:
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
 logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await courier_locations.flush()
+    await span_exporter.flush()
+    process_pool.shutdown()
+    thread_pool.shutdown()
     client.close()
@@ -1,4 +1,5 @@
-import { useState } from "react";
+import { useState, useEffect } from "react";
+import axios from "axios";
 import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
 import { Textarea } from "@/components/ui/textarea";
@@ -12,6 +13,9 @@ import {
 import { Label } from "@/components/ui/label";
 import { Save, RotateCcw, Download, Loader2 } from "lucide-react";
 
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+const API = `${BACKEND_URL}/api`;
+
 const initialFormState = {
   ticket: "",
   calle: "",
@@ -25,6 +29,36 @@ const initialFormState = {
   contacto: ""
 };
 
+// Street names already used in the departamento, most used first, fetched as the user types
+const useSugerenciasCalle = (departamento, texto) => {
+  const [calles, setCalles] = useState([]);
+
+  useEffect(() => {
+    if (!departamento) {
+      setCalles([]);
+      return;
+    }
+    let cancelado = false;
+    const timer = setTimeout(async () => {
+      try {
+        const response = await axios.get(`${API}/direcciones/calles`, {
+          params: { departamento, q: texto }
+        });
+        if (!cancelado) setCalles(response.data.calles.map((c) => c.calle));
+      } catch (error) {
+        // Suggestions are optional; the field keeps working as free text
+        if (!cancelado) setCalles([]);
+      }
+    }, 250);
+    return () => {
+      cancelado = true;
+      clearTimeout(timer);
+    };
+  }, [departamento, texto]);
+
+  return calles;
+};
+
 export const EnvioForm = ({ 
   departamentos, 
   motivos, 
@@ -35,6 +69,8 @@ export const EnvioForm = ({
   const [formData, setFormData] = useState(initialFormState);
   const [lastCreated, setLastCreated] = useState(null);
   const [errors, setErrors] = useState({});
+  const callesSugeridas = useSugerenciasCalle(formData.departamento, formData.calle);
+  const esquinasSugeridas = useSugerenciasCalle(formData.departamento, formData.esquina);
 
   const handleChange = (field, value) => {
     setFormData(prev => ({ ...prev, [field]: value }));
@@ -148,8 +184,13 @@ export const EnvioForm = ({
               value={formData.calle}
               onChange={(e) => handleChange("calle", e.target.value)}
               placeholder="Nombre de la calle"
+              list="calles-sugeridas"
+              autoComplete="off"
               className={`rounded-sm bg-slate-50 focus:bg-white focus:ring-2 focus:ring-[#FF0000]/20 focus:border-[#FF0000] ${errors.calle ? 'border-red-500' : 'border-slate-200'}`}
             />
+            <datalist id="calles-sugeridas">
+              {callesSugeridas.map((calle) => <option key={calle} value={calle} />)}
+            </datalist>
             {errors.calle && <p className="text-xs text-red-500 mt-1">{errors.calle}</p>}
           </div>
           <div>
@@ -193,8 +234,13 @@ export const EnvioForm = ({
               value={formData.esquina}
               onChange={(e) => handleChange("esquina", e.target.value)}
               placeholder="Calle de referencia"
+              list="esquinas-sugeridas"
+              autoComplete="off"
               className="rounded-sm bg-slate-50 focus:bg-white focus:ring-2 focus:ring-[#FF0000]/20 focus:border-[#FF0000] border-slate-200"
             />
+            <datalist id="esquinas-sugeridas">
+              {esquinasSugeridas.map((calle) => <option key={calle} value={calle} />)}
+            </datalist>
           </div>
         </div>
 
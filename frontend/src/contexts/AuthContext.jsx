@@ -1,5 +1,6 @@
-import { createContext, useContext, useState, useEffect } from "react";
+import { createContext, useContext, useState, useEffect, useRef } from "react";
 import axios from "axios";
+import { clearSyncedEnvios } from "@/lib/enviosSync";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -18,6 +19,7 @@ export const AuthProvider = ({ children }) => {
   const [user, setUser] = useState(null);
   const [token, setToken] = useState(localStorage.getItem("token"));
   const [loading, setLoading] = useState(true);
+  const refreshPromise = useRef(null);
 
   // Configure axios defaults
   useEffect(() => {
@@ -28,6 +30,63 @@ export const AuthProvider = ({ children }) => {
     }
   }, [token]);
 
+  // Renew the short-lived access token once on 401 and retry the request.
+  // Concurrent failures share a single refresh call.
+  useEffect(() => {
+    const refreshSession = async () => {
+      const refreshToken = localStorage.getItem("refresh_token");
+      if (!refreshToken) throw new Error("No refresh token");
+      try {
+        const response = await axios.post(`${API}/auth/refresh`, { refresh_token: refreshToken });
+        const { access_token, refresh_token } = response.data;
+        localStorage.setItem("token", access_token);
+        localStorage.setItem("refresh_token", refresh_token);
+        setToken(access_token);
+        return access_token;
+      } catch (error) {
+        // Another tab may have rotated the refresh token first
+        if (localStorage.getItem("refresh_token") !== refreshToken) {
+          const stored = localStorage.getItem("token");
+          setToken(stored);
+          return stored;
+        }
+        throw error;
+      }
+    };
+
+    const interceptor = axios.interceptors.response.use(
+      (response) => response,
+      async (error) => {
+        const original = error.config;
+        const url = original?.url || "";
+        if (
+          error.response?.status !== 401 ||
+          original._retried ||
+          url.endsWith("/auth/login") ||
+          url.endsWith("/auth/refresh")
+        ) {
+          return Promise.reject(error);
+        }
+        original._retried = true;
+        if (!refreshPromise.current) {
+          refreshPromise.current = refreshSession().finally(() => {
+            refreshPromise.current = null;
+          });
+        }
+        try {
+          const accessToken = await refreshPromise.current;
+          axios.defaults.headers.common["Authorization"] = `Bearer ${accessToken}`;
+          original.headers["Authorization"] = `Bearer ${accessToken}`;
+          return axios(original);
+        } catch (refreshError) {
+          logout();
+          return Promise.reject(error);
+        }
+      }
+    );
+    return () => axios.interceptors.response.eject(interceptor);
+  }, []);
+
   // Check auth on mount
   useEffect(() => {
     const checkAuth = async () => {
@@ -48,9 +107,10 @@ export const AuthProvider = ({ children }) => {
 
   const login = async (username, password) => {
     const response = await axios.post(`${API}/auth/login`, { username, password });
-    const { access_token, user: userData } = response.data;
+    const { access_token, refresh_token, user: userData } = response.data;
     
     localStorage.setItem("token", access_token);
+    localStorage.setItem("refresh_token", refresh_token);
     setToken(access_token);
     setUser(userData);
     
@@ -58,7 +118,13 @@ export const AuthProvider = ({ children }) => {
   };
 
   const logout = () => {
+    const refreshToken = localStorage.getItem("refresh_token");
+    if (refreshToken) {
+      axios.post(`${API}/auth/logout`, { refresh_token: refreshToken }).catch(() => {});
+    }
     localStorage.removeItem("token");
+    localStorage.removeItem("refresh_token");
+    clearSyncedEnvios();
     setToken(null);
     setUser(null);
     delete axios.defaults.headers.common["Authorization"];
@@ -0,0 +1,123 @@
+import axios from "axios";
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+const API = `${BACKEND_URL}/api`;
+const STORAGE_KEY = "envios_sync";
+
+const loadStore = () => {
+  try {
+    return JSON.parse(localStorage.getItem(STORAGE_KEY)) || { token: null, envios: {} };
+  } catch {
+    return { token: null, envios: {} };
+  }
+};
+
+const saveStore = (store) => {
+  try {
+    localStorage.setItem(STORAGE_KEY, JSON.stringify(store));
+  } catch {
+    // Quota exceeded: keep the copy for this session only
+    localStorage.removeItem(STORAGE_KEY);
+  }
+};
+
+let memoryStore = null;
+
+const sortedEnvios = (store) =>
+  Object.values(store.envios).sort((a, b) => b.fecha_carga.localeCompare(a.fecha_carga));
+
+// Local copy as of the last successful sync, for use without connection
+export const cachedEnvios = () => sortedEnvios(memoryStore || loadStore());
+
+// Bring the local copy of envíos up to date with /envios/sync and return it, newest first
+export const syncEnvios = async () => {
+  const store = memoryStore || loadStore();
+  let hasMore = true;
+  while (hasMore) {
+    const params = store.token ? { since: store.token } : {};
+    const { data } = await axios.get(`${API}/envios/sync`, { params });
+    if (data.reset) store.envios = {};
+    data.envios.forEach((envio) => {
+      store.envios[envio.id] = envio;
+    });
+    data.eliminados.forEach((id) => {
+      delete store.envios[id];
+    });
+    store.token = data.token;
+    hasMore = data.has_more;
+  }
+  memoryStore = store;
+  saveStore(store);
+  return sortedEnvios(store);
+};
+
+export const clearSyncedEnvios = () => {
+  memoryStore = null;
+  localStorage.removeItem(STORAGE_KEY);
+};
+
+// Same filters as GET /envios, applied to the local copy
+export const filterEnvios = (envios, filters) =>
+  envios.filter((envio) => {
+    const fecha = envio.fecha_carga.slice(0, 10);
+    return (
+      (!filters.departamento || envio.departamento === filters.departamento) &&
+      (!filters.motivo || envio.motivo === filters.motivo) &&
+      (!filters.estado || envio.estado === filters.estado) &&
+      (!filters.fecha_desde || fecha >= filters.fecha_desde) &&
+      (!filters.fecha_hasta || fecha <= filters.fecha_hasta)
+    );
+  });
+
+const QUEUE_KEY = "cambios_pendientes";
+const BATCH_SIZE = 500;
+// Photos taken offline travel inline as data URLs and count against the ~5MB localStorage quota
+const MAX_QUEUED_IMAGE = 1024 * 1024;
+
+// One queue per user, so a courier logging in on a shared device never sends someone else's changes
+const queueKey = (usuarioId) => `${QUEUE_KEY}:${usuarioId}`;
+
+export const pendingCambios = (usuarioId) => {
+  try {
+    return JSON.parse(localStorage.getItem(queueKey(usuarioId))) || [];
+  } catch {
+    return [];
+  }
+};
+
+// Keep a state change made without connection; estado_base lets the server detect conflicts.
+// Returns whether it was stored, and whether its photo had to be left out for being too large
+export const queueCambio = (usuarioId, envio, payload) => {
+  const sinFoto = (payload.imagen_url?.length || 0) > MAX_QUEUED_IMAGE;
+  const cambios = pendingCambios(usuarioId);
+  cambios.push({
+    ...payload,
+    ...(sinFoto && { imagen_url: null }),
+    cambio_id: crypto.randomUUID(),
+    envio_id: envio.id,
+    fecha_cliente: new Date().toISOString(),
+    estado_base: envio.estado
+  });
+  try {
+    localStorage.setItem(queueKey(usuarioId), JSON.stringify(cambios));
+  } catch {
+    // Quota exceeded: the change is not kept
+    return { guardado: false, sinFoto };
+  }
+  return { guardado: true, sinFoto };
+};
+
+// Send the user's queued changes in order; returns the ones the server could not apply
+export const flushCambios = async (usuarioId) => {
+  const rechazados = [];
+  let cambios = pendingCambios(usuarioId);
+  while (cambios.length) {
+    const lote = cambios.slice(0, BATCH_SIZE);
+    const { data } = await axios.post(`${API}/envios/estados/lote`, { cambios: lote });
+    rechazados.push(...data.resultados.filter((r) => r.resultado === "conflicto" || r.resultado === "error"));
+    const enviados = new Set(lote.map((c) => c.cambio_id));
+    cambios = pendingCambios(usuarioId).filter((c) => !enviados.has(c.cambio_id));
+    localStorage.setItem(queueKey(usuarioId), JSON.stringify(cambios));
+  }
+  return rechazados;
+};
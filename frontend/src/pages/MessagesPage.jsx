@@ -11,6 +11,7 @@ import {
   TableRow,
 } from "@/components/ui/table";
 import { ScrollArea } from "@/components/ui/scroll-area";
+import { Button } from "@/components/ui/button";
 import { MessageSquare, Clock, Phone, CheckCircle, XCircle } from "lucide-react";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
@@ -19,12 +20,15 @@ const API = `${BACKEND_URL}/api`;
 export default function MessagesPage() {
   const [messages, setMessages] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     const fetchMessages = async () => {
       try {
         const response = await axios.get(`${API}/messages?limit=100`);
         setMessages(response.data);
+        setNextCursor(response.headers["x-next-cursor"] || null);
       } catch (error) {
         console.error("Error fetching messages:", error);
         toast.error("Error al cargar mensajes");
@@ -36,6 +40,22 @@ export default function MessagesPage() {
     fetchMessages();
   }, []);
 
+  const loadMore = async () => {
+    setLoadingMore(true);
+    try {
+      const response = await axios.get(`${API}/messages`, {
+        params: { limit: 100, cursor: nextCursor }
+      });
+      setMessages((prev) => [...prev, ...response.data]);
+      setNextCursor(response.headers["x-next-cursor"] || null);
+    } catch (error) {
+      console.error("Error fetching messages:", error);
+      toast.error("Error al cargar mensajes");
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const formatDate = (isoString) => {
     const date = new Date(isoString);
     return new Intl.DateTimeFormat('es-UY', {
@@ -164,6 +184,18 @@ export default function MessagesPage() {
                     ))}
                   </TableBody>
                 </Table>
+                {nextCursor && (
+                  <div className="flex justify-center py-4">
+                    <Button
+                      variant="outline"
+                      onClick={loadMore}
+                      disabled={loadingMore}
+                      data-testid="load-more-messages"
+                    >
+                      {loadingMore ? "Cargando..." : "Cargar más"}
+                    </Button>
+                  </div>
+                )}
               </ScrollArea>
             )}
           </div>
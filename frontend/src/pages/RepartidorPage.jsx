@@ -4,6 +4,7 @@ import { toast } from "sonner";
 import { useAuth } from "@/contexts/AuthContext";
 import { AppHeader } from "@/components/AppHeader";
 import { EnvioFilters } from "@/components/EnvioFilters";
+import { syncEnvios, cachedEnvios, filterEnvios, queueCambio, flushCambios } from "@/lib/enviosSync";
 import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
 import { Label } from "@/components/ui/label";
@@ -24,7 +25,7 @@ import {
   DialogDescription,
 } from "@/components/ui/dialog";
 import { ScrollArea } from "@/components/ui/scroll-area";
-import { Bike, Filter, PackageCheck, Truck, Loader2, MapPin, Phone, Clock, Camera, X, Link, Check } from "lucide-react";
+import { Bike, Filter, PackageCheck, Truck, Loader2, MapPin, Phone, Clock, Camera, X, Link, Check, Navigation } from "lucide-react";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -38,6 +39,8 @@ export default function RepartidorPage() {
   const [loading, setLoading] = useState(true);
   const [showFilters, setShowFilters] = useState(false);
   const [copiedId, setCopiedId] = useState(null);
+  const [cercanos, setCercanos] = useState(null);
+  const [locating, setLocating] = useState(false);
   const [filters, setFilters] = useState({
     departamento: "",
     motivo: "",
@@ -60,25 +63,31 @@ export default function RepartidorPage() {
   const [uploadingImage, setUploadingImage] = useState(false);
   const fileInputRef = useRef(null);
 
-  const buildQueryString = (params) => {
-    const query = new URLSearchParams();
-    Object.entries(params).forEach(([key, value]) => {
-      if (value) query.append(key, value);
-    });
-    return query.toString();
-  };
-
-  const fetchEnvios = async (filterParams = filters) => {
+  // Only changes since the last visit are downloaded; filters apply to the local copy
+  const fetchEnvios = async () => {
     try {
-      const queryString = buildQueryString(filterParams);
-      const response = await axios.get(`${API}/envios?limit=50${queryString ? '&' + queryString : ''}`);
-      setEnvios(response.data);
+      setEnvios(await syncEnvios());
     } catch (error) {
+      if (!error.response) {
+        setEnvios(cachedEnvios());
+        return;
+      }
       console.error("Error fetching envios:", error);
       toast.error("Error al cargar los envíos");
     }
   };
 
+  // Send state changes queued while offline, then refresh the local copy
+  const flushPending = async () => {
+    try {
+      const rechazados = await flushCambios(user.id);
+      rechazados.forEach((r) => toast.error(`Cambio no aplicado: ${r.detalle}`));
+    } catch (error) {
+      console.error("Error sending queued changes:", error);
+    }
+    await fetchEnvios();
+  };
+
   useEffect(() => {
     const fetchData = async () => {
       try {
@@ -89,21 +98,22 @@ export default function RepartidorPage() {
         
         setDepartamentos(depRes.data.departamentos);
         setMotivos(motivosRes.data.motivos);
-        await fetchEnvios();
       } catch (error) {
         console.error("Error fetching data:", error);
         toast.error("Error al cargar los datos");
-      } finally {
-        setLoading(false);
       }
+      await flushPending();
+      setLoading(false);
     };
 
     fetchData();
+    window.addEventListener("online", flushPending);
+    return () => window.removeEventListener("online", flushPending);
   }, []);
 
   const handleFilterChange = (newFilters) => {
     setFilters(newFilters);
-    fetchEnvios(newFilters);
+    fetchEnvios();
   };
 
   const handleClearFilters = () => {
@@ -115,9 +125,78 @@ export default function RepartidorPage() {
       fecha_hasta: ""
     };
     setFilters(emptyFilters);
-    fetchEnvios(emptyFilters);
+    fetchEnvios();
   };
 
+  // Open envíos closest to the courier's current position, instead of the filtered list
+  const toggleCercanos = () => {
+    if (cercanos) {
+      setCercanos(null);
+      return;
+    }
+    if (!navigator.geolocation) {
+      toast.error("El dispositivo no permite obtener la ubicación");
+      return;
+    }
+    setLocating(true);
+    navigator.geolocation.getCurrentPosition(
+      async ({ coords }) => {
+        try {
+          const response = await axios.get(`${API}/envios/cercanos`, {
+            params: { lat: coords.latitude, lng: coords.longitude, ...(filters.estado && { estado: filters.estado }) }
+          });
+          setCercanos(response.data);
+        } catch (error) {
+          console.error("Error fetching nearby envios:", error);
+          toast.error("Error al buscar envíos cercanos");
+        } finally {
+          setLocating(false);
+        }
+      },
+      () => {
+        toast.error("No se pudo obtener la ubicación");
+        setLocating(false);
+      }
+    );
+  };
+
+  // While carrying envíos, report the device position in batches
+  const enCamino = envios.some((e) => e.estado === "Asignado a courier" && e.courier_id === user?.id);
+  useEffect(() => {
+    if (!enCamino || !navigator.geolocation) return;
+    let puntos = [];
+    const watchId = navigator.geolocation.watchPosition(
+      ({ coords, timestamp }) => {
+        puntos.push({
+          lat: coords.latitude,
+          lng: coords.longitude,
+          fecha: new Date(timestamp).toISOString(),
+          precision_m: coords.accuracy
+        });
+        puntos = puntos.slice(-500);
+      },
+      (error) => console.error("Error watching position:", error),
+      { enableHighAccuracy: true, maximumAge: 5000 }
+    );
+    const interval = setInterval(async () => {
+      if (!puntos.length) return;
+      const lote = puntos;
+      puntos = [];
+      try {
+        await axios.post(`${API}/couriers/ubicaciones`, { puntos: lote });
+      } catch (error) {
+        // Keep them for the next attempt
+        puntos = [...lote, ...puntos].slice(-500);
+      }
+    }, 15000);
+    return () => {
+      navigator.geolocation.clearWatch(watchId);
+      clearInterval(interval);
+    };
+  }, [enCamino]);
+
+  const visibleEnvios = cercanos || filterEnvios(envios, filters).slice(0, 50);
+
   const copyTrackingLink = async (ticket, envioId) => {
     const link = `${FRONTEND_URL}/rastreo/${ticket}`;
     try {
@@ -204,6 +283,8 @@ export default function RepartidorPage() {
       
       return response.data.imagen_url;
     } catch (error) {
+      // Offline: the photo travels inline with the queued change
+      if (!error.response) return imagePreview;
       console.error("Error uploading image:", error);
       toast.error("Error al subir la imagen");
       return null;
@@ -253,14 +334,37 @@ export default function RepartidorPage() {
         })
       };
 
-      const response = await axios.patch(`${API}/envios/${selectedEnvio.id}/estado`, payload);
+      let updatedEnvio;
+      let offline = false;
+      try {
+        const response = await axios.patch(`${API}/envios/${selectedEnvio.id}/estado`, payload);
+        updatedEnvio = response.data;
+      } catch (error) {
+        if (error.response) throw error;
+        // No connection: queue the change and show it locally until it is sent
+        const { guardado, sinFoto } = queueCambio(user.id, selectedEnvio, payload);
+        if (!guardado) {
+          toast.error("Sin conexión y sin espacio en el dispositivo para guardar el cambio. Intente más tarde.");
+          return;
+        }
+        if (sinFoto) {
+          toast.warning("La foto es muy grande para guardarla sin conexión; el cambio se enviará sin ella.");
+        }
+        updatedEnvio = { ...selectedEnvio, estado: nuevoEstado };
+        offline = true;
+      }
       
       setEnvios(prev => prev.map(e => 
-        e.id === selectedEnvio.id ? response.data : e
+        e.id === selectedEnvio.id ? updatedEnvio : e
+      ));
+      setCercanos(prev => prev && prev.map(e =>
+        e.id === selectedEnvio.id ? { ...updatedEnvio, distancia_m: e.distancia_m } : e
       ));
 
       let message;
-      if (modalAction === "asignar") {
+      if (offline) {
+        message = "Sin conexión. El cambio se enviará al recuperar la señal.";
+      } else if (modalAction === "asignar") {
         message = "Envío asignado. Se notificará al cliente por WhatsApp.";
       } else if (modalAction === "entregar") {
         message = "Envío entregado. Se notificará al cliente por WhatsApp.";
@@ -334,16 +438,33 @@ export default function RepartidorPage() {
                 </div>
               </div>
               
-              <Button
-                onClick={() => setShowFilters(!showFilters)}
-                variant="outline"
-                size="sm"
-                className="rounded-sm border-slate-200 hover:bg-slate-100"
-                data-testid="toggle-filters-btn"
-              >
-                <Filter className="w-4 h-4 mr-2" strokeWidth={1.5} />
-                Filtros
-              </Button>
+              <div className="flex gap-2">
+                <Button
+                  onClick={toggleCercanos}
+                  variant="outline"
+                  size="sm"
+                  disabled={locating}
+                  className={`rounded-sm border-slate-200 hover:bg-slate-100 ${cercanos ? 'bg-slate-100' : ''}`}
+                  data-testid="toggle-cercanos-btn"
+                >
+                  {locating ? (
+                    <Loader2 className="w-4 h-4 mr-2 animate-spin" strokeWidth={1.5} />
+                  ) : (
+                    <Navigation className="w-4 h-4 mr-2" strokeWidth={1.5} />
+                  )}
+                  Cerca de mí
+                </Button>
+                <Button
+                  onClick={() => setShowFilters(!showFilters)}
+                  variant="outline"
+                  size="sm"
+                  className="rounded-sm border-slate-200 hover:bg-slate-100"
+                  data-testid="toggle-filters-btn"
+                >
+                  <Filter className="w-4 h-4 mr-2" strokeWidth={1.5} />
+                  Filtros
+                </Button>
+              </div>
             </div>
             
             {showFilters && (
@@ -360,7 +481,7 @@ export default function RepartidorPage() {
           <div className="p-2 sm:p-4 md:p-6">
             {loading ? (
               <div className="text-center py-12 text-slate-500">Cargando...</div>
-            ) : envios.length === 0 ? (
+            ) : visibleEnvios.length === 0 ? (
               <div className="text-center py-12">
                 <MapPin className="w-12 h-12 mx-auto text-slate-300 mb-4" strokeWidth={1} />
                 <p className="text-slate-500 font-medium">No hay envíos</p>
@@ -372,7 +493,7 @@ export default function RepartidorPage() {
               <ScrollArea className="h-[500px] sm:h-[600px]">
                 {/* Mobile Cards View */}
                 <div className="block lg:hidden space-y-3">
-                  {envios.map((envio) => (
+                  {visibleEnvios.map((envio) => (
                     <div 
                       key={envio.id}
                       className="bg-white border border-slate-200 rounded-lg p-4"
@@ -396,7 +517,10 @@ export default function RepartidorPage() {
                             <p className="font-medium text-slate-700">
                               {envio.calle} {envio.numero}{envio.apto && `, ${envio.apto}`}
                             </p>
-                            <p className="text-xs text-slate-500">{envio.departamento}</p>
+                            <p className="text-xs text-slate-500">
+                              {envio.departamento}
+                              {envio.distancia_m != null && ` · a ${(envio.distancia_m / 1000).toFixed(1)} km`}
+                            </p>
                           </div>
                         </div>
                         
@@ -514,7 +638,7 @@ export default function RepartidorPage() {
                     </TableRow>
                   </TableHeader>
                   <TableBody>
-                    {envios.map((envio) => (
+                    {visibleEnvios.map((envio) => (
                       <TableRow 
                         key={envio.id} 
                         className="border-b border-slate-100"
@@ -1,7 +1,7 @@
 import { useState, useEffect } from "react";
 import { useParams } from "react-router-dom";
 import axios from "axios";
-import { Package, MapPin, Phone, User, Clock, CheckCircle, Truck, FileText } from "lucide-react";
+import { Package, MapPin, Phone, User, Clock, CheckCircle, Truck, FileText, Navigation } from "lucide-react";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -33,6 +33,20 @@ export default function TrackingPage() {
     }
   }, [ticket]);
 
+  // Refresh the courier position while the envío is on its way
+  useEffect(() => {
+    if (envio?.estado !== "Asignado a courier") return;
+    const interval = setInterval(async () => {
+      try {
+        const response = await axios.get(`${API}/tracking/${ticket}`);
+        setEnvio(response.data);
+      } catch (err) {
+        console.error("Error refreshing tracking:", err);
+      }
+    }, 30000);
+    return () => clearInterval(interval);
+  }, [ticket, envio?.estado]);
+
   const getEstadoInfo = (estado) => {
     switch (estado) {
       case "Ingresada":
@@ -151,6 +165,26 @@ export default function TrackingPage() {
                 </div>
               </div>
 
+              {envio.ubicacion_courier && (
+                <div className="flex items-start gap-3">
+                  <Navigation className="w-5 h-5 text-amber-500 mt-0.5 flex-shrink-0" strokeWidth={1.5} />
+                  <div>
+                    <a
+                      href={`https://www.openstreetmap.org/?mlat=${envio.ubicacion_courier.lat}&mlon=${envio.ubicacion_courier.lng}#map=16/${envio.ubicacion_courier.lat}/${envio.ubicacion_courier.lng}`}
+                      target="_blank"
+                      rel="noopener noreferrer"
+                      className="text-sm font-medium text-amber-700 underline"
+                      data-testid="ubicacion-courier-link"
+                    >
+                      Ver dónde está tu cadete
+                    </a>
+                    <p className="text-xs text-slate-500">
+                      Actualizado: {formatDate(envio.ubicacion_courier.fecha)}
+                    </p>
+                  </div>
+                </div>
+              )}
+
               <div className="flex items-center gap-3">
                 <User className="w-5 h-5 text-slate-400 flex-shrink-0" strokeWidth={1.5} />
                 <p className="text-sm text-slate-700">{envio.contacto}</p>
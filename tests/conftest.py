@@ -0,0 +1,80 @@
+"""
+Shared fixtures: one admin login for the whole run.
+
+Logins are rate limited per user (RATE_LIMIT_LOGIN_USER_BURST / _PER_MINUTE, 5 per minute by
+default), so modules must not log in on their own. Raise those limits in the test environment
+when more logins are needed. A 429 on login fails the run instead of skipping the tests.
+"""
+import pytest
+import requests
+import os
+import sys
+from pathlib import Path
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+ADMIN_CREDENTIALS = {"username": "admin", "password": "admin123"}
+
+BACKEND_DIR = Path(__file__).parent.parent / "backend"
+
+
+def login(credentials: dict) -> dict:
+    """Login response body; fails on rate limiting, skips when the credentials are not accepted"""
+    response = requests.post(f"{API_URL}/auth/login", json=credentials)
+    if response.status_code == 429:
+        pytest.fail(
+            f"Login rate limited for {credentials['username']} (Retry-After {response.headers.get('Retry-After')}s); "
+            "raise RATE_LIMIT_LOGIN_USER_BURST / RATE_LIMIT_LOGIN_IP_BURST for the test server"
+        )
+    if response.status_code != 200:
+        pytest.skip(f"Authentication failed for {credentials['username']}: {response.status_code}")
+    return response.json()
+
+
+def auth_session(token: str) -> requests.Session:
+    session = requests.Session()
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {token}"
+    })
+    return session
+
+
+@pytest.fixture(scope="session")
+def admin_token():
+    """Admin access token shared by every module"""
+    return login(ADMIN_CREDENTIALS)["access_token"]
+
+
+@pytest.fixture(scope="session")
+def admin_client(admin_token):
+    """Session with admin auth header"""
+    return auth_session(admin_token)
+
+
+@pytest.fixture(scope="session")
+def mongo_db():
+    """Database of the test server, for states the API cannot produce (e.g. deliveries months old)"""
+    if not os.environ.get('MONGO_URL') or not os.environ.get('DB_NAME'):
+        pytest.skip("MONGO_URL / DB_NAME of the test server not set")
+    from pymongo import MongoClient
+    client = MongoClient(os.environ['MONGO_URL'])
+    yield client[os.environ['DB_NAME']]
+    client.close()
+
+
+@pytest.fixture(scope="session")
+def server():
+    """backend/server.py imported in-process for unit tests; importing it opens no Mongo connection"""
+    defaults = {'MONGO_URL': 'mongodb://localhost:27017', 'DB_NAME': 'test_unit', 'JWT_SECRET': 'test-unit'}
+    missing = {name: value for name, value in defaults.items() if name not in os.environ}
+    os.environ.update(missing)
+    sys.path.insert(0, str(BACKEND_DIR))
+    try:
+        import server as server_module
+    finally:
+        # Settings are read on import; do not leak the placeholders into mongo_db
+        for name in missing:
+            del os.environ[name]
+    return server_module
@@ -0,0 +1,85 @@
+"""
+Test suite for archiving delivered envíos (/api/admin/archivar)
+Tests that old deliveries move to envios_archive and stay readable
+"""
+import pytest
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+@pytest.fixture
+def entregado_antiguo(admin_client, mongo_db):
+    """Envío delivered 30 days ago; the delivery date is backdated directly in Mongo"""
+    response = admin_client.post(f"{API_URL}/envios", json={
+        "ticket": f"TEST-ARCH-{uuid.uuid4().hex[:8]}",
+        "calle": "Yaguarón",
+        "numero": "1100",
+        "motivo": "Entrega",
+        "departamento": "Montevideo",
+        "telefono": "099333222",
+        "contacto": "Archivo Test"
+    })
+    assert response.status_code == 200
+    envio = response.json()
+    for cambio in [
+        {"nuevo_estado": "Asignado a courier"},
+        {"nuevo_estado": "Entregado", "receptor_nombre": "Ana", "receptor_cedula": "12345678"},
+    ]:
+        assert admin_client.patch(f"{API_URL}/envios/{envio['id']}/estado", json=cambio).status_code == 200
+    
+    hace_un_mes = datetime.now(timezone.utc) - timedelta(days=30)
+    mongo_db.envios.update_one({"id": envio["id"]}, {"$set": {"historial_estados.$[].fecha": hace_un_mes}})
+    yield envio
+    admin_client.delete(f"{API_URL}/envios/{envio['id']}")
+
+
+class TestArchivar:
+    """Test POST /api/admin/archivar and reads of archived envíos"""
+
+    def test_archive_old_delivery(self, admin_client, mongo_db, entregado_antiguo):
+        response = admin_client.post(f"{API_URL}/admin/archivar", params={"dias": 7})
+        assert response.status_code == 200, f"Archival failed: {response.text}"
+        assert response.json()["archivados"] >= 1
+        assert response.json()["completo"] is True
+
+        assert mongo_db.envios.find_one({"id": entregado_antiguo["id"]}) is None
+        assert mongo_db.envios_archive.find_one({"id": entregado_antiguo["id"]}) is not None
+        print("✓ Old delivery moved to the archive")
+
+        # Detail reads fall back to the archive
+        response = admin_client.get(f"{API_URL}/envios/{entregado_antiguo['id']}")
+        assert response.status_code == 200
+        assert response.json()["ticket"] == entregado_antiguo["ticket"]
+        print("✓ Archived envío still readable")
+
+    def test_export_include_archived(self, admin_client, entregado_antiguo):
+        assert admin_client.post(f"{API_URL}/admin/archivar", params={"dias": 7}).status_code == 200
+        params = {"estado": "Entregado"}
+
+        hot = admin_client.get(f"{API_URL}/envios/export/csv", params=params)
+        assert hot.status_code == 200
+        assert entregado_antiguo["ticket"] not in hot.text
+
+        todos = admin_client.get(f"{API_URL}/envios/export/csv", params={**params, "include_archived": "true"})
+        assert todos.status_code == 200
+        assert entregado_antiguo["ticket"] in todos.text
+        print("✓ include_archived adds archived envíos to the export")
+
+    def test_recent_delivery_kept(self, admin_client, mongo_db, entregado_antiguo):
+        """Deliveries newer than `dias` stay in the hot collection"""
+        response = admin_client.post(f"{API_URL}/admin/archivar", params={"dias": 60})
+        assert response.status_code == 200
+        assert mongo_db.envios.find_one({"id": entregado_antiguo["id"]}) is not None
+        print("✓ Recent delivery not archived")
+
+    def test_minimum_age(self, admin_client):
+        assert admin_client.post(f"{API_URL}/admin/archivar", params={"dias": 0}).status_code == 400
+        print("✓ Age below one day rejected")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,126 @@
+"""
+Test suite for stateless access tokens (AUTH_STATELESS) and the revocation set
+Unit tests for get_current_user answering from token claims and rejecting revoked users
+"""
+import pytest
+import asyncio
+from types import SimpleNamespace
+
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+USER = {
+    "id": "u-agente", "username": "agente1", "nombre": "Agente Uno", "rol": "agente",
+    "activo": True, "created_at": "2026-01-01T00:00:00+00:00"
+}
+
+
+class FakeUsers:
+    """users collection holding `activos`; counts lookups so tests can tell claims from Mongo reads"""
+
+    def __init__(self, activos=(), inactivos=()):
+        self.activos = {u["id"]: u for u in activos}
+        self.inactivos = set(inactivos)
+        self.lookups = 0
+
+    async def find_one(self, filter, projection=None):
+        self.lookups += 1
+        return self.activos.get(filter["id"]) if filter.get("activo") else None
+
+    async def distinct(self, field, filter):
+        return sorted(self.inactivos)
+
+
+@pytest.fixture
+def users(server, monkeypatch):
+    users = FakeUsers(activos=[USER])
+    monkeypatch.setattr(server, "db", SimpleNamespace(users=users))
+    monkeypatch.setattr(server, "AUTH_STATELESS", True)
+    monkeypatch.setattr(server, "REVOKED_USER_IDS", set())
+    return users
+
+
+def current_user(server, token):
+    return asyncio.run(server.get_current_user(HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)))
+
+
+def rejected(server, token) -> str:
+    with pytest.raises(HTTPException) as error:
+        current_user(server, token)
+    assert error.value.status_code == 401
+    return error.value.detail
+
+
+class TestStatelessAuth:
+    """Test users answered from the token claims"""
+
+    def test_claims_without_lookup(self, server, users):
+        user = current_user(server, server.create_token(USER))
+        assert {k: user[k] for k in ("id", "username", "nombre", "rol")} == {
+            k: USER[k] for k in ("id", "username", "nombre", "rol")
+        }
+        assert users.lookups == 0
+        print("✓ Stateless token answered without Mongo")
+
+    def test_revoked_user_rejected(self, server, users):
+        server.REVOKED_USER_IDS.add(USER["id"])
+        assert rejected(server, server.create_token(USER)) == "Usuario no encontrado"
+        print("✓ Revoked user rejected")
+
+    def test_token_issued_before_revocation(self, server, users):
+        """A token that worked stops working once its user is revoked, without waiting for it to expire"""
+        token = server.create_token(USER)
+        assert current_user(server, token)["id"] == USER["id"]
+
+        server.REVOKED_USER_IDS.add(USER["id"])
+        rejected(server, token)
+        print("✓ Earlier token rejected after revocation")
+
+    def test_user_deleted_in_other_worker(self, server, users):
+        """Deletions made through another worker arrive with the next refresh of the set"""
+        token = server.create_token(USER)
+        users.inactivos.add(USER["id"])
+        assert current_user(server, token)["id"] == USER["id"]
+
+        asyncio.run(server.refresh_revoked_users())
+        assert server.REVOKED_USER_IDS == {USER["id"]}
+        rejected(server, token)
+        print("✓ Deleted user rejected after the revocation refresh")
+
+    def test_refresh_drops_reactivated(self, server, users):
+        server.REVOKED_USER_IDS.update({USER["id"], "u-otro"})
+        asyncio.run(server.refresh_revoked_users())
+        assert server.REVOKED_USER_IDS == set()
+        print("✓ Revocation set replaced on refresh")
+
+
+class TestLegacyTokens:
+    """Test tokens without the stateless claims, and the stateful mode"""
+
+    def test_token_without_claims_looks_up_user(self, server, users):
+        token = server.jwt.encode({"sub": USER["id"]}, server.JWT_SECRET, algorithm=server.JWT_ALGORITHM)
+        assert current_user(server, token)["id"] == USER["id"]
+        assert users.lookups == 1
+
+        del users.activos[USER["id"]]
+        rejected(server, token)
+        print("✓ Claim-less token checked against Mongo")
+
+    def test_stateful_mode_rejects_deleted_user(self, server, users, monkeypatch):
+        monkeypatch.setattr(server, "AUTH_STATELESS", False)
+        token = server.create_token(USER)
+        del users.activos[USER["id"]]
+        assert rejected(server, token) == "Usuario no encontrado"
+        print("✓ Deleted user rejected in stateful mode")
+
+    def test_invalid_and_expired(self, server, users):
+        assert rejected(server, "no-es-un-jwt") == "Token inválido"
+        expired = server.jwt.encode(
+            {"sub": USER["id"], "exp": 1}, server.JWT_SECRET, algorithm=server.JWT_ALGORITHM
+        )
+        assert rejected(server, expired) == "Token expirado"
+        print("✓ Invalid and expired tokens rejected")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
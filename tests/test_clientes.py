@@ -0,0 +1,54 @@
+"""
+Test suite for customer lookup by phone number (/api/clientes/{telefono}/envios)
+Tests that the same number typed in different formats finds the same customer
+"""
+import pytest
+import os
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+class TestClienteEnvios:
+    """Test the customer shipment history"""
+
+    def test_formats_find_same_customer(self, admin_client):
+        """Envíos loaded with differently typed numbers are returned together"""
+        # Random mobile number so earlier runs do not interfere
+        numero = f"09{uuid.uuid4().int % 10**7:07d}"
+        formatos = [f"{numero[:3]} {numero[3:6]} {numero[6:]}", f"+598{numero[1:]}", numero]
+
+        ids = []
+        for telefono in formatos:
+            response = admin_client.post(f"{API_URL}/envios", json={
+                "ticket": f"TEST-CLI-{uuid.uuid4().hex[:8]}",
+                "calle": "Mercedes",
+                "numero": "1200",
+                "motivo": "Entrega",
+                "departamento": "Montevideo",
+                "telefono": telefono,
+                "contacto": "Cliente Test"
+            })
+            assert response.status_code == 200, f"Failed to create envío: {response.text}"
+            assert response.json()["telefono_e164"] == f"+598{numero[1:]}"
+            ids.append(response.json()["id"])
+
+        response = admin_client.get(f"{API_URL}/clientes/{numero}/envios")
+        assert response.status_code == 200, f"Lookup failed: {response.text}"
+        assert sorted(e["id"] for e in response.json()) == sorted(ids)
+        # Only the fields of the envío model, as on the other list endpoints
+        assert all("sla" not in e and "_id" not in e for e in response.json())
+
+        for envio_id in ids:
+            admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Customer found in every phone format")
+
+    def test_invalid_phone(self, admin_client):
+        response = admin_client.get(f"{API_URL}/clientes/123/envios")
+        assert response.status_code == 400
+        print("✓ Invalid phone rejected")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,132 @@
+"""
+Test suite for negotiated response compression (CompressionMiddleware)
+Unit tests over a small Starlette app through httpx's ASGITransport
+"""
+import pytest
+import asyncio
+import gzip
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+GRANDE = {"envios": [{"ticket": f"T-{n}", "calle": "Avenida 18 de Julio"} for n in range(100)]}
+CHUNKS = [b"Ticket,Estado\n"] + [f"T-{n},Entregado\n".encode() for n in range(200)]
+
+
+async def grande(request):
+    return JSONResponse(GRANDE)
+
+
+async def chico(request):
+    return JSONResponse({"ok": True})
+
+
+async def stream(request):
+    async def chunks():
+        for chunk in CHUNKS:
+            yield chunk
+    return StreamingResponse(chunks(), media_type="text/csv")
+
+
+async def imagen(request):
+    return Response(b"\x89PNG" + bytes(4096), media_type="image/png")
+
+
+async def no_modificado(request):
+    return Response(status_code=304, headers={"ETag": '"v1"'})
+
+
+@pytest.fixture
+def client(server):
+    app = Starlette(routes=[
+        Route("/grande", grande), Route("/chico", chico), Route("/stream", stream),
+        Route("/imagen", imagen), Route("/no-modificado", no_modificado)
+    ])
+    return httpx.ASGITransport(app=server.CompressionMiddleware(app, minimum_size=1024))
+
+
+def get(transport, path, accept_encoding):
+    """Response of a GET with the given Accept-Encoding, and its decoded body"""
+    async def fetch():
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.get(path, headers={"Accept-Encoding": accept_encoding})
+            return response, response.content
+    return asyncio.run(fetch())
+
+
+class TestCompression:
+    """Test when responses are compressed"""
+
+    def test_large_response_compressed(self, client):
+        response, body = get(client, "/grande", "gzip")
+        assert response.headers["content-encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["vary"]
+        assert int(response.headers["content-length"]) < len(body)
+        assert response.json() == GRANDE
+        print("✓ Large response compressed")
+
+    def test_below_threshold_not_compressed(self, client):
+        response, body = get(client, "/chico", "gzip")
+        assert "content-encoding" not in response.headers
+        assert "Accept-Encoding" in response.headers["vary"]
+        assert response.json() == {"ok": True}
+        print("✓ Small response sent as is")
+
+    def test_q_zero_refused(self, client, server):
+        for accept_encoding in ("gzip;q=0", "br;q=0, gzip;q=0", "identity"):
+            response, _ = get(client, "/grande", accept_encoding)
+            assert "content-encoding" not in response.headers, accept_encoding
+            assert response.json() == GRANDE
+        assert server.negotiate_encoding("br;q=0, gzip") == "gzip"
+        print("✓ Codings with q=0 never used")
+
+    def test_streaming_compressed(self, client):
+        """Streaming bodies are compressed chunk by chunk, without a Content-Length"""
+        response, body = get(client, "/stream", "gzip")
+        assert response.headers["content-encoding"] == "gzip"
+        assert "content-length" not in response.headers
+        assert body == b"".join(CHUNKS)
+        print("✓ Streaming response compressed")
+
+    def test_skipped_content_type(self, client):
+        response, body = get(client, "/imagen", "gzip")
+        assert "content-encoding" not in response.headers
+        assert body.startswith(b"\x89PNG") and len(body) == 4100
+        print("✓ Already compressed types skipped")
+
+    def test_not_modified_passthrough(self, client):
+        response, body = get(client, "/no-modificado", "gzip")
+        assert response.status_code == 304
+        assert "content-encoding" not in response.headers
+        assert response.headers["etag"] == '"v1"'
+        assert body == b""
+        print("✓ 304 passed through unchanged")
+
+
+class TestGzipStream:
+    """The streamed gzip output is one valid member, decodable by any client"""
+
+    def test_chunks_decode(self, server):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def scenario():
+            responder = server._CompressionResponder(send, "gzip", 1024)
+            await responder.send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/csv")]})
+            for chunk in CHUNKS:
+                await responder.send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await responder.send({"type": "http.response.body", "body": b"", "more_body": False})
+
+        asyncio.run(scenario())
+        bodies = [m for m in sent if m["type"] == "http.response.body"]
+        assert len(bodies) == len(CHUNKS) + 1
+        assert gzip.decompress(b"".join(m["body"] for m in bodies)) == b"".join(CHUNKS)
+        print("✓ Gzip stream flushed per chunk and decodable")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
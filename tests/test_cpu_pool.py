@@ -0,0 +1,110 @@
+"""
+Unit tests for the bounded CPU pools (CpuBoundPool) and the modules their spawned workers import
+Tests fast 503s when the pool is saturated and recovery after a broken executor
+"""
+import pytest
+import asyncio
+import pickle
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+
+from tests.conftest import BACKEND_DIR
+
+
+class BrokenExecutorStub:
+    """Executor whose worker died: every submit fails and shutdown() is recorded"""
+
+    def __init__(self, workers):
+        self.shut_down = False
+
+    def submit(self, fn, *args):
+        raise BrokenProcessPool("worker died")
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+class TestCpuBoundPool:
+    """Test admission and executor recovery"""
+
+    def test_saturated_pool_rejects(self, server):
+        """With the worker busy and no queue slots, the next call fails fast with 503"""
+        pool = server.CpuBoundPool("test", lambda workers: ThreadPoolExecutor(workers), workers=1, queue_max=0)
+        started, release = threading.Event(), threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait(5)
+            return "ok"
+
+        async def scenario():
+            running = asyncio.ensure_future(pool.run("block", blocking))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            with pytest.raises(HTTPException) as rejected:
+                await pool.run("block", blocking)
+            release.set()
+            return rejected.value, await running
+
+        try:
+            rejected, result = asyncio.run(scenario())
+        finally:
+            release.set()
+            pool.shutdown()
+
+        assert rejected.status_code == 503
+        assert rejected.headers["Retry-After"] == "5"
+        assert result == "ok"
+        assert pool.in_flight == 0
+        print("✓ Saturated pool answers 503 with Retry-After")
+
+    def test_broken_executor_shut_down(self, server):
+        """A broken executor is shut down and replaced on the next call"""
+        created = []
+
+        def make_executor(workers):
+            created.append(BrokenExecutorStub(workers))
+            return created[-1]
+
+        pool = server.CpuBoundPool("test", make_executor, workers=1, queue_max=0)
+        for _ in range(2):
+            with pytest.raises(HTTPException) as error:
+                asyncio.run(pool.run("broken", len, "x"))
+            assert error.value.status_code == 503
+
+        assert len(created) == 2
+        assert all(executor.shut_down for executor in created)
+        assert pool.executor is None
+        print("✓ Broken executor shut down and replaced")
+
+
+class TestWorkerImports:
+    """Spawned workers import only what the pickled task references, which must stay light"""
+
+    def test_import_has_no_server_side_effects(self):
+        check = "import sys, cpu_worker, exports; assert 'server' not in sys.modules and 'motor' not in sys.modules"
+        result = subprocess.run([sys.executable, "-c", check], cwd=BACKEND_DIR, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        print("✓ Worker modules import neither server nor motor")
+
+    def test_excel_task_unpickles_without_server(self, server):
+        """The payload process_pool submits for an Excel export, loaded the way a fresh worker loads it"""
+        payload = pickle.dumps((server.timed_call, (server.create_excel_workbook, ([],))))
+        check = "import pickle, sys; pickle.loads(sys.stdin.buffer.read()); assert 'server' not in sys.modules"
+        result = subprocess.run([sys.executable, "-c", check], cwd=BACKEND_DIR, input=payload, capture_output=True)
+        assert result.returncode == 0, result.stderr.decode()
+        print("✓ Excel task unpickled without importing server")
+
+    def test_workbook_from_projected_rows(self, server):
+        envio = {"ticket": "T-1", "estado": "Entregado", "telefono": "099123456", "calle": "Rivera", "numero": "10"}
+        workbook = server.create_excel_workbook([envio])
+        assert workbook.getvalue()[:2] == b"PK"
+        print("✓ Workbook built from the export projection")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,127 @@
+"""
+Test suite for address normalization and the street autocomplete (/api/direcciones)
+Tests that spelling variants of a street are stored once and suggested by prefix
+"""
+import pytest
+import os
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+def envio_data(calle, esquina=None):
+    return {
+        "ticket": f"TEST-DIR-{uuid.uuid4().hex[:8]}",
+        "calle": calle,
+        "numero": "1500",
+        "esquina": esquina,
+        "motivo": "Entrega",
+        "departamento": "Montevideo",
+        "telefono": "099777888",
+        "contacto": "Direccion Test"
+    }
+
+
+class TestNormalization:
+    """Test address normalization on create and update"""
+
+    def test_variants_share_spelling(self, admin_client):
+        """Abbreviated, lowercase and accent-free variants are stored with one spelling"""
+        ids, calles = [], set()
+        for calle in ["av. 18 de julio", "AVENIDA 18 DE JULIO", "Avda 18 de Julio"]:
+            response = admin_client.post(f"{API_URL}/envios", json=envio_data(calle, esquina="gral. flores"))
+            assert response.status_code == 200, f"Failed to create envío: {response.text}"
+            ids.append(response.json()["id"])
+            calles.add(response.json()["calle"])
+            assert response.json()["esquina"] == "General Flores"
+
+        assert len(calles) == 1
+        for envio_id in ids:
+            admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Street variants normalized to one spelling")
+
+    def test_update_normalizes(self, admin_client):
+        create = admin_client.post(f"{API_URL}/envios", json=envio_data("Colonia"))
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+
+        response = admin_client.put(f"{API_URL}/envios/{envio_id}", json={"calle": "bvar. artigas"})
+        assert response.status_code == 200
+        assert response.json()["calle"] == "Bulevar Artigas"
+
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Update normalizes the street")
+
+
+class TestNormalizarCalle:
+    """Unit tests for the display form of street names"""
+
+    def test_roman_numerals_kept(self, server):
+        assert server.normalizar_calle("Felipe II") == "Felipe II"
+        assert server.normalizar_calle("felipe ii") == "Felipe II"
+        assert server.normalizar_calle("PIO IX") == "Pio IX"
+        assert server.normalizar_calle("juan xxiii") == "Juan XXIII"
+        print("✓ Roman numerals kept in uppercase")
+
+    def test_words_that_look_roman(self, server):
+        """Words spelled with Roman digits stay words unless typed like a numeral"""
+        assert server.normalizar_calle("DI GIORGIO") == "Di Giorgio"
+        assert server.normalizar_calle("mi granja") == "Mi Granja"
+        assert server.normalizar_calle("av. 18 de julio") == "Avenida 18 de Julio"
+        print("✓ Ordinary words capitalized")
+
+
+class TestAutocomplete:
+    """Test GET /api/direcciones/calles"""
+
+    def test_prefix_suggestion(self, admin_client):
+        """A street prefix, with or without its type word, suggests the stored street"""
+        create = admin_client.post(f"{API_URL}/envios", json=envio_data("Avenida 18 de Julio"))
+        assert create.status_code == 200
+
+        for q in ["18 de", "Av. 18"]:
+            response = admin_client.get(f"{API_URL}/direcciones/calles", params={"departamento": "Montevideo", "q": q})
+            assert response.status_code == 200, f"Autocomplete failed: {response.text}"
+            assert create.json()["calle"] in [c["calle"] for c in response.json()["calles"]]
+
+        admin_client.delete(f"{API_URL}/envios/{create.json()['id']}")
+        print("✓ Prefix autocomplete works")
+
+    def test_address_book(self, admin_client):
+        create = admin_client.post(f"{API_URL}/envios", json=envio_data("Rivera"))
+        assert create.status_code == 200
+
+        response = admin_client.get(
+            f"{API_URL}/direcciones",
+            params={"departamento": "Montevideo", "calle": "rivera", "numero": "15"}
+        )
+        assert response.status_code == 200
+        assert any(d["numero"] == "1500" and d["usos"] >= 1 for d in response.json()["direcciones"])
+
+        admin_client.delete(f"{API_URL}/envios/{create.json()['id']}")
+        print("✓ Address book suggests used addresses")
+
+    def test_update_counts_only_new_address(self, admin_client):
+        """Edits that keep calle, numero and departamento do not count another use"""
+        data = {**envio_data("Paraguay"), "numero": str(3000 + uuid.uuid4().int % 1000)}
+        create = admin_client.post(f"{API_URL}/envios", json=data)
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+        params = {"departamento": "Montevideo", "calle": "Paraguay", "numero": data["numero"]}
+
+        def usos():
+            direcciones = admin_client.get(f"{API_URL}/direcciones", params=params).json()["direcciones"]
+            return sum(d["usos"] for d in direcciones if d["numero"] == data["numero"])
+
+        assert usos() == 1
+        for cambio in ({"contacto": "Otro Contacto"}, {"calle": "paraguay", "numero": data["numero"]}, {"apto": "2"}):
+            assert admin_client.put(f"{API_URL}/envios/{envio_id}", json=cambio).status_code == 200
+        assert usos() == 1
+
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Unchanged address not counted again")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
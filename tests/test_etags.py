@@ -0,0 +1,89 @@
+"""
+Test suite for conditional GETs on envíos (ETag / If-None-Match)
+Tests 304 responses while nothing changed and a new ETag after every write
+"""
+import pytest
+import os
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+@pytest.fixture
+def envio(admin_client):
+    response = admin_client.post(f"{API_URL}/envios", json={
+        "ticket": f"TEST-ETAG-{uuid.uuid4().hex[:8]}",
+        "calle": "Sarandí",
+        "numero": "600",
+        "motivo": "Entrega",
+        "departamento": "Montevideo",
+        "telefono": "099444555",
+        "contacto": "ETag Test"
+    })
+    assert response.status_code == 200
+    yield response.json()
+    admin_client.delete(f"{API_URL}/envios/{response.json()['id']}")
+
+
+class TestEnvioETag:
+    """Test ETags on GET /api/envios/{id}"""
+
+    def test_not_modified(self, admin_client, envio):
+        first = admin_client.get(f"{API_URL}/envios/{envio['id']}")
+        assert first.status_code == 200
+        etag = first.headers.get("ETag")
+        assert etag, "Missing ETag"
+
+        again = admin_client.get(f"{API_URL}/envios/{envio['id']}", headers={"If-None-Match": etag})
+        assert again.status_code == 304
+        assert again.content == b""
+        print("✓ Unchanged envío answered with 304")
+
+    def test_write_changes_etag(self, admin_client, envio):
+        """Every write bumps the version, so the old ETag no longer matches"""
+        etag = admin_client.get(f"{API_URL}/envios/{envio['id']}").headers["ETag"]
+
+        response = admin_client.patch(f"{API_URL}/envios/{envio['id']}/estado", json={"nuevo_estado": "Asignado a courier"})
+        assert response.status_code == 200
+        assert response.json()["version"] == envio["version"] + 1
+
+        again = admin_client.get(f"{API_URL}/envios/{envio['id']}", headers={"If-None-Match": etag})
+        assert again.status_code == 200
+        assert again.headers["ETag"] != etag
+        print("✓ Write invalidates the ETag")
+
+
+class TestListETag:
+    """Test ETags on the envíos list and message logs"""
+
+    def test_list_not_modified(self, admin_client, envio):
+        params = {"limit": 20}
+        etag = admin_client.get(f"{API_URL}/envios", params=params).headers["ETag"]
+        assert admin_client.get(f"{API_URL}/envios", params=params, headers={"If-None-Match": etag}).status_code == 304
+
+        admin_client.put(f"{API_URL}/envios/{envio['id']}", json={"contacto": "ETag Cambiado"})
+        assert admin_client.get(f"{API_URL}/envios", params=params, headers={"If-None-Match": etag}).status_code == 200
+        print("✓ List ETag follows the versions of the page")
+
+    def test_messages_not_modified(self, admin_client, envio):
+        etag = admin_client.get(f"{API_URL}/messages/{envio['id']}").headers["ETag"]
+        response = admin_client.get(f"{API_URL}/messages/{envio['id']}", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        print("✓ Unchanged messages answered with 304")
+
+
+class TestLegacyVersion:
+    """Unit test for envíos stored before versioning (no version field)"""
+
+    def test_first_write_changes_etag(self, server):
+        """The first $inc creates version 1, so a missing version must tag differently"""
+        legacy = {"id": "e-legacy"}
+        written = {**legacy, "version": server.touch_envio({})["$inc"]["version"]}
+        assert server.etag_de(legacy["id"], legacy.get("version", 0)) != server.etag_de(written["id"], written["version"])
+        assert server.EnvioResponse.model_fields["version"].default == 0
+        print("✓ Legacy envío ETag changes on its first write")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,110 @@
+"""
+Test suite for geocoding and nearby envíos (/api/envios/cercanos)
+Tests the street gazetteer in backend/data and the $geoNear query over geocoded envíos
+"""
+import pytest
+import os
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+# First segment of Colonia in backend/data/calles_uruguay.csv
+COLONIA_800 = [-56.19700, -34.90560]
+COLONIA_2100 = [-56.17010, -34.89850]
+
+
+class TestGazetteer:
+    """Unit tests for the Gazetteer over backend/data/calles_uruguay.csv"""
+
+    @pytest.fixture(scope="class")
+    def gazetteer(self, server):
+        return server.Gazetteer(server.GAZETTEER_PATH)
+
+    def test_segment_ends(self, gazetteer):
+        assert gazetteer.geocode("Montevideo", "Colonia", "800")["coordinates"] == COLONIA_800
+        assert gazetteer.geocode("Montevideo", "Colonia", "2100")["coordinates"] == COLONIA_2100
+        print("✓ Segment ends geocoded to their coordinates")
+
+    def test_interpolation(self, gazetteer):
+        """A door number is placed proportionally along its segment"""
+        lng, lat = gazetteer.geocode("Montevideo", "Colonia", "1450")["coordinates"]
+        assert lng == pytest.approx((COLONIA_800[0] + COLONIA_2100[0]) / 2, abs=1e-6)
+        assert lat == pytest.approx((COLONIA_800[1] + COLONIA_2100[1]) / 2, abs=1e-6)
+        print("✓ Door number interpolated")
+
+    def test_spelling_variants(self, gazetteer):
+        """Streets and departamentos are matched by their normalized key"""
+        expected = gazetteer.geocode("Montevideo", "Avenida 18 de Julio", "1000")
+        assert expected is not None
+        assert gazetteer.geocode("montevideo", "av. 18 de julio", "1000 bis") == expected
+        assert gazetteer.nombre_calle("Montevideo", "avda 18 de julio") == "Avenida 18 de Julio"
+        print("✓ Spelling variants geocoded alike")
+
+    def test_not_covered(self, gazetteer):
+        assert gazetteer.geocode("Montevideo", "Colonia", "99999") is None
+        assert gazetteer.geocode("Montevideo", "Calle Inexistente", "100") is None
+        assert gazetteer.geocode("Montevideo", "Colonia", "s/n") is None
+        print("✓ Uncovered addresses not geocoded")
+
+    def test_missing_file(self, server, tmp_path):
+        assert server.Gazetteer(str(tmp_path / "missing.csv")).geocode("Montevideo", "Colonia", "800") is None
+        print("✓ Missing gazetteer disables geocoding")
+
+
+@pytest.fixture
+def envios_colonia(admin_client):
+    """Two envíos on Colonia, geocoded by the server from the gazetteer"""
+    ids = []
+    for numero in ("800", "2100"):
+        response = admin_client.post(f"{API_URL}/envios", json={
+            "ticket": f"TEST-GEO-{uuid.uuid4().hex[:8]}",
+            "calle": "Colonia",
+            "numero": numero,
+            "motivo": "Entrega",
+            "departamento": "Montevideo",
+            "telefono": "099555666",
+            "contacto": "Geo Test"
+        })
+        assert response.status_code == 200, f"Failed to create envío: {response.text}"
+        ids.append(response.json()["id"])
+    yield ids
+    for envio_id in ids:
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+
+
+class TestCercanos:
+    """Test GET /api/envios/cercanos"""
+
+    def test_geocoded_on_create(self, admin_client, envios_colonia):
+        envio = admin_client.get(f"{API_URL}/envios/{envios_colonia[0]}").json()
+        assert envio["ubicacion"] == {"type": "Point", "coordinates": COLONIA_800}
+        print("✓ Envío geocoded from the gazetteer")
+
+    def test_nearest_first(self, admin_client, envios_colonia):
+        lng, lat = COLONIA_800
+        response = admin_client.get(f"{API_URL}/envios/cercanos", params={"lat": lat, "lng": lng, "max_km": 5, "limit": 200})
+        assert response.status_code == 200, f"Nearby query failed: {response.text}"
+        distancias = {e["id"]: e["distancia_m"] for e in response.json() if e["id"] in envios_colonia}
+        assert list(distancias) == envios_colonia
+        assert distancias[envios_colonia[0]] < 1
+        assert 2000 < distancias[envios_colonia[1]] < 3500
+        print("✓ Nearby envíos sorted by distance")
+
+    def test_max_distance(self, admin_client, envios_colonia):
+        lng, lat = COLONIA_800
+        response = admin_client.get(f"{API_URL}/envios/cercanos", params={"lat": lat, "lng": lng, "max_km": 1, "limit": 200})
+        assert response.status_code == 200
+        ids = [e["id"] for e in response.json()]
+        assert envios_colonia[0] in ids
+        assert envios_colonia[1] not in ids
+        print("✓ Envíos beyond max_km left out")
+
+    def test_invalid_coordinates(self, admin_client):
+        response = admin_client.get(f"{API_URL}/envios/cercanos", params={"lat": 120, "lng": 0})
+        assert response.status_code == 400
+        print("✓ Invalid coordinates rejected")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,245 @@
+"""
+Test suite for Idempotency-Key support on envío creation and state changes
+Tests that retries with the same key replay the original response without writing again
+"""
+import pytest
+import asyncio
+import requests
+import os
+import uuid
+from types import SimpleNamespace
+
+from pymongo.errors import DuplicateKeyError
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+def envio_data(ticket):
+    return {
+        "ticket": ticket,
+        "calle": "Colonia",
+        "numero": "1500",
+        "motivo": "Entrega",
+        "departamento": "Montevideo",
+        "telefono": "099777888",
+        "contacto": "Idem Test"
+    }
+
+
+class TestIdempotentCreate:
+    """Test Idempotency-Key on POST /api/envios"""
+
+    def test_retry_returns_same_envio(self, admin_client):
+        """A retried creation returns the original envío and creates nothing new"""
+        ticket = f"TEST-IDEM-{uuid.uuid4().hex[:8]}"
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+        first = admin_client.post(f"{API_URL}/envios", json=envio_data(ticket), headers=headers)
+        assert first.status_code == 200, f"Failed to create envío: {first.text}"
+        retry = admin_client.post(f"{API_URL}/envios", json=envio_data(ticket), headers=headers)
+        assert retry.status_code == 200
+        assert retry.headers.get("Idempotent-Replayed") == "true"
+        assert retry.json()["id"] == first.json()["id"]
+
+        envios = admin_client.get(f"{API_URL}/envios", params={"limit": 100}).json()
+        assert len([e for e in envios if e["ticket"] == ticket]) == 1
+
+        admin_client.delete(f"{API_URL}/envios/{first.json()['id']}")
+        print("✓ Retried creation replayed without duplicates")
+
+    def test_key_reused_with_other_payload(self, admin_client):
+        """Reusing a key for a different envío is rejected"""
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        first = admin_client.post(f"{API_URL}/envios", json=envio_data(f"TEST-IDEM-{uuid.uuid4().hex[:8]}"), headers=headers)
+        assert first.status_code == 200
+        other = admin_client.post(f"{API_URL}/envios", json=envio_data(f"TEST-IDEM-{uuid.uuid4().hex[:8]}"), headers=headers)
+        assert other.status_code == 422
+
+        admin_client.delete(f"{API_URL}/envios/{first.json()['id']}")
+        print("✓ Key reuse with another payload rejected")
+
+    def test_key_reused_with_other_ticket_prefix(self, admin_client):
+        """prefijo_ticket is not stored on the envío but is part of the request fingerprint"""
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        data = {**envio_data(None), "prefijo_ticket": "IDEMA"}
+        first = admin_client.post(f"{API_URL}/envios", json=data, headers=headers)
+        assert first.status_code == 200, f"Failed to create envío: {first.text}"
+        assert first.json()["ticket"].startswith("IDEMA-")
+
+        other = admin_client.post(f"{API_URL}/envios", json={**data, "prefijo_ticket": "IDEMB"}, headers=headers)
+        assert other.status_code == 422
+
+        admin_client.delete(f"{API_URL}/envios/{first.json()['id']}")
+        print("✓ Key reuse with another ticket prefix rejected")
+
+
+class TestTicketUnico:
+    """Test that tickets stay unique between typed and generated ones"""
+
+    def test_duplicate_ticket_rejected(self, admin_client):
+        ticket = f"TEST-IDEM-{uuid.uuid4().hex[:8]}"
+        first = admin_client.post(f"{API_URL}/envios", json=envio_data(ticket))
+        assert first.status_code == 200
+        again = admin_client.post(f"{API_URL}/envios", json=envio_data(ticket))
+        assert again.status_code == 409
+
+        other = admin_client.post(f"{API_URL}/envios", json=envio_data(f"TEST-IDEM-{uuid.uuid4().hex[:8]}"))
+        assert other.status_code == 200
+        renamed = admin_client.put(f"{API_URL}/envios/{other.json()['id']}", json={"ticket": ticket})
+        assert renamed.status_code == 409
+
+        for response in (first, other):
+            admin_client.delete(f"{API_URL}/envios/{response.json()['id']}")
+        print("✓ Duplicate ticket rejected on create and update")
+
+    def test_generated_ticket_skips_typed_one(self, admin_client):
+        """A sequence number already typed in by hand is skipped by the generator"""
+        prefijo = f"T{uuid.uuid4().hex[:6].upper()}"
+        reservado = admin_client.post(f"{API_URL}/envios/tickets", params={"prefijo": prefijo}).json()["tickets"][0]
+        numero = reservado.split("-")[1]
+        siguiente = f"{prefijo}-{int(numero) + 1:0{len(numero)}d}"
+
+        manual = admin_client.post(f"{API_URL}/envios", json=envio_data(siguiente))
+        assert manual.status_code == 200
+        generado = admin_client.post(f"{API_URL}/envios", json={**envio_data(None), "prefijo_ticket": prefijo})
+        assert generado.status_code == 200, f"Failed to create envío: {generado.text}"
+        assert generado.json()["ticket"] not in (reservado, siguiente)
+
+        for response in (manual, generado):
+            admin_client.delete(f"{API_URL}/envios/{response.json()['id']}")
+        print("✓ Generated ticket does not collide with a typed one")
+
+
+class TestIdempotentEstado:
+    """Test Idempotency-Key on PATCH /api/envios/{id}/estado"""
+
+    def test_retry_does_not_duplicate_message(self, admin_client):
+        """A retried state change keeps a single history entry and a single WhatsApp message"""
+        create = admin_client.post(f"{API_URL}/envios", json=envio_data(f"TEST-IDEM-{uuid.uuid4().hex[:8]}"))
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+        for _ in range(2):
+            response = admin_client.patch(
+                f"{API_URL}/envios/{envio_id}/estado",
+                json={"nuevo_estado": "Asignado a courier"},
+                headers=headers
+            )
+            assert response.status_code == 200, f"Retry failed: {response.text}"
+
+        envio = admin_client.get(f"{API_URL}/envios/{envio_id}").json()
+        assert len(envio["historial_estados"]) == 2
+        messages = admin_client.get(f"{API_URL}/messages/{envio_id}").json()
+        assert len(messages) == 1
+
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Retried state change applied once")
+
+
+class TestIdempotentUpload:
+    """Test Idempotency-Key on POST /api/envios/{id}/upload-image"""
+
+    def test_same_name_other_photo_not_replayed(self, admin_client):
+        """The upload is fingerprinted by content: another photo under the same key is a 422, not a replay"""
+        create = admin_client.post(f"{API_URL}/envios", json=envio_data(f"TEST-IDEM-{uuid.uuid4().hex[:8]}"))
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+        headers = {"Authorization": admin_client.headers["Authorization"], "Idempotency-Key": str(uuid.uuid4())}
+
+        def upload(contents):
+            # Plain requests: the session's JSON Content-Type would replace the multipart one
+            return requests.post(
+                f"{API_URL}/envios/{envio_id}/upload-image",
+                files={"file": ("foto.jpg", contents, "image/jpeg")},
+                headers=headers
+            )
+
+        first = upload(b"\xff\xd8" + b"a" * 100)
+        assert first.status_code == 200, f"Upload failed: {first.text}"
+        assert upload(b"\xff\xd8" + b"a" * 100).headers.get("Idempotent-Replayed") == "true"
+        assert upload(b"\xff\xd8" + b"b" * 100).status_code == 422
+
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Uploads fingerprinted by content")
+
+
+class FakeIdempotencyKeys:
+    def __init__(self):
+        self.docs = {}
+
+    async def insert_one(self, doc):
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError("duplicate key")
+        self.docs[doc["_id"]] = dict(doc)
+
+    async def find_one(self, filter):
+        return self.docs.get(filter["_id"])
+
+    async def update_one(self, filter, update):
+        doc = self.docs.get(filter["_id"])
+        if doc is None or any(doc.get(k) != v for k, v in filter.items() if not isinstance(v, dict)):
+            return SimpleNamespace(modified_count=0)
+        doc.update(update["$set"])
+        return SimpleNamespace(modified_count=1)
+
+    async def delete_one(self, filter):
+        self.docs.pop(filter["_id"], None)
+
+
+@pytest.fixture
+def keys(server, monkeypatch):
+    keys = FakeIdempotencyKeys()
+    monkeypatch.setattr(server, "db", SimpleNamespace(idempotency_keys=keys))
+    return keys
+
+
+def run(server, operation, key="k1"):
+    return asyncio.run(server.run_idempotent(key, {"id": "u1"}, "create_envio", {"ticket": "T-1"}, operation))
+
+
+class TestRunIdempotent:
+    """Unit tests for when the key is released and what a retry gets"""
+
+    def test_failure_before_commit_releases_key(self, server, keys):
+        async def operation(committed):
+            raise RuntimeError("antes de escribir")
+
+        with pytest.raises(RuntimeError):
+            run(server, operation)
+        assert keys.docs == {}
+        print("✓ Key released when nothing was written")
+
+    def test_failure_after_commit_replays_response(self, server, keys):
+        """A step after the write fails: the retry gets the written envío instead of creating another"""
+        writes = []
+
+        async def operation(committed):
+            writes.append(1)
+            committed({"id": "e1", "ticket": "T-1"})
+            raise RuntimeError("registrar_kpi falló")
+
+        with pytest.raises(RuntimeError):
+            run(server, operation)
+        replay = run(server, operation)
+        assert writes == [1]
+        assert replay.status_code == 200
+        assert replay.body == b'{"id":"e1","ticket":"T-1"}'
+        print("✓ Committed response replayed after a later failure")
+
+    def test_failure_after_commit_without_response(self, server, keys):
+        async def operation(committed):
+            committed()
+            raise asyncio.CancelledError()
+
+        with pytest.raises(asyncio.CancelledError):
+            run(server, operation)
+        replay = run(server, operation)
+        assert replay.status_code == 500
+        assert replay.headers["Idempotent-Replayed"] == "true"
+        print("✓ Failed state stored when the write went in without a response")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
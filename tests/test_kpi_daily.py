@@ -0,0 +1,145 @@
+"""
+Test suite for the daily KPI rollups (/api/reports/daily)
+Tests that creations, deliveries and deletions move the counters, and the nightly recompute
+"""
+import pytest
+import os
+import uuid
+import asyncio
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+def contadores(client, departamento="Flores"):
+    """Today's counters (the report's last day); Flores and Durazno are departamentos no other suite loads envíos in"""
+    response = client.get(f"{API_URL}/reports/daily", params={"departamento": departamento})
+    assert response.status_code == 200, f"Report failed: {response.text}"
+    data = response.json()
+    hoy = next((s for s in data["series"] if s["fecha"] == data["hasta"]), None)
+    return hoy or {"creados": 0, "entregados": 0, "fallidos": 0}
+
+
+class TestRollups:
+    """Test counters kept by every write"""
+
+    def test_counters_follow_envio(self, admin_client):
+        before = contadores(admin_client)
+        create = admin_client.post(f"{API_URL}/envios", json={
+            "ticket": f"TEST-KPI-{uuid.uuid4().hex[:8]}",
+            "calle": "Treinta y Tres",
+            "numero": "500",
+            "motivo": "Entrega",
+            "departamento": "Flores",
+            "telefono": "099222333",
+            "contacto": "KPI Test"
+        })
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+        for cambio in [
+            {"nuevo_estado": "Asignado a courier"},
+            {"nuevo_estado": "Entregado", "receptor_nombre": "Eva", "receptor_cedula": "12345678"},
+        ]:
+            assert admin_client.patch(f"{API_URL}/envios/{envio_id}/estado", json=cambio).status_code == 200
+
+        after = contadores(admin_client)
+        assert after["creados"] == before["creados"] + 1
+        assert after["entregados"] == before["entregados"] + 1
+        print("✓ Creation and delivery counted")
+
+        # Deletions are subtracted right away, not left to the nightly recompute
+        assert admin_client.delete(f"{API_URL}/envios/{envio_id}").status_code == 200
+        deleted = contadores(admin_client)
+        assert deleted["creados"] == before["creados"]
+        assert deleted["entregados"] == before["entregados"]
+        print("✓ Deleted envío subtracted")
+
+    def test_counters_follow_departamento(self, admin_client):
+        """Moving an envío to another departamento moves its counts with it"""
+        before = {d: contadores(admin_client, d) for d in ("Flores", "Durazno")}
+        create = admin_client.post(f"{API_URL}/envios", json={
+            "ticket": f"TEST-KPI-{uuid.uuid4().hex[:8]}",
+            "calle": "Treinta y Tres",
+            "numero": "600",
+            "motivo": "Entrega",
+            "departamento": "Flores",
+            "telefono": "099222333",
+            "contacto": "KPI Test"
+        })
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+        response = admin_client.put(f"{API_URL}/envios/{envio_id}", json={"departamento": "Durazno"})
+        assert response.status_code == 200
+
+        after = {d: contadores(admin_client, d) for d in ("Flores", "Durazno")}
+        assert after["Flores"]["creados"] == before["Flores"]["creados"]
+        assert after["Durazno"]["creados"] == before["Durazno"]["creados"] + 1
+
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Counts moved with the departamento")
+
+
+class TestRecompute:
+    """Unit tests for the nightly recompute"""
+
+    def test_ops_replace_without_clearing(self, server):
+        """Recomputed rollups are replaced and stale ones deleted one by one, never cleared wholesale"""
+        ops = server.kpi_recompute_ops({"a": {"creados": 2}, "b": {"creados": 1}}, {"b", "c"})
+        assert [type(op).__name__ for op in ops] == ["ReplaceOne", "ReplaceOne", "DeleteOne"]
+        assert ops[2]._filter == {"_id": "c"}
+        print("✓ Recompute writes replacements and targeted deletes")
+
+    def test_nightly_needs_lease(self, server, monkeypatch):
+        """Only the worker holding the kpi_nightly lease recomputes"""
+        calls = []
+
+        async def recompute(desde):
+            calls.append(desde)
+            return 3
+
+        for holder in (False, True):
+            async def lease(name, seconds, holder=holder):
+                assert name == "kpi_nightly"
+                return holder
+            monkeypatch.setattr(server, "acquire_lease", lease)
+            monkeypatch.setattr(server, "recompute_kpi_daily", recompute)
+            assert asyncio.run(server.run_kpi_nightly()) == (3 if holder else None)
+
+        assert len(calls) == 1
+        print("✓ Nightly recompute runs in the lease holder only")
+
+
+class FakeKpiDaily:
+    def __init__(self):
+        self.updates = []
+
+    async def update_one(self, filter, update, upsert=False):
+        self.updates.append((filter["_id"], update["$inc"]))
+
+
+class TestLegacyDates:
+    """Unit tests for rollup updates on envíos whose dates are still legacy ISO strings"""
+
+    def test_string_dates_counted(self, server, monkeypatch):
+        kpi_daily = FakeKpiDaily()
+        monkeypatch.setattr(server, "db", type("FakeDb", (), {"kpi_daily": kpi_daily})())
+        envio = {
+            "departamento": "Flores", "motivo": "Entrega", "creado_por": "u1",
+            "fecha_carga": "2024-03-01T12:00:00",
+            "historial_estados": [
+                {"estado": "Ingresada", "fecha": "2024-03-01T12:00:00"},
+                {"estado": "Entregado", "fecha": "2024-03-02T15:00:00+00:00"},
+                {"estado": "No entregado", "fecha": "ilegible"},
+            ]
+        }
+        asyncio.run(server.contar_kpis(envio, -1))
+
+        assert kpi_daily.updates == [
+            ("2024-03-01|Flores|Entrega|u1", {"creados": -1}),
+            ("2024-03-02|Flores|Entrega|u1", {"entregados": -1}),
+        ]
+        print("✓ Legacy string dates parsed, unreadable ones skipped")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
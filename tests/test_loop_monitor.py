@@ -0,0 +1,96 @@
+"""
+Test suite for the event-loop lag monitor (LoopMonitor)
+Unit tests for the lag metrics and the blocking report of a handler that blocks the loop
+"""
+import pytest
+import asyncio
+import logging
+import time
+
+
+def blocking_handler():
+    """Stands in for a route that does synchronous work on the event loop"""
+    time.sleep(0.4)
+
+
+async def blocking_app(scope, receive, send):
+    blocking_handler()
+
+
+REQUEST_SCOPE = {"type": "http", "method": "GET", "path": "/api/bloqueante", "endpoint": blocking_handler}
+
+
+class TestLoopMonitor:
+    """Test lag sampling and blocking reports"""
+
+    def test_lag_metrics(self, server):
+        """A blocked loop shows up as lag, a max and a blocked sample"""
+        before = server.METRICS.copy()
+        monitor = server.LoopMonitor(interval_ms=20, threshold_ms=100)
+
+        async def scenario():
+            task = asyncio.create_task(monitor.run())
+            await asyncio.sleep(0.1)
+            time.sleep(0.3)
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(scenario())
+
+        assert server.METRICS["event_loop.samples"] > before["event_loop.samples"]
+        assert server.METRICS["event_loop.blocked"] == before["event_loop.blocked"] + 1
+        assert server.METRICS["event_loop.lag_ms_max"] >= 200
+        assert server.METRICS["event_loop.lag_ms_total"] - before["event_loop.lag_ms_total"] >= 200
+        assert monitor.stopped.is_set()
+        print("✓ Lag recorded in METRICS")
+
+    def test_blocking_report_names_route(self, server, caplog):
+        """The watchdog logs the blocking call's stack once, with the request being served"""
+        monitor = server.LoopMonitor(interval_ms=20, threshold_ms=100)
+        middleware = server.LoopMonitorMiddleware(blocking_app, monitor)
+
+        async def scenario():
+            task = asyncio.create_task(monitor.run())
+            await asyncio.sleep(0.1)
+            await middleware(REQUEST_SCOPE, None, None)
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        with caplog.at_level(logging.WARNING, logger=server.logger.name):
+            asyncio.run(scenario())
+
+        reports = [r.getMessage() for r in caplog.records if "Event loop blocked" in r.getMessage()]
+        assert len(reports) == 1
+        assert "GET /api/bloqueante (blocking_handler)" in reports[0]
+        assert "time.sleep(0.4)" in reports[0]
+        assert monitor.requests == {}
+        print("✓ Blocking report names the route and the blocking call")
+
+    def test_report_outside_requests(self, server, caplog):
+        """Blocking in a background task is reported without a route"""
+        monitor = server.LoopMonitor(interval_ms=20, threshold_ms=100)
+
+        async def scenario():
+            task = asyncio.create_task(monitor.run())
+            await asyncio.sleep(0.1)
+            blocking_handler()
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        with caplog.at_level(logging.WARNING, logger=server.logger.name):
+            asyncio.run(scenario())
+
+        reports = [r.getMessage() for r in caplog.records if "Event loop blocked" in r.getMessage()]
+        assert len(reports) == 1
+        assert "no request" in reports[0]
+        print("✓ Blocking outside a request reported")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,120 @@
+"""
+Test suite for paginated and filtered message logs (/api/messages)
+Tests cursor pagination through X-Next-Cursor and the ticket / estado filters
+"""
+import pytest
+import os
+import uuid
+import base64
+import json
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+@pytest.fixture(scope="module")
+def envio_con_mensajes(admin_client):
+    """Envío assigned and then marked 'No entregado', producing two messages"""
+    ticket = f"TEST-MSG-{uuid.uuid4().hex[:8]}"
+    response = admin_client.post(f"{API_URL}/envios", json={
+        "ticket": ticket,
+        "calle": "Rivera",
+        "numero": "2020",
+        "motivo": "Entrega",
+        "departamento": "Montevideo",
+        "telefono": "099555666",
+        "contacto": "Log Test"
+    })
+    assert response.status_code == 200
+    envio_id = response.json()["id"]
+
+    for cambio in [{"nuevo_estado": "Asignado a courier"}, {"nuevo_estado": "No entregado", "comentario": "Ausente"}]:
+        response = admin_client.patch(f"{API_URL}/envios/{envio_id}/estado", json=cambio)
+        assert response.status_code == 200
+
+    yield ticket
+    admin_client.delete(f"{API_URL}/envios/{envio_id}")
+
+
+class TestMessageLogs:
+    """Test filters and cursor pagination on message logs"""
+
+    def test_filter_by_ticket(self, admin_client, envio_con_mensajes):
+        """Only the messages of the requested ticket are returned, newest first"""
+        response = admin_client.get(f"{API_URL}/messages", params={"ticket": envio_con_mensajes})
+        assert response.status_code == 200, f"Failed to get messages: {response.text}"
+
+        messages = response.json()
+        assert [m["estado"] for m in messages] == ["No entregado", "Asignado a courier"]
+        print("✓ Ticket filter works")
+
+    def test_filter_by_ticket_and_estado(self, admin_client, envio_con_mensajes):
+        response = admin_client.get(
+            f"{API_URL}/messages",
+            params={"ticket": envio_con_mensajes, "estado": "Asignado a courier"}
+        )
+        assert response.status_code == 200
+        assert len(response.json()) == 1
+        print("✓ Estado filter works")
+
+    def test_filter_by_phone(self, admin_client, envio_con_mensajes):
+        """Any format of the number finds its messages"""
+        response = admin_client.get(f"{API_URL}/messages", params={"telefono": "+598 99 555 666", "ticket": envio_con_mensajes})
+        assert response.status_code == 200
+        assert len(response.json()) == 2
+        print("✓ Phone filter normalizes the number")
+
+    def test_filter_by_unrecognized_phone(self, admin_client):
+        """Numbers that cannot be normalized are matched as typed"""
+        telefono = f"int {uuid.uuid4().int % 10**6}"
+        create = admin_client.post(f"{API_URL}/envios", json={
+            "ticket": f"TEST-MSG-{uuid.uuid4().hex[:8]}",
+            "calle": "Rivera",
+            "numero": "2030",
+            "motivo": "Entrega",
+            "departamento": "Montevideo",
+            "telefono": telefono,
+            "contacto": "Log Test"
+        })
+        assert create.status_code == 200
+        admin_client.patch(f"{API_URL}/envios/{create.json()['id']}/estado", json={"nuevo_estado": "Asignado a courier"})
+
+        response = admin_client.get(f"{API_URL}/messages", params={"telefono": telefono})
+        assert response.status_code == 200
+        assert [m["telefono"] for m in response.json()] == [telefono]
+
+        admin_client.delete(f"{API_URL}/envios/{create.json()['id']}")
+        print("✓ Unrecognized phone matched as typed")
+
+    def test_cursor_pagination(self, admin_client, envio_con_mensajes):
+        """Pages of one message follow each other without repeating"""
+        first = admin_client.get(f"{API_URL}/messages", params={"ticket": envio_con_mensajes, "limit": 1})
+        assert first.status_code == 200
+        cursor = first.headers.get("X-Next-Cursor")
+        assert cursor, "Missing X-Next-Cursor on a full page"
+
+        second = admin_client.get(
+            f"{API_URL}/messages",
+            params={"ticket": envio_con_mensajes, "limit": 1, "cursor": cursor}
+        )
+        assert second.status_code == 200
+        assert second.json()[0]["id"] != first.json()[0]["id"]
+        assert second.json()[0]["estado"] == "Asignado a courier"
+        print("✓ Cursor pagination works")
+
+    def test_invalid_cursor(self, admin_client):
+        response = admin_client.get(f"{API_URL}/messages", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+        print("✓ Invalid cursor rejected")
+
+    def test_cursor_with_wrong_types(self, admin_client):
+        """A well-formed cursor whose values have the wrong types is a 400, not a server error"""
+        for values in ([1700000000, "id"], [None, "id"], ["2026-01-01T00:00:00+00:00", 5]):
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+            response = admin_client.get(f"{API_URL}/messages", params={"cursor": cursor})
+            assert response.status_code == 400, f"{values}: {response.status_code}"
+        print("✓ Cursor value types checked")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
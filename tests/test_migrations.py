@@ -0,0 +1,63 @@
+"""
+Test suite for the startup data migrations (run_data_migrations)
+Unit tests that only the worker holding the data_migrations lease runs them
+"""
+import pytest
+import asyncio
+
+
+class FakeMigrations:
+    def __init__(self, completed=()):
+        self.completed = set(completed)
+
+    async def find_one(self, filter):
+        return {"_id": filter["_id"]} if filter["_id"] in self.completed else None
+
+    async def update_one(self, filter, update, upsert=False):
+        self.completed.add(filter["_id"])
+
+
+@pytest.fixture
+def migrations(server, monkeypatch):
+    """Two fake migrations over a fake migrations collection; returns the calls made"""
+    calls = []
+
+    def migration(name):
+        async def run():
+            calls.append(name)
+            return 1
+        return run
+
+    monkeypatch.setattr(server, "DATA_MIGRATIONS", [("uno", migration("uno")), ("dos", migration("dos"))])
+    monkeypatch.setattr(server, "db", type("FakeDb", (), {"migrations": FakeMigrations({"uno"})})())
+    return calls
+
+
+class TestMigrationLease:
+    """Test that concurrent workers do not run migrations twice"""
+
+    def test_lease_holder_runs_pending(self, server, monkeypatch, migrations):
+        leases = []
+
+        async def lease(name, seconds):
+            leases.append(name)
+            return True
+
+        monkeypatch.setattr(server, "acquire_lease", lease)
+        asyncio.run(server.run_data_migrations())
+        assert migrations == ["dos"]
+        assert leases == ["data_migrations"]
+        print("✓ Pending migrations run by the lease holder")
+
+    def test_other_worker_skips(self, server, monkeypatch, migrations):
+        async def lease(name, seconds):
+            return False
+
+        monkeypatch.setattr(server, "acquire_lease", lease)
+        asyncio.run(server.run_data_migrations())
+        assert migrations == []
+        print("✓ Workers without the lease do not migrate")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,89 @@
+"""
+Test suite for offline batches of state changes (/api/envios/estados/lote)
+Tests ordered application, replay of a retried batch and conflict reporting
+"""
+import pytest
+import os
+import uuid
+from datetime import datetime, timezone
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+@pytest.fixture
+def envio_id(admin_client):
+    response = admin_client.post(f"{API_URL}/envios", json={
+        "ticket": f"TEST-LOTE-{uuid.uuid4().hex[:8]}",
+        "calle": "Sarandí",
+        "numero": "450",
+        "motivo": "Entrega",
+        "departamento": "Tacuarembó",
+        "telefono": "099333444",
+        "contacto": "Lote Test"
+    })
+    assert response.status_code == 200
+    yield response.json()["id"]
+    admin_client.delete(f"{API_URL}/envios/{response.json()['id']}")
+
+
+def cambio(envio_id, nuevo_estado, estado_base, **extra):
+    return {
+        "cambio_id": str(uuid.uuid4()),
+        "envio_id": envio_id,
+        "nuevo_estado": nuevo_estado,
+        "estado_base": estado_base,
+        "fecha_cliente": datetime.now(timezone.utc).isoformat(),
+        **extra
+    }
+
+
+class TestOfflineBatch:
+    """Test offline state change batches"""
+
+    def test_batch_applied_in_order(self, admin_client, envio_id):
+        """Assign and deliver in one batch; retrying the batch changes nothing"""
+        lote = {"cambios": [
+            cambio(envio_id, "Asignado a courier", "Ingresada"),
+            cambio(envio_id, "Entregado", "Asignado a courier", receptor_nombre="Ana", receptor_cedula="12345678"),
+        ]}
+        response = admin_client.post(f"{API_URL}/envios/estados/lote", json=lote)
+        assert response.status_code == 200, f"Batch failed: {response.text}"
+        assert [r["resultado"] for r in response.json()["resultados"]] == ["aplicado", "aplicado"]
+
+        retry = admin_client.post(f"{API_URL}/envios/estados/lote", json=lote)
+        assert [r["resultado"] for r in retry.json()["resultados"]] == ["duplicado", "duplicado"]
+
+        envio = admin_client.get(f"{API_URL}/envios/{envio_id}").json()
+        assert envio["estado"] == "Entregado"
+        assert len(envio["historial_estados"]) == 3
+        print("✓ Batch applied once, in order")
+
+    def test_conflict_reported(self, admin_client, envio_id):
+        """A change made against a state the server no longer has is reported, not applied"""
+        admin_client.patch(f"{API_URL}/envios/{envio_id}/estado", json={"nuevo_estado": "Asignado a courier"})
+        lote = {"cambios": [cambio(envio_id, "Asignado a courier", "Ingresada")]}
+
+        response = admin_client.post(f"{API_URL}/envios/estados/lote", json=lote)
+        assert response.status_code == 200
+        resultado = response.json()["resultados"][0]
+        assert resultado["resultado"] == "conflicto"
+        assert resultado["estado_actual"] == "Asignado a courier"
+        print("✓ Conflict reported with the server state")
+
+    def test_timestamp_without_offset(self, admin_client, envio_id):
+        """A device timestamp without UTC offset is taken as UTC instead of failing the batch"""
+        fecha = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        lote = {"cambios": [cambio(envio_id, "Asignado a courier", "Ingresada", fecha_cliente=fecha.isoformat())]}
+
+        response = admin_client.post(f"{API_URL}/envios/estados/lote", json=lote)
+        assert response.status_code == 200, f"Batch failed: {response.text}"
+        assert response.json()["resultados"][0]["resultado"] == "aplicado"
+
+        historial = admin_client.get(f"{API_URL}/envios/{envio_id}").json()["historial_estados"][-1]
+        assert datetime.fromisoformat(historial["fecha_cliente"]) == fecha.replace(tzinfo=timezone.utc)
+        print("✓ Offset-less device timestamp accepted as UTC")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
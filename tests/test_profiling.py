@@ -0,0 +1,88 @@
+"""
+Test suite for on-demand request profiling (ProfilingMiddleware)
+Unit tests that only admins get a profile stored and its id returned in X-Profile-Id
+"""
+import pytest
+import asyncio
+
+
+def token(server, rol):
+    return server.create_token({
+        "id": f"test-{rol}", "username": f"test_{rol}", "nombre": f"Test {rol}", "rol": rol,
+        "created_at": "2026-01-01T00:00:00+00:00"
+    })
+
+
+async def ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+@pytest.fixture
+def profiling(server, monkeypatch):
+    """Middleware over a trivial app; stateless auth, and stored profiles kept in a list"""
+    monkeypatch.setattr(server, "AUTH_STATELESS", True)
+    stored = []
+
+    async def store(self, profile_id, scope, ruta, duracion_ms, muestras):
+        stored.append({"id": profile_id, "ruta": ruta})
+
+    monkeypatch.setattr(server.ProfilingMiddleware, "_store", store)
+    profiler = server.RequestProfiler(interval_ms=5, sample_every=0)
+    return server.ProfilingMiddleware(ok_app, profiler), stored
+
+
+def request(middleware, headers):
+    """Response headers of a GET /api/envios sent with the given headers"""
+    scope = {
+        "type": "http", "method": "GET", "path": "/api/envios", "raw_path": b"/api/envios",
+        "root_path": "", "query_string": b"", "scheme": "http", "server": ("test", 80),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+    }
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(middleware(scope, None, send))
+    return dict(messages[0]["headers"])
+
+
+class TestProfileHeader:
+    """Test who can ask for a profile"""
+
+    def test_admin_gets_profile_id(self, server, profiling):
+        middleware, stored = profiling
+        headers = request(middleware, {
+            server.PROFILE_HEADER: "1", "Authorization": f"Bearer {token(server, 'admin')}"
+        })
+
+        assert b"x-profile-id" in headers
+        assert [p["id"] for p in stored] == [headers[b"x-profile-id"].decode()]
+        assert stored[0]["ruta"] == "GET /api/envios"
+        print("✓ Admin profile stored and its id returned")
+
+    def test_non_admin_header_ignored(self, server, profiling):
+        """The header from an agente, or without a valid token, neither profiles nor fails the request"""
+        middleware, stored = profiling
+        denied = server.METRICS["profiling.denied"]
+        for authorization in (f"Bearer {token(server, 'agente')}", "Bearer invalido", None):
+            headers = {server.PROFILE_HEADER: "1"}
+            if authorization:
+                headers["Authorization"] = authorization
+            assert b"x-profile-id" not in request(middleware, headers)
+
+        assert stored == []
+        assert server.METRICS["profiling.denied"] == denied + 3
+        print("✓ Profile header ignored for non-admins")
+
+    def test_no_header_not_profiled(self, server, profiling):
+        middleware, stored = profiling
+        headers = request(middleware, {"Authorization": f"Bearer {token(server, 'admin')}"})
+        assert b"x-profile-id" not in headers
+        assert stored == []
+        print("✓ Requests without the header are not profiled")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
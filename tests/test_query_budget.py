@@ -0,0 +1,92 @@
+"""
+Test suite for per-endpoint query budgets (query_budget, budgeted_find, budgeted_aggregate)
+Unit tests for the mapping of maxTimeMS overruns to 503 / 413 and the cursor options applied
+"""
+import pytest
+
+from fastapi import HTTPException
+from pymongo.errors import ExecutionTimeout, OperationFailure
+
+
+class FakeCursor:
+    def __init__(self):
+        self.options = {}
+
+    def max_time_ms(self, ms):
+        self.options["max_time_ms"] = ms
+        return self
+
+    def batch_size(self, size):
+        self.options["batch_size"] = size
+        return self
+
+
+class FakeCollection:
+    def find(self, *args, **kwargs):
+        return FakeCursor()
+
+    def aggregate(self, pipeline, **options):
+        return options
+
+
+def overrun(server, endpoint):
+    """The HTTPException query_budget raises for a maxTimeMS overrun on an endpoint"""
+    with pytest.raises(HTTPException) as error:
+        with server.query_budget(endpoint):
+            raise ExecutionTimeout("operation exceeded time limit", 50)
+    return error.value
+
+
+class TestQueryBudget:
+    """Test the error returned when a query runs out of time"""
+
+    def test_interactive_overrun_is_503(self, server):
+        exceeded = server.METRICS["query_budget.get_envios.exceeded"]
+        error = overrun(server, "get_envios")
+        assert error.status_code == 503
+        assert "Acote los filtros" in error.detail
+        assert server.METRICS["query_budget.get_envios.exceeded"] == exceeded + 1
+        print("✓ Interactive overrun answered with 503")
+
+    def test_export_overrun_is_413(self, server):
+        """Exports too large to produce in budget are the request's fault, not a busy server"""
+        for endpoint in ("export_excel", "export_csv"):
+            assert overrun(server, endpoint).status_code == 413
+        print("✓ Export overrun answered with 413")
+
+    def test_every_endpoint_mapped(self, server):
+        for endpoint, (_, status, _) in server.QUERY_BUDGETS.items():
+            assert overrun(server, endpoint).status_code == status in (413, 503)
+        print("✓ Every budgeted endpoint maps overruns")
+
+    def test_other_errors_untouched(self, server):
+        with pytest.raises(OperationFailure):
+            with server.query_budget("get_envios"):
+                raise OperationFailure("bad query", 2)
+        with server.query_budget("get_envios"):
+            pass
+        print("✓ Other errors and successful queries pass through")
+
+
+class TestBudgetedCursors:
+    """Test the maxTimeMS and batch size applied to queries"""
+
+    def test_find_options(self, server):
+        cursor = server.budgeted_find(FakeCollection(), "get_envios", {})
+        assert cursor.options == {
+            "max_time_ms": server.QUERY_BUDGET_MS["get_envios"],
+            "batch_size": server.QUERY_BATCH_SIZE["get_envios"]
+        }
+        cursor = server.budgeted_find(FakeCollection(), "sync_envios", {})
+        assert cursor.options == {"max_time_ms": server.QUERY_BUDGET_MS["sync_envios"]}
+        print("✓ find() gets the endpoint budget")
+
+    def test_aggregate_options(self, server):
+        options = server.budgeted_aggregate(FakeCollection(), "export_excel", [])
+        assert options["maxTimeMS"] == server.QUERY_BUDGET_MS["export_excel"]
+        assert options["batchSize"] == server.QUERY_BATCH_SIZE["export_excel"]
+        print("✓ aggregate() gets the endpoint budget")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
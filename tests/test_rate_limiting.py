@@ -0,0 +1,110 @@
+"""
+Test suite for rate limiting on public tracking and login
+Tests that a burst over the per-ticket bucket is rejected with 429 + Retry-After and counted in /api/metrics
+"""
+import pytest
+import asyncio
+import requests
+import os
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+class TestTrackingRateLimit:
+    """Test the per-ticket token bucket on the public tracking endpoint"""
+
+    def test_tracking_burst_is_limited(self):
+        """Hammering one ticket eventually returns 429 with Retry-After"""
+        ticket = f"TEST-RL-{uuid.uuid4().hex[:8]}"
+
+        limited = None
+        for _ in range(40):
+            response = requests.get(f"{API_URL}/tracking/{ticket}")
+            if response.status_code == 429:
+                limited = response
+                break
+            assert response.status_code == 404, f"Unexpected status: {response.status_code}"
+
+        assert limited is not None, "Tracking endpoint never rate limited"
+        assert int(limited.headers["Retry-After"]) >= 1
+        print("✓ Tracking burst rejected with 429")
+
+    def test_limiter_counters_exported(self, admin_token):
+        """Limiter counters are visible to admins"""
+        response = requests.get(
+            f"{API_URL}/metrics",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200, f"Failed to get metrics: {response.text}"
+
+        metrics = response.json()["metrics"]
+        assert metrics.get("rate_limit.tracking_ticket.limited", 0) >= 1
+        print("✓ Limiter counters exported")
+
+
+class TestClientIp:
+    """Unit tests for the client IP used by the per-IP limits"""
+
+    def request(self, forwarded):
+        from starlette.requests import Request
+        return Request({
+            "type": "http",
+            "headers": [(b"x-forwarded-for", forwarded.encode())],
+            "client": ("10.0.0.1", 1234)
+        })
+
+    def test_forwarded_ignored_without_proxy(self, server, monkeypatch):
+        monkeypatch.setattr(server, "RATE_LIMIT_TRUST_FORWARDED", False)
+        assert server.client_ip(self.request("1.2.3.4")) == "10.0.0.1"
+
+    def test_spoofed_entries_ignored(self, server, monkeypatch):
+        """Behind one proxy only the entry it appended counts, whatever the client sent before it"""
+        monkeypatch.setattr(server, "RATE_LIMIT_TRUST_FORWARDED", True)
+        monkeypatch.setattr(server, "RATE_LIMIT_PROXY_HOPS", 1)
+        assert server.client_ip(self.request("6.6.6.6, 203.0.113.7")) == "203.0.113.7"
+
+        monkeypatch.setattr(server, "RATE_LIMIT_PROXY_HOPS", 2)
+        assert server.client_ip(self.request("6.6.6.6, 203.0.113.7, 10.0.0.2")) == "203.0.113.7"
+        print("✓ Client IP taken from the trusted proxy entry")
+
+
+class TestMemoryBackend:
+    """Unit tests for the in-process token buckets"""
+
+    def test_bucket_limits_and_refills(self, server, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr(server.time, "monotonic", lambda: clock[0])
+        backend = server.MemoryRateLimitBackend()
+
+        async def scenario():
+            assert [await backend.take("ip:1", 2, 1) for _ in range(2)] == [0.0, 0.0]
+            assert await backend.take("ip:1", 2, 1) == pytest.approx(1.0)
+            clock[0] += 1
+            return await backend.take("ip:1", 2, 1)
+
+        assert asyncio.run(scenario()) == 0.0
+        print("✓ Bucket limits and refills")
+
+    def test_evicts_least_recently_used(self, server):
+        """Over max_keys one stale key is dropped per call; recently used buckets are kept"""
+        backend = server.MemoryRateLimitBackend(max_keys=3)
+
+        async def scenario():
+            for _ in range(2):
+                await backend.take("victima", 5, 0.1)
+            for n in range(10):
+                await backend.take(f"flood:{n}", 5, 0.1)
+                await backend.take("victima", 5, 0.1)
+
+        asyncio.run(scenario())
+        assert len(backend.buckets) == 3
+        assert list(backend.buckets)[-1] == "victima"
+        # 12 takes from a bucket of 5 refilled at 0.1/s: still limited
+        assert backend.buckets["victima"][0] < 1
+        print("✓ Least recently used buckets evicted")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
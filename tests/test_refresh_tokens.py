@@ -0,0 +1,63 @@
+"""
+Test suite for refresh tokens and sessions (/api/auth/refresh, /api/auth/logout)
+Tests rotation, single use of a refresh token and revocation on logout
+"""
+import pytest
+import requests
+import os
+
+from tests.conftest import login
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+ADMIN_CREDENTIALS = {"username": "admin", "password": "admin123"}
+
+
+@pytest.fixture(scope="module")
+def login_data():
+    """One login with its own session; the rotation test leaves the current refresh token in it"""
+    return login(ADMIN_CREDENTIALS)
+
+
+class TestRefreshTokens:
+    """Test the refresh token lifecycle"""
+
+    def test_login_returns_refresh_token(self, login_data):
+        assert login_data.get("refresh_token")
+        assert login_data["expires_in"] > 0
+        print("✓ Login returns refresh token")
+
+    def test_refresh_rotates_token(self, login_data):
+        """A refresh token issues a new access token and can only be used once"""
+        old = login_data["refresh_token"]
+        response = requests.post(f"{API_URL}/auth/refresh", json={"refresh_token": old})
+        assert response.status_code == 200, f"Refresh failed: {response.text}"
+
+        data = response.json()
+        assert data["refresh_token"] != old
+        me = requests.get(f"{API_URL}/auth/me", headers={"Authorization": f"Bearer {data['access_token']}"})
+        assert me.status_code == 200
+
+        reused = requests.post(f"{API_URL}/auth/refresh", json={"refresh_token": old})
+        assert reused.status_code == 401
+        login_data["refresh_token"] = data["refresh_token"]
+        print("✓ Refresh token rotated")
+
+    def test_logout_revokes_session(self, login_data):
+        refresh_token = login_data["refresh_token"]
+        response = requests.post(f"{API_URL}/auth/logout", json={"refresh_token": refresh_token})
+        assert response.status_code == 200
+
+        response = requests.post(f"{API_URL}/auth/refresh", json={"refresh_token": refresh_token})
+        assert response.status_code == 401
+        print("✓ Logout revokes the session")
+
+    def test_invalid_refresh_token(self):
+        response = requests.post(f"{API_URL}/auth/refresh", json={"refresh_token": "invalido"})
+        assert response.status_code == 401
+        print("✓ Invalid refresh token rejected")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
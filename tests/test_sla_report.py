@@ -0,0 +1,57 @@
+"""
+Test suite for the SLA report (/api/reports/sla)
+Tests that delivery durations and failed attempts recorded on transitions are aggregated per group
+"""
+import pytest
+import os
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+class TestSlaReport:
+    """Test the SLA report"""
+
+    def test_delivery_counted(self, admin_client):
+        """A delivered envío with one failed attempt shows up in its departamento"""
+        before = admin_client.get(f"{API_URL}/reports/sla", params={"agrupar": "departamento"})
+        assert before.status_code == 200, f"Failed to get report: {before.text}"
+        grupo = next((g for g in before.json()["grupos"] if g["clave"] == "Rivera"), {"entregados": 0, "intentos_fallidos": 0})
+
+        create = admin_client.post(f"{API_URL}/envios", json={
+            "ticket": f"TEST-SLA-{uuid.uuid4().hex[:8]}",
+            "calle": "Sarandí",
+            "numero": "600",
+            "motivo": "Entrega",
+            "departamento": "Rivera",
+            "telefono": "099444555",
+            "contacto": "SLA Test"
+        })
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+        for cambio in [
+            {"nuevo_estado": "Asignado a courier"},
+            {"nuevo_estado": "No entregado", "comentario": "Ausente"},
+            {"nuevo_estado": "Asignado a courier"},
+            {"nuevo_estado": "Entregado", "receptor_nombre": "Luis", "receptor_cedula": "12345678"},
+        ]:
+            assert admin_client.patch(f"{API_URL}/envios/{envio_id}/estado", json=cambio).status_code == 200
+
+        after = admin_client.get(f"{API_URL}/reports/sla", params={"agrupar": "departamento"}).json()
+        rivera = next(g for g in after["grupos"] if g["clave"] == "Rivera")
+        assert rivera["entregados"] == grupo["entregados"] + 1
+        assert rivera["intentos_fallidos"] == grupo["intentos_fallidos"] + 1
+        assert rivera["minutos_entrega"]["p50"] >= 0
+
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Delivery and failed attempt counted")
+
+    def test_invalid_grouping(self, admin_client):
+        response = admin_client.get(f"{API_URL}/reports/sla", params={"agrupar": "color"})
+        assert response.status_code == 400
+        print("✓ Invalid grouping rejected")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
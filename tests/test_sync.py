@@ -0,0 +1,133 @@
+"""
+Test suite for the delta sync endpoint (/api/envios/sync)
+Tests that a sync token returns only changed envíos and tombstones of deleted ones
+"""
+import pytest
+import os
+import time
+import uuid
+from tests.conftest import login, auth_session
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+API_URL = f"{BASE_URL}/api"
+
+
+def full_sync(client, token=None):
+    """Follow has_more until the device is up to date; returns (envios by id, eliminados, token)"""
+    envios, eliminados = {}, []
+    while True:
+        response = client.get(f"{API_URL}/envios/sync", params={"since": token} if token else {})
+        assert response.status_code == 200, f"Sync failed: {response.text}"
+        data = response.json()
+        envios.update({e["id"]: e for e in data["envios"]})
+        eliminados.extend(data["eliminados"])
+        token = data["token"]
+        if not data["has_more"]:
+            return envios, eliminados, token
+
+
+@pytest.fixture(scope="module")
+def repartidor_client(admin_client):
+    """Session of a courier created for this module"""
+    credentials = {"username": f"test-sync-{uuid.uuid4().hex[:8]}", "password": "rep123"}
+    user = admin_client.post(f"{API_URL}/users", json={**credentials, "nombre": "Sync Courier", "rol": "repartidor"})
+    assert user.status_code == 200, f"Failed to create courier: {user.text}"
+    yield auth_session(login(credentials)["access_token"])
+    admin_client.delete(f"{API_URL}/users/{user.json()['id']}")
+
+
+class TestDeltaSync:
+    """Test /api/envios/sync"""
+
+    def test_initial_sync_is_reset(self, admin_client):
+        response = admin_client.get(f"{API_URL}/envios/sync", params={"limit": 1})
+        assert response.status_code == 200
+        assert response.json()["reset"] is True
+        print("✓ Initial sync requests a full reset")
+
+    def test_changes_and_deletions(self, admin_client):
+        """Changes after the token are returned, deletions come back as tombstones"""
+        _, _, token = full_sync(admin_client)
+
+        create = admin_client.post(f"{API_URL}/envios", json={
+            "ticket": f"TEST-SYNC-{uuid.uuid4().hex[:8]}",
+            "calle": "Mercedes",
+            "numero": "900",
+            "motivo": "Entrega",
+            "departamento": "Montevideo",
+            "telefono": "099111222",
+            "contacto": "Sync Test"
+        })
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+
+        envios, _, token = full_sync(admin_client, token)
+        assert envio_id in envios
+
+        admin_client.patch(f"{API_URL}/envios/{envio_id}/estado", json={"nuevo_estado": "Asignado a courier"})
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        # Let the change leave the server's safety lag window
+        time.sleep(6)
+
+        _, eliminados, _ = full_sync(admin_client, token)
+        assert envio_id in eliminados
+        print("✓ Changes and deletions synced")
+
+    def test_invalid_token(self, admin_client):
+        response = admin_client.get(f"{API_URL}/envios/sync", params={"since": "invalido"})
+        assert response.status_code == 400
+        print("✓ Invalid sync token rejected")
+
+
+class TestCourierSync:
+    """Test the working set synced to couriers"""
+
+    def test_taken_envio_becomes_tombstone(self, admin_client, repartidor_client):
+        """Open envíos are synced without photos; once another user takes one it is removed from the device"""
+        _, _, token = full_sync(repartidor_client)
+
+        create = admin_client.post(f"{API_URL}/envios", json={
+            "ticket": f"TEST-SYNC-{uuid.uuid4().hex[:8]}",
+            "calle": "Mercedes",
+            "numero": "950",
+            "motivo": "Entrega",
+            "departamento": "Montevideo",
+            "telefono": "099111222",
+            "contacto": "Sync Courier Test"
+        })
+        assert create.status_code == 200
+        envio_id = create.json()["id"]
+        time.sleep(6)
+
+        envios, _, token = full_sync(repartidor_client, token)
+        assert envio_id in envios
+        assert all(h.get("imagen_url") is None for h in envios[envio_id]["historial_estados"])
+
+        # Assigned to the admin, so out of this courier's scope
+        admin_client.patch(f"{API_URL}/envios/{envio_id}/estado", json={"nuevo_estado": "Asignado a courier"})
+        time.sleep(6)
+
+        envios, eliminados, _ = full_sync(repartidor_client, token)
+        assert envio_id not in envios
+        assert envio_id in eliminados
+
+        full, _, _ = full_sync(repartidor_client)
+        assert envio_id not in full
+
+        admin_client.delete(f"{API_URL}/envios/{envio_id}")
+        print("✓ Courier sync limited to its scope")
+
+
+class TestSyncReads:
+    """Unit test for where delta sync reads from"""
+
+    def test_reads_from_primary(self, server):
+        """Whatever MONGO_READ_PREFERENCE says, a lagging secondary must not advance the sync token"""
+        from pymongo import ReadPreference
+        assert server.QUERY_BUDGETS["sync_envios"][0] == "sync"
+        assert server.read_db("sync").read_preference == ReadPreference.PRIMARY
+        print("✓ Delta sync reads from the primary")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
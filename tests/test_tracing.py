@@ -0,0 +1,125 @@
+"""
+Test suite for request tracing (Tracer, TracingMiddleware, SpanExporter)
+Unit tests for traceparent parsing and propagation, and for the span buffer shared with Motor threads
+"""
+import pytest
+import asyncio
+import threading
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+async def ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+def request(middleware, headers):
+    """Response headers of a GET /api/envios sent with the given headers"""
+    scope = {
+        "type": "http", "method": "GET", "path": "/api/envios",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+    }
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(middleware(scope, None, send))
+    return {name.decode(): value.decode() for name, value in messages[0]["headers"]}
+
+
+class TestParseTraceparent:
+    """Test W3C traceparent parsing"""
+
+    def test_valid(self, server):
+        assert server.parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01") == (TRACE_ID, PARENT_ID, True)
+        assert server.parse_traceparent(f" 00-{TRACE_ID}-{PARENT_ID}-00 ") == (TRACE_ID, PARENT_ID, False)
+        print("✓ Trace id, parent and sampled flag parsed")
+
+    def test_invalid(self, server):
+        for value in (
+            None, "", "basura", f"00-{TRACE_ID}-{PARENT_ID}", f"00-{TRACE_ID.upper()}-{PARENT_ID}-01",
+            f"00-{'0' * 32}-{PARENT_ID}-01", f"00-{TRACE_ID}-{'0' * 16}-01"
+        ):
+            assert server.parse_traceparent(value) == (None, None, None), value
+        print("✓ Malformed and all-zero headers ignored")
+
+
+class TestPropagation:
+    """Test that traces continue through the server"""
+
+    def test_continues_caller_trace(self, server):
+        """A sampled caller gets back our span id in its trace, and our span is its child"""
+        tracer = server.Tracer(buffer_max=10)
+        middleware = server.TracingMiddleware(ok_app, tracer, sample_ratio=0)
+        headers = request(middleware, {"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"})
+
+        [span] = tracer.take_finished()
+        assert (span.trace_id, span.parent_id, span.kind) == (TRACE_ID, PARENT_ID, "server")
+        assert span.attributes["http.status_code"] == 200
+        assert headers["traceparent"] == f"00-{TRACE_ID}-{span.span_id}-01"
+        print("✓ Caller's trace continued and returned")
+
+    def test_caller_not_sampled(self, server):
+        """The caller's sampling decision wins over our ratio"""
+        tracer = server.Tracer(buffer_max=10)
+        middleware = server.TracingMiddleware(ok_app, tracer, sample_ratio=1)
+        headers = request(middleware, {"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"})
+
+        assert "traceparent" not in headers
+        assert tracer.take_finished() == []
+        print("✓ Unsampled caller not traced")
+
+    def test_new_trace_by_ratio(self, server):
+        tracer = server.Tracer(buffer_max=10)
+        headers = request(server.TracingMiddleware(ok_app, tracer, sample_ratio=1), {})
+
+        [span] = tracer.take_finished()
+        assert span.parent_id is None
+        assert headers["traceparent"] == span.traceparent()
+
+        assert "traceparent" not in request(server.TracingMiddleware(ok_app, tracer, sample_ratio=0), {})
+        assert tracer.take_finished() == []
+        print("✓ New traces started by the sample ratio")
+
+
+class TestSpanBuffer:
+    """Test the finished-span buffer"""
+
+    def test_no_span_lost_while_flushing(self, server):
+        """Spans ended on other threads during take_finished land in one batch or the next"""
+        tracer = server.Tracer(buffer_max=100000)
+        per_thread, threads = 5000, 4
+
+        def end_spans():
+            for _ in range(per_thread):
+                tracer.end(tracer.start("mongo.find", "client"))
+
+        workers = [threading.Thread(target=end_spans) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        taken = []
+        while any(worker.is_alive() for worker in workers):
+            taken.extend(tracer.take_finished())
+        for worker in workers:
+            worker.join()
+        taken.extend(tracer.take_finished())
+
+        assert len(taken) == per_thread * threads
+        print("✓ No span lost to a concurrent flush")
+
+    def test_buffer_max(self, server):
+        tracer = server.Tracer(buffer_max=2)
+        dropped = server.METRICS["tracing.dropped"]
+        for _ in range(3):
+            tracer.end(tracer.start("x"))
+
+        assert len(tracer.take_finished()) == 2
+        assert server.METRICS["tracing.dropped"] == dropped + 1
+        print("✓ Spans beyond the buffer dropped and counted")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
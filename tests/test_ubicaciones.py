@@ -0,0 +1,91 @@
+"""
+Test suite for buffered courier location pings (CourierLocations)
+Unit tests for the in-memory buffer and its batched, cancellation-safe flush
+"""
+import pytest
+import asyncio
+from datetime import datetime, timezone
+
+
+class FakeCollection:
+    """insert_many that takes `delay` seconds and fails with `error` if set"""
+
+    def __init__(self, delay=0.0, error=None):
+        self.docs = []
+        self.delay = delay
+        self.error = error
+
+    async def insert_many(self, docs, ordered=True):
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        self.docs.extend(docs)
+
+
+def puntos(server, n):
+    return [
+        server.PuntoUbicacion(lat=-34.9 + i / 1000, lng=-56.19, fecha=datetime.now(timezone.utc))
+        for i in range(n)
+    ]
+
+
+class TestBuffer:
+    """Test buffering and flushing of pings"""
+
+    def test_flush_writes_buffer(self, server):
+        async def scenario():
+            locations = server.CourierLocations(FakeCollection())
+            assert locations.add("c1", puntos(server, 3)) == 3
+            assert locations.collection.docs == []
+            await locations.flush()
+            return locations
+        
+        locations = asyncio.run(scenario())
+        assert len(locations.collection.docs) == 3
+        assert locations.pending == []
+        assert locations.latest["c1"][0]["lat"] == pytest.approx(-34.898)
+        print("✓ Buffered pings written on flush")
+
+    def test_buffer_limit(self, server, monkeypatch):
+        monkeypatch.setattr(server, "LOCATION_BUFFER_MAX", 5)
+        locations = server.CourierLocations(FakeCollection())
+        locations.add("c1", puntos(server, 4))
+        with pytest.raises(server.HTTPException) as error:
+            locations.add("c1", puntos(server, 2))
+        assert error.value.status_code == 503
+        print("✓ Full buffer rejects pings with 503")
+
+    def test_failed_write_kept(self, server):
+        async def scenario():
+            locations = server.CourierLocations(FakeCollection(error=server.PyMongoError("down")))
+            locations.add("c1", puntos(server, 3))
+            await locations.flush()
+            return locations
+        
+        assert len(asyncio.run(scenario()).pending) == 3
+        print("✓ Failed batch kept for the next flush")
+
+    def test_cancelled_flush_keeps_batch(self, server):
+        """Cancelling the flush loop mid-insert (shutdown) does not lose the batch it swapped out"""
+        async def scenario():
+            locations = server.CourierLocations(FakeCollection(delay=0.05))
+            locations.add("c1", puntos(server, 3))
+            loop_task = asyncio.create_task(locations.flush_loop())
+            locations.wakeup.set()
+            await asyncio.sleep(0.01)
+            assert locations.pending == [] and locations.collection.docs == []
+            
+            loop_task.cancel()
+            locations.add("c1", puntos(server, 2))
+            # What shutdown does after cancelling the background tasks
+            await locations.flush()
+            return locations
+        
+        locations = asyncio.run(scenario())
+        assert len(locations.collection.docs) == 5
+        assert locations.pending == []
+        print("✓ Cancelled flush still writes its batch")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])